@@ -1,5 +1,6 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from .models import *
+from . import search
 
 admin.site.register(Conversation)
 admin.site.register(Message)
@@ -11,3 +12,30 @@ class FeedbackAdmin(admin.ModelAdmin):
 	search_fields = ('subject', 'message', 'name', 'email')
 	list_filter = ('type', 'status', 'created_at')
 	readonly_fields = ('created_at', 'updated_at')
+	search_limit = 1000
+
+	def get_search_results(self, request, queryset, search_term):
+		# served from the full-text index instead of icontains scans over every column
+		if not search_term.strip():
+			return queryset, False
+		ids = search.search_feedback(search_term, limit=self.search_limit)
+		if len(ids) >= self.search_limit:
+			# the changelist paginates what it is given; say so when the index cut the matches short
+			message = f'Only the {self.search_limit} best matches are listed; refine the search to see the rest.'
+			self.message_user(request, message, messages.WARNING)
+		return queryset.filter(id__in=ids), False
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+	list_display = ('id', 'subject', 'recipient', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+	list_filter = ('status',)
+	search_fields = ('recipient', 'subject')
+	readonly_fields = ('created_at', 'sent_at')
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+	list_display = ('id', 'group', 'status', 'attempts', 'created_at', 'dispatched_at')
+	list_filter = ('status',)
+	readonly_fields = ('created_at', 'dispatched_at')
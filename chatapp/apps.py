@@ -1,6 +1,23 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatappConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "chatapp"
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        if getattr(settings, 'CHAT_START_WORKERS', False):
+            # one poll straight away: mail, events and messages left over from before a restart
+            # shouldn't have to wait for new ones to be queued
+            from .mail import mail_worker
+            from .outbox import event_dispatcher
+            from .search import message_indexer
+            if getattr(settings, 'CHAT_MAIL_WORKER', 'thread') == 'thread':
+                mail_worker.wake()
+            if getattr(settings, 'CHAT_OUTBOX_WORKER', 'thread') == 'thread':
+                event_dispatcher.wake()
+            if getattr(settings, 'CHAT_SEARCH_WORKER', 'thread') == 'thread':
+                message_indexer.wake()
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .cache import user_cache
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that resolves the token's user through the shared user cache.
+
+    The cache only hears about user changes made in this process, so entries
+    older than `CHAT_AUTH_USER_MAX_AGE` seconds are reloaded: a user
+    deactivated, deleted or with a changed password elsewhere is turned away
+    within that window instead of the cache's full TTL.
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_FIELD != 'id':
+            return super().get_user(validated_token)
+
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        try:
+            user = user_cache.load(user_id, max_age=getattr(settings, 'CHAT_AUTH_USER_MAX_AGE', 10))
+        except self.user_model.DoesNotExist as e:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found") from e
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
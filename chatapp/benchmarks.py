@@ -0,0 +1,313 @@
+"""Load and latency benchmarks for the chat hot paths.
+
+`BenchmarkSuite` drives ChatConsumer through channels' WebsocketCommunicator
+(N rooms x M clients on an in-process channel layer) and the REST endpoints
+through DRF's APIClient, against the current database. `manage.py
+bench_suite` runs it on a throwaway test database and writes the results as
+JSON so runs can be compared across commits.
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import db
+from .models import Conversation, Feedback
+from .services import post_message
+
+LAYERS = {
+    'local': {'BACKEND': 'chatapp.layers.LocalChannelLayer'},
+    'inmemory': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+}
+
+# the suite measures the paths, not the throttles in front of them
+UNTHROTTLED = {
+    'CHAT_MESSAGE_RATE': 1e9,
+    'CHAT_MESSAGE_BURST': 10 ** 9,
+    'CHAT_USER_MESSAGE_RATE': 1e9,
+    'CHAT_USER_MESSAGE_BURST': 10 ** 9,
+}
+
+
+class QueryCounter:
+    """Counts queries on every connection, including the ones on the consumers' database threads.
+
+    The wrapper is attached to each connection as it opens and stays there;
+    it only counts while the counter is active.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.active = False
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.active:
+            with self._lock:
+                self.count += 1
+        return execute(sql, params, many, context)
+
+    def attach(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def start(self):
+        connection_created.connect(self.attach)
+        for connection in connections.all(initialized_only=True):
+            self.attach(connection=connection)
+        self.active = True
+
+    def stop(self):
+        self.active = False
+
+
+query_counter = QueryCounter()
+
+
+@contextmanager
+def throwaway_database():
+    """Point the default connection at a fresh test database for the duration of the block.
+
+    Benchmarks create and delete rows by the thousand from many threads, so
+    they neither touch the configured database nor fit in a rolled-back
+    transaction. An in-memory SQLite test database is replaced by a file, so
+    the benchmark's threads share one database, in WAL mode as in a sqlite
+    deployment.
+    """
+    setup_test_environment()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            test_settings = connection.settings_dict['TEST']
+            old_test_name = test_settings.get('NAME')
+            if connection.vendor == 'sqlite' and connection.creation.is_in_memory_db(old_test_name or ':memory:'):
+                test_settings['NAME'] = os.path.join(directory, 'bench.sqlite3')
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            if connection.vendor == 'sqlite':
+                # the mode is stored in the file, so every thread's connection gets it
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode=WAL')
+            try:
+                yield
+            finally:
+                close_pool_connections()
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                test_settings['NAME'] = old_test_name
+    finally:
+        teardown_test_environment()
+
+
+def close_pool_connections():
+    # the consumers' database threads keep their connections open (CONN_MAX_AGE), and
+    # postgres won't drop a database with open sessions; run one close on every thread
+    pools = []
+    if db._db_executor is not None:
+        pools.append((db._db_executor.pool, db._db_executor.max_workers))
+    if db._write_executor is not None:
+        pools.append((db._write_executor, 1))
+    for pool, workers in pools:
+        barrier = threading.Barrier(workers, timeout=5)
+
+        def close():
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            connections.close_all()
+
+        for future in [pool.submit(close) for _ in range(workers)]:
+            future.result()
+    connections.close_all()
+
+
+def summarize(latencies, elapsed, queries):
+    """Throughput, latency percentiles (ms) and queries per operation for one benchmark."""
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def pct(p):
+        return round(latencies[min(count - 1, int(count * p))] * 1000, 3)
+
+    return {
+        'count': count,
+        'seconds': round(elapsed, 3),
+        'throughput': round(count / elapsed, 1) if elapsed else None,
+        'p50_ms': pct(0.50),
+        'p95_ms': pct(0.95),
+        'p99_ms': pct(0.99),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'queries_per_op': round(queries / count, 2),
+    }
+
+
+class BenchmarkSuite:
+    """N rooms x M websocket clients, then the REST endpoints, on freshly seeded data.
+
+    Operations:
+
+    - ws_connect: open a socket and receive its presence snapshot.
+    - ws_message: one client sends, until every client in the room has the
+      message; all rooms send concurrently, one message at a time each.
+    - rest_message_list, rest_conversation_list, rest_feedback_list,
+      rest_feedback_create: one request each.
+    """
+
+    def __init__(self, rooms=10, clients=5, messages=20, requests=50, history=50, layer='local', timeout=10.0):
+        self.rooms = rooms
+        self.clients = clients
+        self.messages = messages
+        self.requests = requests
+        self.history = history
+        self.layer = layer
+        self.timeout = timeout
+
+    def config(self):
+        return {
+            'rooms': self.rooms,
+            'clients': self.clients,
+            'messages': self.messages,
+            'requests': self.requests,
+            'history': self.history,
+            'layer': self.layer,
+        }
+
+    def run(self):
+        overrides = dict(UNTHROTTLED, CHANNEL_LAYERS={'default': LAYERS[self.layer]},
+                         CHAT_OUTBOX_WORKER='command', CHAT_MAIL_WORKER='command',
+                         CHAT_SEARCH_WORKER='command')
+        with override_settings(**overrides):
+            self.seed()
+            query_counter.start()
+            try:
+                results = asyncio.run(self.run_websockets())
+                results.update(self.run_rest())
+            finally:
+                query_counter.stop()
+        return {'config': self.config(), 'results': results}
+
+    def seed(self):
+        # unusable passwords: hashing one per user would dominate the setup
+        password = make_password(None)
+        self.agent = User.objects.create(username='bench-agent', password=password, is_staff=True)
+        User.objects.create(username='bench-admin', password=password, email='bench-admin@example.com',
+                            is_staff=True, is_superuser=True)
+        self.room_users = []
+        for room in range(self.rooms):
+            users = User.objects.bulk_create([
+                User(username=f'bench-{room}-{client}', password=password) for client in range(self.clients)
+            ])
+            conversation = Conversation.objects.create()
+            conversation.participants.set([*users, self.agent])
+            for i in range(self.history):
+                post_message(conversation, users[i % len(users)], f'history {i}')
+            self.room_users.append((conversation, users))
+        Feedback.objects.bulk_create([
+            Feedback(user=self.room_users[i % self.rooms][1][0], subject=f'feedback {i}', message='Benchmark feedback')
+            for i in range(self.history)
+        ])
+
+    async def run_websockets(self):
+        application = import_string(settings.ASGI_APPLICATION)
+        rooms = []
+        try:
+            latencies = []
+            queries = query_counter.count
+            started = time.perf_counter()
+            for conversation, users in self.room_users:
+                sockets = []
+                rooms.append(sockets)
+                for user in users:
+                    path = f'/ws/chat/{conversation.id}/?token={AccessToken.for_user(user)}'
+                    connect_started = time.perf_counter()
+                    communicator = WebsocketCommunicator(application, path)
+                    connected, code = await communicator.connect(self.timeout)
+                    if not connected:
+                        raise RuntimeError(f'websocket connect was refused with code {code}')
+                    sockets.append(communicator)
+                    await communicator.receive_json_from(self.timeout)
+                    latencies.append(time.perf_counter() - connect_started)
+            results = {'ws_connect': summarize(latencies, time.perf_counter() - started,
+                                               query_counter.count - queries)}
+
+            latencies = []
+            queries = query_counter.count
+            started = time.perf_counter()
+            await asyncio.gather(*(self.chat(n, sockets, latencies) for n, sockets in enumerate(rooms)))
+            elapsed = time.perf_counter() - started
+            results['ws_message'] = summarize(latencies, elapsed, query_counter.count - queries)
+            results['ws_message']['deliveries_per_second'] = round(len(latencies) * self.clients / elapsed, 1)
+        finally:
+            await asyncio.gather(*(communicator.disconnect() for sockets in rooms for communicator in sockets))
+        return results
+
+    async def chat(self, room, sockets, latencies):
+        for i in range(self.messages):
+            text = f'bench {room}:{i}'
+            started = time.perf_counter()
+            await sockets[i % len(sockets)].send_json_to({'type': 'chat_message', 'message': text})
+            await asyncio.gather(*(self.receive_message(communicator, text) for communicator in sockets))
+            latencies.append(time.perf_counter() - started)
+
+    async def receive_message(self, communicator, text):
+        # presence deltas and other frames arrive on the same socket; skip them
+        while True:
+            frame = await communicator.receive_json_from(self.timeout)
+            if frame.get('type') == 'error':
+                raise RuntimeError(f"websocket error frame: {frame.get('code')}: {frame.get('message')}")
+            if frame.get('type') == 'chat_message' and frame.get('message') == text:
+                return
+
+    def run_rest(self):
+        client = APIClient()
+
+        def message_list(i):
+            conversation, users = self.room_users[i % self.rooms]
+            client.force_authenticate(users[0])
+            return client.get(reverse('message_list_create', args=[conversation.id]))
+
+        def conversation_list(i):
+            client.force_authenticate(self.agent)
+            return client.get(reverse('conversation_list'))
+
+        def feedback_list(i):
+            client.force_authenticate(self.agent)
+            return client.get(reverse('feedback_list_create'))
+
+        def feedback_create(i):
+            client.force_authenticate(self.room_users[i % self.rooms][1][0])
+            return client.post(reverse('feedback_list_create'),
+                               {'subject': f'bench {i}', 'message': 'Benchmark feedback', 'type': Feedback.FEEDBACK})
+
+        operations = {
+            'rest_message_list': message_list,
+            'rest_conversation_list': conversation_list,
+            'rest_feedback_list': feedback_list,
+            'rest_feedback_create': feedback_create,
+        }
+        return {name: self.measure_requests(request) for name, request in operations.items()}
+
+    def measure_requests(self, request):
+        latencies = []
+        queries = query_counter.count
+        started = time.perf_counter()
+        for i in range(self.requests):
+            request_started = time.perf_counter()
+            response = request(i)
+            latencies.append(time.perf_counter() - request_started)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{response.request["PATH_INFO"]} returned {response.status_code}: {response.content[:200]}')
+        return summarize(latencies, time.perf_counter() - started, query_counter.count - queries)
@@ -0,0 +1,141 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire `ttl` seconds after being set."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class UserCache:
+    """Process-wide cache of authenticated users keyed by primary key.
+
+    Shared by the websocket consumers and the REST JWT authentication so that
+    (re)connecting sockets and API calls don't hit the database for the same
+    user over and over. Entries are dropped by the User save/delete signals;
+    other worker processes only see a change once their entry's TTL runs out,
+    so callers making an authorization decision pass a shorter `max_age`.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, user_id, max_age=None):
+        """The cached user, or None if it isn't cached or was loaded more than `max_age` seconds ago."""
+        entry = self._cache.get(int(user_id))
+        if entry is None:
+            return None
+        loaded_at, user = entry
+        if max_age is not None and time.monotonic() - loaded_at > max_age:
+            return None
+        # hand out copies so callers can't mutate the cached instance
+        return copy.copy(user)
+
+    def load(self, user_id, max_age=None):
+        """Return the user from the cache, falling back to the database (raises DoesNotExist)."""
+        user = self.get(user_id, max_age)
+        if user is None:
+            from django.contrib.auth import get_user_model
+            user = get_user_model().objects.get(pk=user_id)
+            self._cache.set(user.pk, (time.monotonic(), user))
+            user = copy.copy(user)
+        return user
+
+    async def aload(self, user_id, max_age=None):
+        # common case is a cache hit which needs no thread hop at all
+        user = self.get(user_id, max_age)
+        if user is None:
+            from .db import db_to_async
+            user = await db_to_async(self.load)(user_id, max_age)
+        return user
+
+    def invalidate(self, user_id):
+        self._cache.delete(int(user_id))
+
+    def clear(self):
+        self._cache.clear()
+
+
+class StaffDirectory:
+    """Cached directory of staff and superuser accounts.
+
+    The admin set is tiny and rarely changes but is read on every feedback
+    submission, to address the notification mail. The User save/delete signals
+    invalidate it whenever an admin, or someone who was one, changes; the TTL
+    bounds staleness in other worker processes, so it is not used for
+    authorization: permission checks read the user row itself.
+    """
+
+    def __init__(self, ttl):
+        self._cache = TTLCache(maxsize=1, ttl=ttl)
+
+    def members(self):
+        """Mapping of user id -> {'id', 'email', 'is_staff', 'is_superuser'} for every admin."""
+        members = self._cache.get('members')
+        if members is None:
+            from django.contrib.auth import get_user_model
+            from django.db.models import Q
+            rows = (get_user_model().objects
+                    .filter(Q(is_staff=True) | Q(is_superuser=True))
+                    .values('id', 'email', 'is_staff', 'is_superuser'))
+            members = {row['id']: row for row in rows}
+            self._cache.set('members', members)
+        return members
+
+    def superuser_emails(self):
+        return [member['email'] for member in self.members().values() if member['is_superuser'] and member['email']]
+
+    def invalidate_for(self, user):
+        members = self._cache.get('members')
+        if members is not None and (user.is_staff or user.is_superuser or user.pk in members):
+            self.invalidate()
+
+    def invalidate(self):
+        self._cache.clear()
+
+
+user_cache = UserCache(
+    maxsize=getattr(settings, 'CHAT_USER_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'CHAT_USER_CACHE_TTL', 300),
+)
+
+staff_directory = StaffDirectory(ttl=getattr(settings, 'CHAT_STAFF_DIRECTORY_TTL', 300))
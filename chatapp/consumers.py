@@ -1,230 +1,651 @@
-from asgiref.sync import sync_to_async
-import json 
-import jwt 
+import asyncio
+import json
+import jwt
+import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
+from django.utils import timezone
 from urllib.parse import parse_qs
 
+from .cache import user_cache
+from .db import DatabaseBusy, db_to_async, write_to_async
+from .encoding import dumps, event_text, group_event
+from .ids import new_ulid
+from .indicators import get_typing_coalescer
+from .presence import get_presence_registry
+from .ratelimit import TokenBucket, get_rate_limiter
+from . import ratelimit
 
-class ChatConsumer(AsyncWebsocketConsumer):
+logger = logging.getLogger(__name__)
 
-    async def connect(self):
-        query_string = self.scope['query_string'].decode('utf-8')
-        params = parse_qs(query_string)
-        token = params.get('token', [None])[0] # token retrieved
-
-        if token:
-            try:
-                decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-                self.user = await self.get_user(decoded_data['user_id']) #get the user from the token
-                self.scope['user'] = self.user
-            except jwt.ExpiredSignatureError:
-                await self.close(code=4000) #close the connection if token is expired
-                return
-            except jwt.InvalidTokenError:
-                await self.close(code=4001) #close the connection if token is invalid
-                return
-        else:
-            await self.close(code=4002) #close the connection if no token is provided
-            return
 
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.room_group_name = f'chat_{self.conversation_id}'
+class ChatRoom:
+    """One conversation a socket has joined: messages, typing and presence for its `chat_{id}` group.
 
+    ChatConsumer holds a single room; StreamConsumer holds one per subscribed
+    `chat.<id>` stream. Per-socket state (user, rate limits, pending writes)
+    stays on the consumer.
+    """
 
-        # Add channel to the  group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-
-        # accept websocket connections
-        await self.accept()
-
-        user_data = await self.get_user_data(self.user)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'online_status',
-                'online_users': [user_data],
-                'status': 'online',
-            }
-        )
+    def __init__(self, consumer, conversation, stream=None):
+        self.consumer = consumer
+        self.conversation = conversation
+        self.conversation_id = conversation.id
+        self.group = f'chat_{conversation.id}'
+        self.stream = stream
+        self.catch_up_task = None
+        self.held_events = None   # live events held back while a catch-up is replaying
+        self.replayed_ids = set() # replayed messages whose live event may still be on its way
+        self.joined_at = None
+
+    async def join(self):
+        consumer = self.consumer
+        await consumer.channel_layer.group_add(self.group, consumer.channel_name)
+        self.joined_at = timezone.now()
+
+    def online_snapshot(self):
+        # the joining socket gets everyone already online; others learn about it from the next batched delta
+        consumer = self.consumer
+        online_users = get_presence_registry().join(self.group, consumer.user_data, consumer.channel_name)
+        return {
+            'type': 'online_status',
+            'online_users': online_users,
+            'status': 'online',
+            'snapshot': True,
+        }
 
-    async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_name'):
-            # notify others about the disconnect
-            user_data = await self.get_user_data(self.scope["user"])
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'online_status',
-                    'online_users': [user_data],
-                    'status': 'offline',
-                }
-            )
+    async def leave(self):
+        consumer = self.consumer
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+        # the offline status goes out with the next batched presence delta
+        get_presence_registry().leave(self.group, consumer.user.id, consumer.channel_name)
+        if get_typing_coalescer().stop(self.group, consumer.user.id):
+            await self.broadcast_typing(None, False)
 
-            # Remove channel from the group
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+        # Remove channel from the group
+        await consumer.channel_layer.group_discard(self.group, consumer.channel_name)
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        event_type = text_data_json.get('type')
+    async def receive(self, event_type, data):
+        consumer = self.consumer
 
         if event_type == 'chat_message':
-            message_content = text_data_json.get('message')
-            temp_id = text_data_json.get('temp_id', None)
+            message_content = data.get('message')
+            temp_id = data.get('temp_id', None)
 
-            try:
-                # use the authenticated user associated with this connection
-                user = self.scope.get('user')
+            if not isinstance(message_content, str) or not message_content.strip():
+                await self.send_error('invalid', '`message` must be a non-empty string', event=event_type, temp_id=temp_id)
+                return
+            # stored the way the REST serializer stores it, so what peers see is what gets saved
+            message_content = message_content.strip()
+            if len(message_content) > consumer.max_message_length:
+                ratelimit.stats['oversized'] += 1
+                await self.send_error('too_large', f'Messages are limited to {consumer.max_message_length} characters',
+                                      event=event_type, temp_id=temp_id)
+                return
+            if await self.throttled(event_type, 'throttled_messages', 'Too many messages, slow down', temp_id=temp_id):
+                return
 
-                conversation = await self.get_conversation(self.conversation_id)
-                from .serializers import UserListSerializer
-                user_data = UserListSerializer(user).data
+            if getattr(settings, 'CHAT_BROADCAST_BEFORE_PERSIST', False):
+                await self.broadcast_then_persist(message_content, temp_id)
+                return
 
-                # save message to the database
-                message = await self.save_message(conversation, user, message_content)
+            started = time.perf_counter()
+            try:
+                # conversation, membership and the user payload were resolved on connect
+                message = await consumer.save_message(self.conversation, consumer.user, message_content)
 
                 # broadcast the message to the group (include temp_id if provided)
                 payload = {
                     'type': 'chat_message',
                     'id': message.id,
+                    'uid': message.uid,
                     'message': message.content,
-                    'user': user_data,
+                    'user': consumer.user_data,
                     'timestamp': message.timestamp.isoformat(),
                 }
+                if getattr(message, 'change_version', None) is not None:
+                    payload['version'] = message.change_version
                 if temp_id is not None:
                     payload['temp_id'] = temp_id
 
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    payload
-                )
-            except Exception as e:
-                print(f"Error saving message: {e}")
-        
+                await self.broadcast(payload)
+            except DatabaseBusy as e:
+                # backpressure: the client keeps the message and retries it
+                logger.warning('chat message rejected, database busy', extra=self.log_context(started))
+                await self.send_error('busy', 'Server is busy, retry shortly',
+                                      event=event_type, temp_id=temp_id, retry_after=e.retry_after)
+            except Exception:
+                logger.exception('chat message failed', extra=self.log_context(started))
+            else:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('chat message sent', extra=self.log_context(started, message_id=message.id))
+
+        elif event_type == 'heartbeat':
+            get_presence_registry().heartbeat(self.group, consumer.user.id, consumer.channel_name)
+
+        elif event_type == 'resume':
+            # every resume is a history query (up to CHAT_CATCH_UP_LIMIT rows); it costs what a message does
+            if await self.throttled(event_type, 'throttled_resumes', 'Too many resume requests, slow down'):
+                return
+            await self.resume(data.get('last_id'))
+
         elif event_type == 'typing':
+            if consumer.typing_bucket.take(time.monotonic()):
+                ratelimit.stats['throttled_typing'] += 1
+                # typing is best effort: drop the frames, but say so once per burst
+                if not consumer.typing_throttled:
+                    consumer.typing_throttled = True
+                    await self.send_error('throttled', 'Too many typing events', event=event_type)
+                return
+            consumer.typing_throttled = False
             try:
-                user_data = await self.get_user_data(self.scope['user'])
-                receiver_id = text_data_json.get('receiver')
+                receiver_id = data.get('receiver')
 
                 if receiver_id is not None:
                     if isinstance(receiver_id, (str, int, float)):
                         receiver_id = int(receiver_id)
 
-                        if receiver_id != self.scope['user'].id:
-                            print(f"{user_data['username']} is typing for Receiver: {receiver_id}")
-                            await self.channel_layer.group_send(
-                                self.room_group_name,
-                                {
-                                    'type': 'typing',
-                                    'user': user_data,
-                                    'receiver': receiver_id,
-                                }
-                            )
+                        if receiver_id != consumer.user.id:
+                            await self.handle_typing(receiver_id, data.get('is_typing', True) is not False)
                         else:
-                            print(f"User is typing for themselves")
+                            logger.debug('typing event for self ignored', extra=self.log_context())
                     else:
-                        print(f"Invalid receiver ID: {type(receiver_id)}")
+                        logger.debug('typing event with invalid receiver ignored', extra=self.log_context())
                 else:
-                    print("No receiver ID provided")
-            except ValueError as e:
-                print(f"Error parsing receiver ID: {e}")
-            except Exception as e:
-                print(f"Error getting user data: {e}")
-
-    # helper functions
-    async def chat_message(self, event):
-        message = event['message']
-        user = event['user']
-        timestamp = event['timestamp']
-        message_id = event.get('id')
-        temp_id = event.get('temp_id')
+                    logger.debug('typing event without receiver ignored', extra=self.log_context())
+            except ValueError:
+                logger.debug('typing event with invalid receiver ignored', extra=self.log_context())
+            except Exception:
+                logger.exception('typing event failed', extra=self.log_context())
+
+    async def throttled(self, event_type, counter, message, **extra):
+        """Charge a frame to the socket's and the user's message buckets; tells the client if it was refused."""
+        consumer = self.consumer
+        retry_after = get_rate_limiter().take(consumer.message_bucket, consumer.user.id)
+        if not retry_after:
+            return False
+        ratelimit.stats[counter] += 1
+        await self.send_error('throttled', message, event=event_type, retry_after=round(retry_after, 3), **extra)
+        return True
+
+    async def handle_typing(self, receiver_id, is_typing):
+        # coalesced per (conversation, user): at most one typing broadcast per window,
+        # plus a single "stopped typing" once the user goes quiet or says so
+        typing = get_typing_coalescer()
+        user_id = self.consumer.user.id
+        if not is_typing:
+            if typing.stop(self.group, user_id):
+                await self.broadcast_typing(receiver_id, False)
+            return
+        if typing.start(self.group, user_id, lambda: self.broadcast_typing(receiver_id, False)):
+            await self.broadcast_typing(receiver_id, True)
+
+    async def broadcast_typing(self, receiver_id, is_typing):
+        await self.broadcast({
+            'type': 'typing',
+            'user': self.consumer.user_data,
+            'receiver': receiver_id,
+            'is_typing': is_typing,
+        })
+
+    async def broadcast_then_persist(self, content, temp_id):
+        """Fan the message out under a server-assigned uid first and write it in the background.
 
+        Recipients get `chat_message` with `pending: true` right away, followed by
+        `message_persisted` (carrying the database id) or `message_failed`.
+        """
+        uid = new_ulid()
         payload = {
             'type': 'chat_message',
-            'message': message,
-            'user': user,
-            'timestamp': timestamp,
+            'uid': uid,
+            'message': content,
+            'user': self.consumer.user_data,
+            'timestamp': timezone.now().isoformat(),
+            'pending': True,
         }
-
-        if message_id is not None:
-            payload['id'] = message_id
         if temp_id is not None:
             payload['temp_id'] = temp_id
+        await self.broadcast(payload)
 
-        await self.send(text_data=json.dumps(payload))
-    
-    async def typing(self, event):
-        user = event['user']
-        receiver = event.get('receiver')
-        is_typing = event.get('is_typing', False)
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'user': user,
-            'receiver': receiver,
-            'is_typing': is_typing,
-        }))
-
-    async def online_status(self, event):
-        await self.send(text_data=json.dumps(event))
-    
-    
-    @sync_to_async
-    def get_user(self, user_id):
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        return User.objects.get(id=user_id)
-
-    @sync_to_async
-    def get_user_data(self, user):
+        task = asyncio.ensure_future(self.persist_message(uid, content, temp_id))
+        pending_writes = self.consumer.pending_writes
+        pending_writes.add(task)
+        task.add_done_callback(pending_writes.discard)
+
+    async def persist_message(self, uid, content, temp_id):
+        consumer = self.consumer
+        try:
+            message = await consumer.save_message(self.conversation, consumer.user, content, uid=uid)
+        except DatabaseBusy as e:
+            logger.warning('background message write rejected, database busy', extra=self.log_context(uid=uid))
+            event = {'type': 'message_failed', 'uid': uid, 'error': 'Server is busy, retry shortly',
+                     'retry_after': e.retry_after}
+        except Exception:
+            logger.exception('background message write failed', extra=self.log_context(uid=uid))
+            event = {'type': 'message_failed', 'uid': uid, 'error': 'Message could not be saved'}
+        else:
+            event = {
+                'type': 'message_persisted',
+                'uid': uid,
+                'id': message.id,
+                'timestamp': message.timestamp.isoformat(),
+            }
+            if getattr(message, 'change_version', None) is not None:
+                event['version'] = message.change_version
+        if temp_id is not None:
+            event['temp_id'] = temp_id
+        await self.broadcast(event)
+
+    async def resume(self, last_id):
+        """Replay the messages sent after `last_id` before delivering anything live.
+
+        Live events arriving meanwhile are held and delivered once the replay is
+        done, so the client sees one ordered history with no gap and no repeats.
+        """
+        try:
+            last_id = int(last_id)
+        except (TypeError, ValueError):
+            await self.send_error('invalid', '`last_id` must be a message id', event='resume')
+            return
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+        if self.held_events is None:
+            self.held_events = []
+        self.catch_up_task = asyncio.ensure_future(self.catch_up(last_id))
+
+    async def catch_up(self, last_id):
+        from .services import message_payload
+        consumer = self.consumer
+        batch_size = getattr(settings, 'CHAT_CATCH_UP_BATCH_SIZE', 100)
+        limit = getattr(settings, 'CHAT_CATCH_UP_LIMIT', 1000)
+        cursor, sent = last_id, 0
+        try:
+            while True:
+                messages = await consumer.get_messages_after(self.conversation_id, cursor, min(batch_size, limit - sent + 1))
+                truncated = sent + len(messages) > limit
+                if truncated:
+                    messages = messages[:limit - sent]
+                done = truncated or len(messages) < batch_size
+                payloads = []
+                for message in messages:
+                    payloads.append(message_payload(message))
+                    if message.timestamp >= self.joined_at:
+                        self.replayed_ids.add(message.id)
+                if messages:
+                    cursor = (messages[-1].timestamp, messages[-1].id)
+                    sent += len(messages)
+                frame = {'type': 'catch_up', 'messages': payloads, 'done': done}
+                if truncated:
+                    # too far behind: the client should reload through the REST history instead
+                    frame['truncated'] = True
+                await consumer.send_payload(frame, self.stream)
+                if done:
+                    break
+        except DatabaseBusy as e:
+            await self.send_error('busy', 'Server is busy, retry shortly', event='resume', retry_after=e.retry_after)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('catch-up failed', extra=self.log_context(last_id=last_id))
+            await self.send_error('catch_up_failed', 'Missed messages could not be loaded', event='resume')
+        finally:
+            if self.catch_up_task is asyncio.current_task():
+                self.catch_up_task = None
+        held, self.held_events = self.held_events or [], None
+        for event in held:
+            await self.deliver(event)
+
+    async def deliver(self, event):
+        """Send a group event from this room's group to the socket."""
+        if self.held_events is not None:
+            self.held_events.append(event)
+            return
+        if self.replayed_ids and event['type'] == 'chat_message' and event.get('id') in self.replayed_ids:
+            return
+        await self.consumer.send_group_event(event)
+
+    async def send_error(self, code, message, **extra):
+        await self.consumer.send_error(code, message, stream=self.stream, **extra)
+
+    def log_context(self, started=None, **extra):
+        context = {'conversation_id': self.conversation_id, 'user_id': self.consumer.user.id, **extra}
+        if started is not None:
+            context['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        return context
+
+    async def broadcast(self, payload):
+        """Encode `payload` once and fan it out to the conversation group."""
+        await self.consumer.channel_layer.group_send(self.group, group_event(payload, self.group))
+
+
+class ChatSocketConsumer(AsyncWebsocketConsumer):
+    """Shared plumbing for authenticated sockets: JWT auth, frame limits and chat persistence."""
+
+    async def authenticate(self):
+        """Resolve the user from the `token` query parameter; closes the socket and returns False on failure."""
+        query_string = self.scope['query_string'].decode('utf-8')
+        params = parse_qs(query_string)
+        token = params.get('token', [None])[0] # token retrieved
+
+        if token:
+            try:
+                decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+                self.user = await self.get_user(decoded_data['user_id']) #get the user from the token
+                if not self.user.is_active:
+                    await self.close(code=4001) #close the connection if the user was deactivated
+                    return False
+                self.scope['user'] = self.user
+            except jwt.ExpiredSignatureError:
+                await self.close(code=4000) #close the connection if token is expired
+                return False
+            except (jwt.InvalidTokenError, KeyError, ObjectDoesNotExist):
+                await self.close(code=4001) #close the connection if token is invalid or its user is gone
+                return False
+            except DatabaseBusy:
+                await self.close(code=1013) #try again later: the database queue is full
+                return False
+        else:
+            await self.close(code=4002) #close the connection if no token is provided
+            return False
+        return True
+
+    def setup_socket(self):
         from .serializers import UserListSerializer
-        return UserListSerializer(user).data
+        self.user_data = UserListSerializer(self.user).data
+        self.pending_writes = set()
+        self.message_bucket = get_rate_limiter().connection_bucket()
+        self.typing_bucket = TokenBucket(getattr(settings, 'CHAT_TYPING_RATE', 5.0), getattr(settings, 'CHAT_TYPING_BURST', 10))
+        self.typing_throttled = False
+        self.max_frame_size = getattr(settings, 'CHAT_MAX_FRAME_SIZE', 16384)
+        self.max_message_length = getattr(settings, 'CHAT_MAX_MESSAGE_LENGTH', 4000)
+
+    async def parse_frame(self, text_data):
+        # checked before parsing so an oversized frame costs nothing but its length
+        if len(text_data) > self.max_frame_size:
+            ratelimit.stats['oversized'] += 1
+            await self.send_error('too_large', f'Frames are limited to {self.max_frame_size} characters')
+            return None
+        return json.loads(text_data)
+
+    async def send_payload(self, payload, stream=None):
+        await self.send(text_data=dumps({'stream': stream, **payload} if stream is not None else payload))
+
+    async def send_group_event(self, event):
+        await self.send(text_data=event_text(event))
 
-    @sync_to_async
+    async def send_error(self, code, message, stream=None, **extra):
+        # on multiplexed sockets error frames lead with their stream like every other frame
+        frame = {'stream': stream} if stream is not None else {}
+        frame.update(type='error', code=code, message=message)
+        frame.update((key, value) for key, value in extra.items() if value is not None)
+        await self.send(text_data=dumps(frame))
+
+    async def get_user(self, user_id):
+        # same revalidation as REST authentication: changes made by other processes apply within the max age
+        return await user_cache.aload(user_id, max_age=getattr(settings, 'CHAT_AUTH_USER_MAX_AGE', 10))
+
+    @db_to_async
+    def get_messages_after(self, conversation_id, cursor, limit):
+        """The next `limit` messages after `cursor` (a message id, or the (timestamp, id) of the last one sent)."""
+        from .models import Message
+        from .pagination import MessageKeysetPagination
+        queryset = Message.objects.filter(conversation_id=conversation_id)
+        if isinstance(cursor, tuple):
+            timestamp, message_id = cursor
+            newer = Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+        else:
+            # same (timestamp, id) keyset as `?after=` on the REST history, on the same index
+            newer = MessageKeysetPagination().newer_than(queryset, cursor)
+        return list(queryset.filter(newer).select_related('sender').order_by('timestamp', 'id')[:limit])
+
+    @db_to_async
     def get_conversation(self, conversation_id):
         from .models import Conversation
         try:
             return Conversation.objects.get(id=conversation_id)
         except Conversation.DoesNotExist:
-            print(F"Conversation with id {conversation_id} does not exist")
+            logger.info('conversation does not exist', extra={'conversation_id': conversation_id})
             return None
 
-    @sync_to_async
-    def save_message(self, conversation, user, content):
-        from .models import Message
-        return Message.objects.create(
-            conversation=conversation,
-            sender=user,
-            content=content
-        )
+    async def save_message(self, conversation, user, content, uid=None):
+        if getattr(settings, 'CHAT_WRITE_BEHIND', False):
+            # batched with other sockets' messages; resolves once the row (and its id) exists
+            from .models import Message
+            from .persistence import get_message_writer
+            message = Message(conversation=conversation, sender=user, content=content)
+            if uid is not None:
+                message.uid = uid
+            return await get_message_writer().submit(message)
+        return await write_to_async(self.create_message)(conversation, user, content, uid)
 
+    def create_message(self, conversation, user, content, uid=None):
+        from .services import post_message
+        # the consumer broadcasts the message itself, straight from the event loop
+        return post_message(conversation, user, content, uid=uid)
 
-class NotificationsConsumer(AsyncWebsocketConsumer):
-    """Simple notifications consumer that joins a per-user group named `user_{id}`.
-    Used to push feedback updates (admin responses) to the specific user in real time.
+
+class ChatConsumer(ChatSocketConsumer):
+
+    async def connect(self):
+        if not await self.authenticate():
+            return
+
+        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
+
+        # resolve the conversation and membership once; the message hot path relies on both
+        try:
+            self.conversation = await self.get_conversation(self.conversation_id)
+        except DatabaseBusy:
+            await self.close(code=1013)
+            return
+        if self.conversation is None:
+            await self.close(code=4004) #close the connection if the conversation does not exist
+            return
+        if not any(participant.id == self.user.id for participant in self.conversation.participants.all()):
+            await self.close(code=4003) #close the connection if the user is not a participant
+            return
+
+        self.setup_socket()
+        self.room = ChatRoom(self, self.conversation)
+
+        # Add channel to the  group
+        await self.room.join()
+
+        # accept websocket connections
+        await self.accept()
+
+        await self.send(text_data=dumps(self.room.online_snapshot()))
+
+        # reconnecting clients pass the last message they saw and get everything after it first
+        last_id = parse_qs(self.scope['query_string'].decode('utf-8')).get('last_id', [None])[0]
+        if last_id:
+            await self.room.resume(last_id)
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'room'):
+            await self.room.leave()
+
+    async def receive(self, text_data):
+        text_data_json = await self.parse_frame(text_data)
+        if text_data_json is not None:
+            await self.room.receive(text_data_json.get('type'), text_data_json)
+
+    # group event handlers: the payload was encoded once by the sender, the room sends it as-is
+    async def room_event(self, event):
+        await self.room.deliver(event)
+
+    chat_message = room_event
+    typing = room_event
+    online_status = room_event
+    message_persisted = room_event
+    message_failed = room_event
+    message_deleted = room_event
+    read_receipt = room_event
+
+
+class StreamConsumer(ChatSocketConsumer):
+    """One authenticated socket multiplexing any number of conversations and notifications.
+
+    Clients subscribe to streams, either on connect (`?streams=chat.12,notifications`)
+    or with frames, and every frame in either direction is tagged with its stream:
+
+        -> {"type": "subscribe", "streams": ["chat.12", "chat.40", "notifications"]}
+        <- {"stream": "chat.12", "type": "subscribed"}
+        -> {"stream": "chat.12", "type": "chat_message", "message": "hi", "temp_id": "t1"}
+        <- {"stream": "chat.12", "type": "chat_message", "id": 501, ...}
+        -> {"type": "unsubscribe", "stream": "chat.40"}
+
+    `chat.<id>` streams accept the same frames as ws/chat/<id>/ and deliver the
+    same events; `notifications` delivers what ws/notifications/ does.
     """
 
     async def connect(self):
-        query_string = self.scope['query_string'].decode('utf-8')
-        params = parse_qs(query_string)
-        token = params.get('token', [None])[0]
+        if not await self.authenticate():
+            return
+        self.setup_socket()
+        self.rooms = {}      # stream -> ChatRoom
+        self.room_groups = {}  # group -> ChatRoom
+        self.prefixes = {}   # group -> '{"stream":"<stream>",' spliced in front of pre-encoded events
+        self.max_streams = getattr(settings, 'CHAT_STREAM_MAX_SUBSCRIPTIONS', 100)
+        await self.accept()
 
-        if token:
-            try:
-                decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-                self.user = await self.get_user(decoded_data['user_id'])
-                self.scope['user'] = self.user
-            except Exception:
-                await self.close(code=4001)
+        params = parse_qs(self.scope['query_string'].decode('utf-8'))
+        streams = [stream for value in params.get('streams', []) for stream in value.split(',') if stream]
+        if streams:
+            await self.subscribe(streams)
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'rooms'):
+            for stream in [*self.rooms, 'notifications']:
+                await self.unsubscribe(stream, acknowledge=False)
+
+    async def receive(self, text_data):
+        data = await self.parse_frame(text_data)
+        if data is None:
+            return
+        event_type = data.get('type')
+
+        if event_type == 'subscribe':
+            last_ids = data.get('last_ids')
+            await self.subscribe(self.requested_streams(data), last_ids if isinstance(last_ids, dict) else None)
+        elif event_type == 'unsubscribe':
+            for stream in self.requested_streams(data):
+                await self.unsubscribe(stream)
+        else:
+            stream = data.get('stream')
+            room = self.rooms.get(stream)
+            if room is None:
+                await self.send_error('not_subscribed', 'Subscribe to the stream first', stream=stream, event=event_type)
                 return
+            await room.receive(event_type, data)
+
+    def requested_streams(self, data):
+        streams = data.get('streams', [data.get('stream')])
+        return [stream for stream in streams if isinstance(stream, str)] if isinstance(streams, list) else []
+
+    async def subscribe(self, streams, last_ids=None):
+        last_ids = last_ids or {}
+        conversation_ids = {}
+        for stream in dict.fromkeys(streams):
+            if stream == 'notifications':
+                group = f'user_{self.user.id}'
+                if group not in self.prefixes:
+                    await self.channel_layer.group_add(group, self.channel_name)
+                    self.prefixes[group] = self.stream_prefix(stream)
+                await self.send_payload({'type': 'subscribed'}, stream)
+            elif stream in self.rooms:
+                await self.send_payload({'type': 'subscribed'}, stream)
+            elif stream.startswith('chat.') and stream[5:].isdigit():
+                if len(self.rooms) + len(conversation_ids) >= self.max_streams:
+                    await self.send_error('too_many_streams', f'At most {self.max_streams} conversations per connection',
+                                          stream=stream)
+                else:
+                    conversation_ids[int(stream[5:])] = stream
+            else:
+                await self.send_error('unknown_stream', 'Unknown stream', stream=stream)
+        if not conversation_ids:
+            return
+
+        # one query for the whole batch, and no re-authentication per conversation
+        try:
+            conversations = await self.get_conversations(list(conversation_ids))
+        except DatabaseBusy as e:
+            for stream in conversation_ids.values():
+                await self.send_error('busy', 'Server is busy, retry shortly', stream=stream, retry_after=e.retry_after)
+            return
+        for conversation_id, stream in conversation_ids.items():
+            conversation = conversations.get(conversation_id)
+            if conversation is None:
+                await self.send_error('not_found', 'Conversation does not exist', stream=stream)
+            elif not any(participant.id == self.user.id for participant in conversation.participants.all()):
+                await self.send_error('forbidden', 'You are not a participant of this conversation', stream=stream)
+            else:
+                room = self.rooms[stream] = ChatRoom(self, conversation, stream=stream)
+                self.room_groups[room.group] = room
+                self.prefixes[room.group] = self.stream_prefix(stream)
+                await room.join()
+                await self.send_payload({'type': 'subscribed'}, stream)
+                await self.send_payload(room.online_snapshot(), stream)
+                if last_ids.get(stream):
+                    await room.resume(last_ids[stream])
+
+    async def unsubscribe(self, stream, acknowledge=True):
+        room = self.rooms.pop(stream, None)
+        if room is not None:
+            self.prefixes.pop(room.group, None)
+            self.room_groups.pop(room.group, None)
+            await room.leave()
+        elif stream == 'notifications':
+            group = f'user_{self.user.id}'
+            if self.prefixes.pop(group, None) is not None:
+                await self.channel_layer.group_discard(group, self.channel_name)
+        if acknowledge:
+            await self.send_payload({'type': 'unsubscribed'}, stream)
+
+    @db_to_async
+    def get_conversations(self, conversation_ids):
+        from .models import Conversation
+        return Conversation.objects.in_bulk(conversation_ids)
+
+    def stream_prefix(self, stream):
+        return '{"stream":%s,' % dumps(stream)
+
+    async def send_group_event(self, event):
+        # tag the sender's pre-encoded text with our stream name without re-encoding it
+        prefix = self.prefixes.get(event.get('group'))
+        if prefix is None:
+            return  # unsubscribed while the event was in flight
+        await self.send(text_data=prefix + event_text(event)[1:])
+
+    async def stream_event(self, event):
+        room = self.room_groups.get(event.get('group'))
+        if room is not None:
+            await room.deliver(event)
         else:
-            await self.close(code=4002)
+            await self.send_group_event(event)
+
+    chat_message = stream_event
+    typing = stream_event
+    online_status = stream_event
+    message_persisted = stream_event
+    message_failed = stream_event
+    message_deleted = stream_event
+    read_receipt = stream_event
+    feedback_update = stream_event
+
+
+class NotificationsConsumer(ChatSocketConsumer):
+    """Simple notifications consumer that joins a per-user group named `user_{id}`.
+    Used to push feedback updates (admin responses) to the specific user in real time.
+    """
+
+    async def connect(self):
+        if not await self.authenticate():
             return
 
         self.group_name = f'user_{self.user.id}'
@@ -239,14 +660,5 @@ class NotificationsConsumer(AsyncWebsocketConsumer):
             pass
 
     async def feedback_update(self, event):
-        # event will contain payload keys for the feedback
-        await self.send(text_data=json.dumps({
-            'type': 'feedback_update',
-            'feedback': event.get('feedback')
-        }))
-
-    @sync_to_async
-    def get_user(self, user_id):
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        return User.objects.get(id=user_id)
\ No newline at end of file
+        # event carries the pre-encoded feedback payload
+        await self.send(text_data=event_text(event))
\ No newline at end of file
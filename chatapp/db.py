@@ -0,0 +1,186 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics
+
+_lock = threading.Lock()
+_write_executor = None
+_db_executor = None
+
+
+class DatabaseBusy(Exception):
+    """The database queue is full; the caller should tell the client to retry later."""
+
+    def __init__(self, retry_after):
+        super().__init__('Database is busy')
+        self.retry_after = retry_after
+
+
+def single_writer():
+    return getattr(settings, 'CHAT_DB_SINGLE_WRITER', False)
+
+
+def get_write_executor():
+    """The one thread all async-originated writes run on in the single-writer profile."""
+    global _write_executor
+    with _lock:
+        if _write_executor is None:
+            _write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-db-writer')
+        return _write_executor
+
+
+class DatabaseExecutor:
+    """Bounded thread pool for database work started from consumers.
+
+    At most `max_workers` queries run at once, on threads shared by the whole
+    process, and at most `max_pending` calls per event loop may be queued or
+    running: the limit is a semaphore per loop, so a server running one loop
+    per process (daphne, uvicorn) gets one budget. Past that, callers wait up to
+    `queue_timeout` seconds for a slot and then get DatabaseBusy, so a slow
+    database shows up as latency and explicit retry errors instead of an
+    unbounded pile of coroutines and threads.
+    """
+
+    def __init__(self, max_workers=8, max_pending=256, queue_timeout=1.0):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-db')
+        self._slots = weakref.WeakKeyDictionary()
+
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.pending = 0
+        self.peak_pending = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    async def run(self, fn, write=False, block=False):
+        """Run `fn()` on the pool (or the writer thread for writes) and return its result.
+
+        `block=True` waits for a slot however long it takes; used by the
+        write-behind writer, whose batches must not be dropped.
+        """
+        slots = self._get_slots()
+        if not slots.locked() or block:
+            await slots.acquire()
+        elif self.queue_timeout > 0:
+            try:
+                await asyncio.wait_for(slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject()
+        else:
+            self._reject()
+
+        self.submitted += 1
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        queued = time.perf_counter()
+
+        def call():
+            wait_ms = (time.perf_counter() - queued) * 1000
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            close_old_connections()
+            try:
+                return fn()
+            finally:
+                close_old_connections()
+
+        def done(future):
+            self.pending -= 1
+            slots.release()
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+
+        executor = get_write_executor() if write and single_writer() else self.pool
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(executor, context.run, call)
+        # the slot is held until the query really finishes, even if the caller goes away
+        future.add_done_callback(done)
+        return await asyncio.shield(future)
+
+    def _get_slots(self):
+        loop = asyncio.get_running_loop()
+        slots = self._slots.get(loop)
+        if slots is None:
+            slots = self._slots[loop] = asyncio.Semaphore(self.max_pending)
+        return slots
+
+    def _reject(self):
+        self.rejected += 1
+        raise DatabaseBusy(retry_after=max(self.queue_timeout, 1.0))
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'peak_pending': self.peak_pending,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'avg_wait_ms': round(self.total_wait_ms / self.submitted, 3) if self.submitted else 0.0,
+            'max_wait_ms': round(self.max_wait_ms, 3),
+        }
+
+
+def get_db_executor():
+    global _db_executor
+    with _lock:
+        if _db_executor is None:
+            _db_executor = DatabaseExecutor(
+                max_workers=getattr(settings, 'CHAT_DB_WORKERS', 8),
+                max_pending=getattr(settings, 'CHAT_DB_MAX_PENDING', 256),
+                queue_timeout=getattr(settings, 'CHAT_DB_QUEUE_TIMEOUT', 1.0),
+            )
+        return _db_executor
+
+
+def db_to_async(fn):
+    """Like `sync_to_async`, but on the bounded database pool (raises DatabaseBusy when full)."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await get_db_executor().run(functools.partial(fn, *args, **kwargs))
+    return wrapper
+
+
+def write_to_async(fn, block=False):
+    """`db_to_async` for functions that write to the database.
+
+    SQLite allows one writer at a time; concurrent writers from a thread pool
+    just take turns on the file lock (or fail with "database is locked"). With
+    CHAT_DB_SINGLE_WRITER the writes are queued onto a dedicated thread
+    instead, which keeps its connection open between writes.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await get_db_executor().run(functools.partial(fn, *args, **kwargs), write=True, block=block)
+    return wrapper
+
+
+def _database_stats():
+    from django.db import connection
+    stats = {
+        'vendor': connection.vendor,
+        'conn_max_age': connection.settings_dict.get('CONN_MAX_AGE'),
+        'conn_health_checks': connection.settings_dict.get('CONN_HEALTH_CHECKS'),
+        'single_writer': single_writer(),
+    }
+    if _write_executor is not None:
+        stats['write_queue'] = _write_executor._work_queue.qsize()
+    if _db_executor is not None:
+        stats['executor'] = _db_executor.stats()
+    return stats
+
+
+metrics.register('database', _database_stats)
@@ -0,0 +1,59 @@
+"""JSON encoding for websocket frames.
+
+Group events are encoded once at `group_send` time (`group_event`) and every
+receiving consumer sends the resulting text as-is, instead of rebuilding and
+re-encoding the payload per socket. The encoder is pluggable through
+`CHAT_JSON_ENCODER`: 'json', 'orjson', or 'auto' (orjson when installed).
+"""
+import functools
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj)
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj).decode()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoder(name):
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("CHAT_JSON_ENCODER='orjson' requires the orjson package")
+        return _orjson_dumps
+    return _json_dumps
+
+
+def dumps(obj):
+    return _get_encoder(getattr(settings, 'CHAT_JSON_ENCODER', 'auto'))(obj)
+
+
+def group_event(payload, group=None):
+    """Wrap a client payload into a channel-layer event carrying its pre-encoded text.
+
+    `group` is carried along so multiplexed sockets can tell which stream the event belongs to,
+    and the payload's `id` so sockets replaying history can drop live duplicates without decoding.
+    """
+    event = {'type': payload['type'], 'text': dumps(payload)}
+    if group is not None:
+        event['group'] = group
+    if payload.get('id') is not None:
+        event['id'] = payload['id']
+    return event
+
+
+def event_text(event):
+    """The frame to send for a group event (events from older senders carry no `text`)."""
+    text = event.get('text')
+    if text is None:
+        text = dumps(event)
+    return text
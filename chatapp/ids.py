@@ -0,0 +1,14 @@
+import os
+import time
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+def new_ulid():
+    """Return a new ULID: 48-bit millisecond timestamp + 80 random bits, Crockford base32.
+
+    ULIDs sort by creation time, so the server can hand out message ids before
+    the database has assigned a primary key.
+    """
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), 'big')
+    return ''.join(_CROCKFORD[(value >> shift) & 31] for shift in range(125, -1, -5))
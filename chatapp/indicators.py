@@ -0,0 +1,62 @@
+import asyncio
+import time
+import weakref
+
+from django.conf import settings
+
+
+class TypingCoalescer:
+    """Rate limits and coalesces typing indicators per (group, user).
+
+    A user's keystroke events produce at most one `is_typing: true` broadcast
+    per `window` seconds, no matter how many sockets or frames they send. If no
+    typing frame arrives for `timeout` seconds the user is considered to have
+    stopped and `on_timeout` is called once so a `is_typing: false` can go out.
+    """
+
+    def __init__(self, window=3.0, timeout=5.0):
+        self.window = window
+        self.timeout = timeout
+        self.typing = {}  # (group, user_id) -> [last broadcast time, stop timer]
+
+    def start(self, group, user_id, on_timeout):
+        """Record a typing frame; returns True if a typing broadcast is due."""
+        key = (group, user_id)
+        now = time.monotonic()
+        state = self.typing.get(key)
+        due = state is None or now - state[0] >= self.window
+        if state is None:
+            state = self.typing[key] = [now, None]
+        else:
+            state[1].cancel()
+            if due:
+                state[0] = now
+        state[1] = asyncio.get_running_loop().call_later(self.timeout, self._expire, key, on_timeout)
+        return due
+
+    def stop(self, group, user_id):
+        """Forget the user's typing state; returns True if they were typing."""
+        state = self.typing.pop((group, user_id), None)
+        if state is None:
+            return False
+        state[1].cancel()
+        return True
+
+    def _expire(self, key, on_timeout):
+        if self.typing.pop(key, None) is not None:
+            asyncio.ensure_future(on_timeout())
+
+
+_coalescers = weakref.WeakKeyDictionary()
+
+
+def get_typing_coalescer():
+    """Return the typing coalescer bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    coalescer = _coalescers.get(loop)
+    if coalescer is None:
+        coalescer = _coalescers[loop] = TypingCoalescer(
+            window=getattr(settings, 'CHAT_TYPING_WINDOW', 3.0),
+            timeout=getattr(settings, 'CHAT_TYPING_TIMEOUT', 5.0),
+        )
+    return coalescer
@@ -0,0 +1,177 @@
+import asyncio
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+from . import metrics
+
+
+class LocalChannelLayer(InMemoryChannelLayer):
+    """In-process channel layer for single-node deployments, tests and benchmarks.
+
+    Same semantics as channels' InMemoryChannelLayer, tuned for our fan-out:
+
+    - messages are delivered by reference, not deep-copied per recipient.
+      Every group event here is a pre-encoded `{'type', 'text'}` dict that
+      handlers only read; consumers must not mutate received messages.
+    - `group_send` enqueues directly onto each member's queue instead of
+      spawning a task per recipient, and validates names once at `group_add`.
+    - groups are plain sets with a reverse index of each channel's groups, so
+      dropping a dead channel doesn't scan every group.
+    - per-channel queues are capped at `capacity`; a full (slow) channel
+      misses group messages rather than stalling the sender.
+    - the expiry sweep for channels nobody reads from runs at most every
+      `cleanup_interval` seconds instead of on every send and receive.
+    - the layer is owned by the loop its receivers run on. Sends from other
+      threads (the outbox worker, REST views via `async_to_sync`) run on their
+      own loops; they are handed over to the owning loop, so its queues and
+      groups are only ever touched from that loop and waiting receivers are
+      woken straight away.
+    """
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 cleanup_interval=1.0, **kwargs):
+        super().__init__(expiry=expiry, group_expiry=group_expiry, capacity=capacity,
+                         channel_capacity=channel_capacity, **kwargs)
+        self.memberships = {}  # channel -> {group: joined at}
+        self.cleanup_interval = cleanup_interval
+        self._next_cleanup = 0.0
+        self.delivered = 0
+        self.dropped = 0
+        self.expired = 0
+        self._loop = None
+        metrics.register('channel_layer', self.stats)
+
+    def _queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _owner_loop(self):
+        """The loop receivers wait on, if it is running and isn't the caller's."""
+        loop = self._loop
+        if loop is None or loop.is_closed() or not loop.is_running() or loop is asyncio.get_running_loop():
+            return None
+        return loop
+
+    async def _run_on(self, loop, coroutine):
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+
+    async def send(self, channel, message):
+        loop = self._owner_loop()
+        if loop is not None:
+            return await self._run_on(loop, self.send(channel, message))
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        try:
+            self._queue(channel).put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+        self.delivered += 1
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._loop = asyncio.get_running_loop()
+        self._maybe_clean_expired()
+        queue = self._queue(channel)
+        try:
+            _, message = await queue.get()
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+        return message
+
+    async def group_add(self, group, channel):
+        loop = self._owner_loop()
+        if loop is not None:
+            return await self._run_on(loop, self.group_add(group, channel))
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, set()).add(channel)
+        self.memberships.setdefault(channel, {})[group] = time.time()
+
+    async def group_discard(self, group, channel):
+        loop = self._owner_loop()
+        if loop is not None:
+            return await self._run_on(loop, self.group_discard(group, channel))
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._leave(group, channel)
+
+    async def group_send(self, group, message):
+        loop = self._owner_loop()
+        if loop is not None:
+            return await self._run_on(loop, self.group_send(group, message))
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        self._maybe_clean_expired()
+        members = self.groups.get(group)
+        if not members:
+            return
+        item = (time.time() + self.expiry, message)
+        for channel in members:
+            try:
+                self._queue(channel).put_nowait(item)
+            except asyncio.QueueFull:
+                self.dropped += 1
+            else:
+                self.delivered += 1
+
+    async def flush(self):
+        loop = self._owner_loop()
+        if loop is not None:
+            return await self._run_on(loop, self.flush())
+        await super().flush()
+        self.memberships = {}
+
+    def _leave(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.groups[group]
+        groups = self.memberships.get(channel)
+        if groups is not None:
+            groups.pop(group, None)
+            if not groups:
+                del self.memberships[channel]
+
+    def _remove_from_groups(self, channel):
+        for group in list(self.memberships.get(channel, ())):
+            self._leave(group, channel)
+
+    def _maybe_clean_expired(self):
+        now = time.time()
+        if now >= self._next_cleanup:
+            self._next_cleanup = now + self.cleanup_interval
+            self._clean_expired()
+
+    def _clean_expired(self):
+        now = time.time()
+        # a channel whose oldest message outlived `expiry` has no reader left
+        for channel, queue in list(self.channels.items()):
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+                self.expired += 1
+                self._remove_from_groups(channel)
+                if queue.empty():
+                    self.channels.pop(channel, None)
+
+        cutoff = now - self.group_expiry
+        for channel, groups in list(self.memberships.items()):
+            for group, joined in list(groups.items()):
+                if joined < cutoff:
+                    self._leave(group, channel)
+
+    def stats(self):
+        return {
+            'channels': len(self.memberships),
+            'groups': len(self.groups),
+            'queued': sum(queue.qsize() for queue in self.channels.values()),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'expired': self.expired,
+        }
@@ -0,0 +1,15 @@
+async def lifespan(scope, receive, send):
+    """ASGI lifespan handler: flushes pending write-behind messages on server shutdown.
+
+    For servers with lifespan support (uvicorn, hypercorn); under daphne the
+    writers install a reactor shutdown trigger instead (see chatapp.persistence).
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            from .persistence import close_message_writers
+            await close_message_writers()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
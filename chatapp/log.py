@@ -0,0 +1,118 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import time
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+
+from . import metrics
+
+# attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the record's `extra` fields (conversation_id, user_id, latency_ms, ...)."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueLogHandler(QueueHandler):
+    """Queues records for a background thread that formats and writes them.
+
+    Emitting only puts the record on an in-memory queue, so log calls from the
+    event loop never wait on stream I/O. When the queue is full records are
+    dropped (and counted) rather than blocking the caller. Drops are reported:
+    a warning with the count goes out once the queue has room again (at most
+    every `report_interval` seconds), any still unreported are written when
+    the handler stops, and the total is in the metrics snapshot.
+    """
+
+    def __init__(self, stream=None, maxsize=10000, report_interval=60.0):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self.reported = 0
+        self.report_interval = report_interval
+        self._next_report = 0.0
+        self._stopped = False
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+        atexit.register(self.stop)
+        _handlers.add(self)
+
+    def setFormatter(self, fmt):
+        # formatting happens on the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # records stay in-process, so only freeze the message; exc_info is formatted by the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped > self.reported and time.monotonic() >= self._next_report:
+            dropped = self.dropped
+            try:
+                self.queue.put_nowait(self._dropped_record(dropped))
+            except queue.Full:
+                return
+            self.reported = dropped
+            self._next_report = time.monotonic() + self.report_interval
+
+    def stop(self):
+        """Drain the queue and stop the listener thread, then report drops not reported yet."""
+        if self._stopped:
+            return
+        self._stopped = True
+        # QueueListener.stop puts its sentinel with put_nowait, which fails on a full queue
+        self.queue.join()
+        self.listener.stop()
+        if self.dropped > self.reported:
+            self.target.handle(self._dropped_record(self.dropped))
+            self.reported = self.dropped
+
+    def _dropped_record(self, dropped):
+        return logging.makeLogRecord({
+            'name': __name__,
+            'levelno': logging.WARNING,
+            'levelname': 'WARNING',
+            'msg': 'log queue full, records dropped',
+            'dropped': dropped - self.reported,
+            'dropped_total': dropped,
+        })
+
+
+_handlers = weakref.WeakSet()
+
+
+def _log_stats():
+    handlers = list(_handlers)
+    return {
+        'queue_depth': sum(handler.queue.qsize() for handler in handlers),
+        'dropped': sum(handler.dropped for handler in handlers),
+    }
+
+
+metrics.register('logging', _log_stats)
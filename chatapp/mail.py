@@ -0,0 +1,119 @@
+"""Email outbox: notifications are queued in the request and sent by a background worker.
+
+`queue_mail` stores one `OutboundEmail` row per recipient inside the caller's
+transaction and wakes the worker once it commits, so API latency no longer
+depends on the mail server. `deliver_due_mail` claims a batch of due rows in
+one short transaction, sends them over a single SMTP connection with no
+transaction or row lock held, then records the results and reschedules
+failures with exponential backoff until `CHAT_MAIL_MAX_ATTEMPTS` is reached.
+Sent rows are deleted after `CHAT_MAIL_RETENTION_DAYS`; failed ones are kept
+for someone to look at.
+
+With `CHAT_MAIL_WORKER = 'thread'` (default) every process runs an in-process
+worker thread; with `'command'` delivery is left to `manage.py send_queued_mail`.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutboundEmail
+from .workers import BackgroundWorker, delete_in_batches
+
+logger = logging.getLogger(__name__)
+
+
+def queue_mail(subject, body, recipients, from_email=None):
+    from_email = from_email or getattr(settings, 'DEFAULT_FROM_EMAIL', None) or ''
+    emails = OutboundEmail.objects.bulk_create([
+        OutboundEmail(recipient=recipient, subject=subject[:255], body=body, from_email=from_email)
+        for recipient in dict.fromkeys(recipients) if recipient
+    ])
+    if emails and getattr(settings, 'CHAT_MAIL_WORKER', 'thread') == 'thread':
+        transaction.on_commit(mail_worker.wake)
+    return emails
+
+
+def retry_delay(attempts):
+    base = getattr(settings, 'CHAT_MAIL_RETRY_DELAY', 30)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), 3600))
+
+
+def claim_due_mail(batch_size):
+    """Reserve up to `batch_size` due emails for this worker."""
+    now = timezone.now()
+    with transaction.atomic():
+        due = OutboundEmail.objects.filter(status=OutboundEmail.PENDING, next_attempt_at__lte=now)
+        if connection.features.has_select_for_update_skip_locked:
+            # several workers can poll the same outbox without claiming a row twice
+            due = due.select_for_update(skip_locked=True)
+        emails = list(due.order_by('next_attempt_at')[:batch_size])
+        if emails:
+            # a worker that dies mid-send leaves its claim to expire, and the rows are retried
+            lease = timedelta(seconds=getattr(settings, 'CHAT_MAIL_CLAIM_TIMEOUT', 300))
+            OutboundEmail.objects.filter(id__in=[email.id for email in emails]).update(next_attempt_at=now + lease)
+    return emails
+
+
+def deliver_due_mail(batch_size=50):
+    """Send up to `batch_size` due emails over one connection; returns how many were attempted."""
+    max_attempts = getattr(settings, 'CHAT_MAIL_MAX_ATTEMPTS', 5)
+    emails = claim_due_mail(batch_size)
+    if not emails:
+        return 0
+
+    mail_connection = get_connection(fail_silently=False)
+    try:
+        mail_connection.open()
+    except Exception as e:
+        opened, open_error = False, e
+    else:
+        opened, open_error = True, None
+
+    now = timezone.now()
+    try:
+        for email in emails:
+            email.attempts += 1
+            try:
+                if not opened:
+                    raise open_error
+                EmailMessage(email.subject, email.body, email.from_email or None,
+                             [email.recipient], connection=mail_connection).send()
+            except Exception as e:
+                email.last_error = str(e)
+                if email.attempts >= max_attempts:
+                    email.status = OutboundEmail.FAILED
+                    logger.error('email delivery failed', extra={'email_id': email.id, 'attempts': email.attempts})
+                else:
+                    email.next_attempt_at = now + retry_delay(email.attempts)
+            else:
+                email.status = OutboundEmail.SENT
+                email.sent_at = now
+                email.last_error = ''
+    finally:
+        if opened:
+            mail_connection.close()
+
+    with transaction.atomic():
+        OutboundEmail.objects.bulk_update(emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    return len(emails)
+
+
+def prune_sent_mail(days=None):
+    """Delete emails sent more than `days` (default `CHAT_MAIL_RETENTION_DAYS`) days ago; returns how many."""
+    if days is None:
+        days = getattr(settings, 'CHAT_MAIL_RETENTION_DAYS', 7)
+    cutoff = timezone.now() - timedelta(days=days)
+    return delete_in_batches(OutboundEmail.objects.filter(status=OutboundEmail.SENT, sent_at__lt=cutoff))
+
+
+mail_worker = BackgroundWorker(
+    'chatapp-mail',
+    deliver_due_mail,
+    batch_size=getattr(settings, 'CHAT_MAIL_BATCH_SIZE', 50),
+    poll_interval=getattr(settings, 'CHAT_MAIL_POLL_INTERVAL', 30),
+    prune=prune_sent_mail,
+)
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class WorkerCommand(BaseCommand):
+    """Runs a BackgroundWorker's job once, or with --loop as a dedicated worker process.
+
+    The command does what the worker thread does (see chatapp.workers): it
+    drains the backlog in batches and, for workers that prune, deletes rows
+    they are done with once at start and then every `prune_interval` seconds.
+    Subclasses set `worker`, the default poll `interval` and the `processed` /
+    `pruned` summaries.
+    """
+    worker = None
+    interval = 1.0
+    processed = '{} item(s) processed'
+    pruned = '{} row(s) pruned'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=self.worker.batch_size)
+        parser.add_argument('--loop', action='store_true', help='keep polling instead of exiting once everything is processed')
+        parser.add_argument('--interval', type=float, default=self.interval, help='seconds between polls with --loop')
+        if self.worker.prune is not None:
+            parser.add_argument('--prune-days', type=int, default=None,
+                                help='delete processed rows older than this many days (default: the retention setting)')
+
+    def handle(self, *args, **options):
+        total, next_prune = 0, 0.0
+        while True:
+            if self.worker.prune is not None and time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + self.worker.prune_interval
+                pruned = self.worker.prune(options['prune_days'])
+                if pruned:
+                    self.stdout.write(self.pruned.format(pruned))
+            total += self.worker.drain(options['batch_size'])
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.processed.format(total))
@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+
+from chatapp.benchmarks import throwaway_database
+from chatapp.db import write_to_async
+from chatapp.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = ('Load test message writes from concurrent async clients on a throwaway test database of the '
+            'configured profile (select it with CHAT_DB_ENGINE / CHAT_DB_POOL / CHAT_SQLITE_* before running)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='concurrent writers')
+        parser.add_argument('--messages', type=int, default=40, help='messages per client')
+        parser.add_argument('--executor', choices=('both', 'shared', 'single'), default='both',
+                            help="'shared': asgiref's thread pool, 'single': the dedicated writer thread")
+
+    def handle(self, *args, **options):
+        # thousands of rows from many threads at once: a test database, not a rolled-back transaction
+        with throwaway_database(), override_settings(CHAT_SEARCH_WORKER='command'):
+            self.benchmark(options)
+
+    def benchmark(self, options):
+        settings_dict = connection.settings_dict
+        self.stdout.write(f"{connection.vendor}: CONN_MAX_AGE={settings_dict.get('CONN_MAX_AGE')} "
+                          f"OPTIONS={settings_dict.get('OPTIONS')}")
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                pragmas = {name: cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                           for name in ('journal_mode', 'synchronous', 'mmap_size', 'busy_timeout')}
+            self.stdout.write(f'pragmas: {pragmas}')
+
+        sender, _ = User.objects.get_or_create(username='bench-db-writer')
+        conversation = Conversation.objects.create()
+        conversation.participants.add(sender)
+        connection.close()
+        executors = ('shared', 'single') if options['executor'] == 'both' else (options['executor'],)
+        for executor in executors:
+            with override_settings(CHAT_DB_SINGLE_WRITER=executor == 'single'):
+                to_async = write_to_async if executor == 'single' else self.shared_pool
+                result = asyncio.run(self.run(conversation, sender, to_async,
+                                              options['clients'], options['messages']))
+            self.report(executor, result)
+
+    @staticmethod
+    def shared_pool(fn):
+        return sync_to_async(fn, thread_sensitive=False)
+
+    async def run(self, conversation, sender, to_async, clients, messages):
+        def write(content):
+            return Message.objects.create(conversation=conversation, sender=sender, content=content)
+
+        latencies, errors = [], []
+
+        async def client(n):
+            for i in range(messages):
+                started = time.perf_counter()
+                try:
+                    await to_async(write)(f'{n}:{i}')
+                except OperationalError as e:
+                    errors.append(str(e))
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(n) for n in range(clients)))
+        return time.perf_counter() - started, sorted(latencies), errors
+
+    def report(self, executor, result):
+        elapsed, latencies, errors = result
+        written = len(latencies) - len(errors)
+
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write(
+            f'{executor:>7}: {written / elapsed:8.0f} writes/s  '
+            f'p50 {pct(0.50):7.1f} ms  p95 {pct(0.95):7.1f} ms  p99 {pct(0.99):7.1f} ms  '
+            f'errors {len(errors)}'
+        )
+        if errors:
+            self.stdout.write(f'         first error: {errors[0]}')
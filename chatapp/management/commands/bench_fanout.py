@@ -0,0 +1,93 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from channels.layers import InMemoryChannelLayer
+
+from chatapp.encoding import event_text, group_event
+from chatapp.layers import LocalChannelLayer
+
+
+def legacy_chat_message(event):
+    # what ChatConsumer.chat_message used to do for every receiving socket
+    payload = {
+        'type': 'chat_message',
+        'message': event['message'],
+        'user': event['user'],
+        'timestamp': event['timestamp'],
+    }
+    if event.get('id') is not None:
+        payload['id'] = event['id']
+    if event.get('temp_id') is not None:
+        payload['temp_id'] = event['temp_id']
+    return json.dumps(payload)
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-recipient CPU cost of chat fan-out: per-socket encoding vs pre-encoded group events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--length', type=int, default=200, help='message length in characters')
+
+    def handle(self, *args, **options):
+        recipients, messages = options['recipients'], options['messages']
+        payload = {
+            'type': 'chat_message',
+            'id': 123456,
+            'uid': '01JAAAAAAAAAAAAAAAAAAAAAAA',
+            'message': 'x' * options['length'],
+            'user': {'id': 42, 'username': 'support-agent', 'is_staff': True, 'is_superuser': False},
+            'timestamp': '2025-01-01T12:00:00.000000+00:00',
+            'temp_id': 'tmp-1',
+        }
+
+        def per_recipient():
+            for _ in range(messages):
+                for _ in range(recipients):
+                    legacy_chat_message(payload)
+
+        def pre_encoded():
+            for _ in range(messages):
+                event = group_event(payload)
+                for _ in range(recipients):
+                    event_text(event)
+
+        deliveries = recipients * messages
+        results = {'per_recipient_json': self.measure(per_recipient, deliveries)}
+        for encoder in ('json', 'orjson'):
+            with override_settings(CHAT_JSON_ENCODER=encoder):
+                try:
+                    results[f'pre_encoded_{encoder}'] = self.measure(pre_encoded, deliveries)
+                except ImportError:
+                    self.stdout.write(f'skipping {encoder}: not installed')
+
+        layer_messages = max(1, messages // 10)
+        for name, layer_class in (('inmemory_layer', InMemoryChannelLayer), ('local_layer', LocalChannelLayer)):
+            layer = layer_class(capacity=layer_messages + 1)
+            results[name] = self.measure(lambda: asyncio.run(self.layer_fanout(layer, payload, recipients, layer_messages)),
+                                         recipients * layer_messages)
+
+        self.stdout.write(f'{recipients} recipients x {messages} messages '
+                          f'({layer_messages} through the channel layers, send + receive)')
+        for name, cost in results.items():
+            self.stdout.write(f'{name:>24}: {cost:8.3f} us CPU per recipient')
+
+    async def layer_fanout(self, layer, payload, recipients, messages):
+        channels = [await layer.new_channel() for _ in range(recipients)]
+        for channel in channels:
+            await layer.group_add('chat_1', channel)
+        for _ in range(messages):
+            await layer.group_send('chat_1', group_event(payload))
+        for channel in channels:
+            for _ in range(messages):
+                await layer.receive(channel)
+
+    def measure(self, fn, deliveries):
+        started = time.process_time()
+        fn()
+        return (time.process_time() - started) / deliveries * 1e6
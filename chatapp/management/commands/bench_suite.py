@@ -0,0 +1,87 @@
+import json
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chatapp.benchmarks import LAYERS, BenchmarkSuite, throwaway_database
+
+
+class Command(BaseCommand):
+    help = ('Load and latency benchmarks for the websocket and REST hot paths, run on a throwaway test '
+            'database; prints throughput, p50/p95/p99 and queries per operation, optionally as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--clients', type=int, default=5, help='websocket clients per room')
+        parser.add_argument('--messages', type=int, default=20, help='messages sent per room')
+        parser.add_argument('--requests', type=int, default=50, help='requests per REST operation')
+        parser.add_argument('--history', type=int, default=50,
+                            help='messages seeded per room (and feedback items in total)')
+        parser.add_argument('--layer', choices=sorted(LAYERS), default='local')
+        parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for any one frame')
+        parser.add_argument('--label', default='', help='free-form label stored with the results')
+        parser.add_argument('--output', help="write the results as JSON to this file ('-' for stdout)")
+        parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        suite = BenchmarkSuite(rooms=options['rooms'], clients=options['clients'], messages=options['messages'],
+                               requests=options['requests'], history=options['history'],
+                               layer=options['layer'], timeout=options['timeout'])
+        with throwaway_database():
+            report = suite.run()
+
+        report['environment'] = {
+            'label': options['label'],
+            'commit': self.git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+        }
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['results']
+
+        if options['output'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.print_results(report, baseline)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"results written to {options['output']}")
+
+    def git_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def print_results(self, report, baseline):
+        config = report['config']
+        self.stdout.write(f"{config['rooms']} rooms x {config['clients']} clients, {config['messages']} messages "
+                          f"per room, {config['requests']} requests per REST operation, {config['layer']} layer "
+                          f"({report['environment']['database']}, commit {report['environment']['commit']})")
+        self.stdout.write(f"{'operation':<24}{'count':>7}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+                          f"{'p99 ms':>10}{'queries':>9}")
+        for name, result in report['results'].items():
+            self.stdout.write(f"{name:<24}{result['count']:>7}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}"
+                              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['queries_per_op']:>9.2f}")
+            before = (baseline or {}).get(name)
+            if before:
+                self.stdout.write(f"{'':<24}vs baseline: ops/s {self.change(before['throughput'], result['throughput'])}, "
+                                  f"p95 {self.change(before['p95_ms'], result['p95_ms'])}, "
+                                  f"queries {before['queries_per_op']} -> {result['queries_per_op']}")
+
+    @staticmethod
+    def change(before, after):
+        if not before:
+            return 'n/a'
+        return f'{(after - before) / before * 100:+.1f}%'
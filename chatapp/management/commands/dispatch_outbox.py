@@ -0,0 +1,9 @@
+from chatapp.management.base import WorkerCommand
+from chatapp.outbox import event_dispatcher
+
+
+class Command(WorkerCommand):
+    help = 'Dispatch pending realtime outbox events (use --loop to run as a dedicated worker)'
+    worker = event_dispatcher
+    processed = '{} event(s) processed'
+    pruned = '{} dispatched event(s) pruned'
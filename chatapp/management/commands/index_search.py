@@ -0,0 +1,8 @@
+from chatapp.management.base import WorkerCommand
+from chatapp.search import message_indexer
+
+
+class Command(WorkerCommand):
+    help = 'Add newly sent messages to the search index (use --loop to run as a dedicated worker)'
+    worker = message_indexer
+    processed = '{} message(s) indexed'
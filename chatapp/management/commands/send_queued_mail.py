@@ -0,0 +1,10 @@
+from chatapp.mail import mail_worker
+from chatapp.management.base import WorkerCommand
+
+
+class Command(WorkerCommand):
+    help = 'Deliver queued outbound emails (use --loop to run as a dedicated worker)'
+    worker = mail_worker
+    interval = 5.0
+    processed = '{} email(s) processed'
+    pruned = '{} sent email(s) pruned'
@@ -0,0 +1,16 @@
+"""Tiny in-process metrics registry.
+
+Subsystems register a callable returning a dict of their current counters;
+`snapshot()` collects them all for the staff-only metrics endpoint. Values are
+per worker process.
+"""
+
+_providers = {}
+
+
+def register(name, provider):
+    _providers[name] = provider
+
+
+def snapshot():
+    return {name: provider() for name, provider in sorted(_providers.items())}
@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-18 04:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0002_feedback"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["conversation", "timestamp", "id"],
+                name="message_conv_ts_id_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0 on 2026-10-18 04:40
+
+from django.db import migrations, models
+
+import chatapp.ids
+
+
+def populate_uids(apps, schema_editor):
+    Message = apps.get_model("chatapp", "Message")
+    messages = list(Message.objects.filter(uid__isnull=True).only("id"))
+    for message in messages:
+        message.uid = chatapp.ids.new_ulid()
+    Message.objects.bulk_update(messages, ["uid"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0003_message_keyset_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="uid",
+            field=models.CharField(editable=False, max_length=26, null=True),
+        ),
+        migrations.RunPython(populate_uids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="message",
+            name="uid",
+            field=models.CharField(
+                default=chatapp.ids.new_ulid,
+                editable=False,
+                max_length=26,
+                unique=True,
+            ),
+        ),
+    ]
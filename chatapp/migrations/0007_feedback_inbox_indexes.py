@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-18 04:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0006_outboxevent"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="feedback",
+            index=models.Index(fields=["created_at"], name="feedback_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="feedback",
+            index=models.Index(
+                fields=["status", "created_at"], name="feedback_status_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="feedback",
+            index=models.Index(
+                fields=["type", "created_at"], name="feedback_type_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="feedback",
+            index=models.Index(
+                fields=["user", "created_at"], name="feedback_user_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 6.0 on 2026-10-18 04:46
+
+from django.db import migrations
+
+# rowid = id * 2 for messages and id * 2 + 1 for feedback (see chatapp.search)
+
+SQLITE_CREATE = [
+    """
+    CREATE VIRTUAL TABLE chatapp_search USING fts5(
+        body,
+        kind UNINDEXED,
+        conversation_id UNINDEXED,
+        owner_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    INSERT INTO chatapp_search (rowid, body, kind, conversation_id, owner_id)
+    SELECT id * 2, content, 'message', conversation_id, sender_id FROM chatapp_message
+    """,
+    """
+    INSERT INTO chatapp_search (rowid, body, kind, conversation_id, owner_id)
+    SELECT id * 2 + 1, subject || ' ' || message || ' ' || name || ' ' || email, 'feedback', NULL, user_id
+    FROM chatapp_feedback
+    """,
+]
+
+POSTGRES_CREATE = [
+    """
+    CREATE TABLE chatapp_search (
+        rowid bigint PRIMARY KEY,
+        body text NOT NULL,
+        kind varchar(16) NOT NULL,
+        conversation_id bigint NULL,
+        owner_id bigint NULL,
+        document tsvector GENERATED ALWAYS AS (to_tsvector('simple', body)) STORED
+    )
+    """,
+    "CREATE INDEX chatapp_search_document_idx ON chatapp_search USING GIN (document)",
+    """
+    INSERT INTO chatapp_search (rowid, body, kind, conversation_id, owner_id)
+    SELECT id * 2, content, 'message', conversation_id, sender_id FROM chatapp_message
+    """,
+    """
+    INSERT INTO chatapp_search (rowid, body, kind, conversation_id, owner_id)
+    SELECT id * 2 + 1, concat_ws(' ', subject, message, name, email), 'feedback', NULL, user_id
+    FROM chatapp_feedback
+    """,
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {"sqlite": SQLITE_CREATE, "postgresql": POSTGRES_CREATE}.get(vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ("sqlite", "postgresql"):
+        schema_editor.execute("DROP TABLE IF EXISTS chatapp_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0007_feedback_inbox_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
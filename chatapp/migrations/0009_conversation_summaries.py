@@ -0,0 +1,109 @@
+# Generated by Django 6.0 on 2026-10-18 04:45
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_summaries(apps, schema_editor):
+    Conversation = apps.get_model("chatapp", "Conversation")
+    Message = apps.get_model("chatapp", "Message")
+    ConversationReadState = apps.get_model("chatapp", "ConversationReadState")
+    for conversation in Conversation.objects.all().iterator():
+        last = (
+            Message.objects.filter(conversation=conversation)
+            .order_by("-timestamp", "-id")
+            .first()
+        )
+        conversation.last_message = last
+        conversation.last_activity_at = last.timestamp if last else conversation.created_at
+        conversation.save(update_fields=["last_message", "last_activity_at"])
+        # existing history counts as read
+        ConversationReadState.objects.bulk_create(
+            [
+                ConversationReadState(
+                    conversation=conversation,
+                    user_id=user_id,
+                    last_read_id=last.id if last else 0,
+                )
+                for user_id in conversation.participants.values_list("id", flat=True)
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0008_search_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ConversationReadState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_read_id", models.PositiveBigIntegerField(default=0)),
+                ("unread_count", models.PositiveIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="last_activity_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="last_message",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="chatapp.message",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="conversation",
+            index=models.Index(
+                fields=["-last_activity_at"], name="conversation_activity_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="conversationreadstate",
+            name="conversation",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="read_states",
+                to="chatapp.conversation",
+            ),
+        ),
+        migrations.AddField(
+            model_name="conversationreadstate",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="read_states",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="conversationreadstate",
+            constraint=models.UniqueConstraint(
+                fields=("conversation", "user"),
+                name="read_state_conversation_user_uniq",
+            ),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-18 05:10
+
+from django.db import migrations, models
+
+
+def populate_participant_keys(apps, schema_editor):
+    Conversation = apps.get_model("chatapp", "Conversation")
+    seen = set()
+    # oldest conversation wins; any pre-existing duplicates are left without a key
+    for conversation in Conversation.objects.order_by("id").prefetch_related("participants"):
+        ids = sorted(user.id for user in conversation.participants.all())
+        if len(ids) != 2:
+            continue
+        key = f"{ids[0]}:{ids[1]}"
+        if key in seen:
+            continue
+        seen.add(key)
+        conversation.participant_key = key
+        conversation.save(update_fields=["participant_key"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0009_conversation_summaries"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="participant_key",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True, unique=True
+            ),
+        ),
+        migrations.RunPython(populate_participant_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 6.0 on 2026-10-18 05:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_changes(apps, schema_editor):
+    Conversation = apps.get_model("chatapp", "Conversation")
+    Message = apps.get_model("chatapp", "Message")
+    MessageChange = apps.get_model("chatapp", "MessageChange")
+    for conversation in Conversation.objects.all().iterator():
+        message_ids = (
+            Message.objects.filter(conversation=conversation)
+            .order_by("timestamp", "id")
+            .values_list("id", flat=True)
+        )
+        MessageChange.objects.bulk_create(
+            [
+                MessageChange(
+                    conversation=conversation,
+                    version=version,
+                    message_id=message_id,
+                    kind="created",
+                )
+                for version, message_id in enumerate(message_ids, start=1)
+            ],
+            batch_size=500,
+        )
+        conversation.version = len(message_ids)
+        conversation.save(update_fields=["version"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0010_conversation_participant_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="version",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="MessageChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.PositiveBigIntegerField()),
+                ("message_id", models.PositiveBigIntegerField()),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("created", "Created"), ("deleted", "Deleted")],
+                        max_length=10,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "conversation",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="changes",
+                        to="chatapp.conversation",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("conversation", "version"),
+                        name="message_change_version_uniq",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(backfill_changes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 05:14
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0011_message_changes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxevent",
+            name="next_attempt_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name="outboxevent",
+            index=models.Index(
+                condition=models.Q(("status", "pending")),
+                fields=["group", "id"],
+                name="outbox_event_pending_group_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 6.0 on 2026-10-18 05:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatapp", "0012_outbox_event_backoff"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # existing messages were indexed by the old post_save receiver
+        migrations.AddField(
+            model_name="message",
+            name="search_indexed",
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="search_indexed",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                condition=models.Q(("search_indexed", False)),
+                fields=["id"],
+                name="message_search_pending_idx",
+            ),
+        ),
+    ]
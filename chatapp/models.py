@@ -1,38 +1,111 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models import Prefetch
+from django.utils import timezone
+
+from .ids import new_ulid
 
 
 
 class ConversationManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().prefetch_related(
-            Prefetch('participants', queryset=User.objects.only('id', 'username'))
+            Prefetch('participants', queryset=User.objects.only('id', 'username', 'is_staff', 'is_superuser'))
         )
 
 
 class Conversation(models.Model):
     participants = models.ManyToManyField(User, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
+    # denormalized inbox summary, maintained by services.record_new_messages and the Message delete signal
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # canonical "<low id>:<high id>" key for one-to-one conversations; the unique index makes
+    # a second conversation between the same two users impossible
+    participant_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+    # version of the newest entry in the conversation's change log (MessageChange)
+    version = models.PositiveBigIntegerField(default=0)
     objects = ConversationManager()
 
+    @staticmethod
+    def pair_key(user_id, other_id):
+        low, high = sorted((int(user_id), int(other_id)))
+        return f'{low}:{high}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity_at'], name='conversation_activity_idx'),
+        ]
+
 
     def __str__(self):
         participant_names = " ,".join([user.username for user in self.participants.all()])
         return f'Conversation with {participant_names}'
 
 
+class ConversationReadState(models.Model):
+    """Per-participant read receipt and unread counter for a conversation."""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    # id of the newest message the user has read; a watermark rather than a FK so deletes don't reset it
+    last_read_id = models.PositiveBigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='read_state_conversation_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} read {self.conversation_id} up to {self.last_read_id}'
+
+
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # server-assigned id known before the row is written (see broadcast-before-persist)
+    uid = models.CharField(max_length=26, unique=True, default=new_ulid, editable=False)
+    # new messages are added to the search index in batches, off the write path (see chatapp.search)
+    search_indexed = models.BooleanField(default=False, editable=False)
+
+    class Meta:
+        indexes = [
+            # backs keyset pagination of a conversation's history
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conv_ts_id_idx'),
+            models.Index(fields=['id'], condition=models.Q(search_indexed=False), name='message_search_pending_idx'),
+        ]
 
 
     def __str__(self):
         return f'Message from {self.sender.username} in {self.content[:20]}'
 
 
+class MessageChange(models.Model):
+    """Append-only, per-conversation log of message changes; deletes leave a tombstone here."""
+    CREATED = 'created'
+    DELETED = 'deleted'
+    KIND_CHOICES = [
+        (CREATED, 'Created'),
+        (DELETED, 'Deleted'),
+    ]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='changes')
+    version = models.PositiveBigIntegerField()
+    # not a FK: the tombstone outlives the message
+    message_id = models.PositiveBigIntegerField()
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # also the index behind `changes?since=<version>`
+            models.UniqueConstraint(fields=['conversation', 'version'], name='message_change_version_uniq'),
+        ]
+
+
 class Feedback(models.Model):
     FEEDBACK = 'feedback'
     COMPLAINT = 'complaint'
@@ -63,5 +136,82 @@ class Feedback(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # the inbox is always newest-first, optionally narrowed by status, type or owner
+            models.Index(fields=['created_at'], name='feedback_created_idx'),
+            models.Index(fields=['status', 'created_at'], name='feedback_status_created_idx'),
+            models.Index(fields=['type', 'created_at'], name='feedback_type_created_idx'),
+            models.Index(fields=['user', 'created_at'], name='feedback_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} ({self.get_type_display()}) - {self.get_status_display()}"
+
+class OutboundEmail(models.Model):
+    """Outbox row for one email to one recipient, delivered by the background mail worker."""
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the worker polls for due pending rows
+            models.Index(fields=['status', 'next_attempt_at'], name='outbound_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.recipient} ({self.get_status_display()})"
+
+
+class OutboxEvent(models.Model):
+    """Realtime event written in the same transaction as the change it announces.
+
+    The event dispatcher sends pending rows to their channel-layer group after commit.
+    Rows that fail, and rows claimed by a dispatcher that is still sending, wait
+    until `next_attempt_at`; later events for the same group wait behind them.
+    """
+    PENDING = 'pending'
+    DISPATCHED = 'dispatched'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (DISPATCHED, 'Dispatched'),
+        (FAILED, 'Failed'),
+    ]
+
+    group = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the dispatcher only ever scans pending rows, in insertion order
+            models.Index(fields=['id'], condition=models.Q(status='pending'), name='outbox_event_pending_idx'),
+            # "is an earlier event for this group still waiting?"
+            models.Index(fields=['group', 'id'], condition=models.Q(status='pending'), name='outbox_event_pending_group_idx'),
+        ]
+
     def __str__(self):
-        return f"{self.subject} ({self.get_type_display()}) - {self.get_status_display()}"
\ No newline at end of file
+        return f"{self.payload.get('type')} -> {self.group} ({self.get_status_display()})"
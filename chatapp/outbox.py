@@ -0,0 +1,130 @@
+"""Transactional outbox for realtime notifications.
+
+`publish` writes an `OutboxEvent` in the caller's transaction, so a
+notification exists if and only if the change it announces was committed,
+and wakes the dispatcher once the transaction commits. `dispatch_pending_events`
+claims a batch of due events in one short transaction, sends them to the
+channel layer in one event-loop pass with no transaction open, and records
+the outcome in a second one. Groups are sent to concurrently while events for
+the same group keep their order: a group stops at its first failure, and
+later events for it wait behind the failed one. Failed events are retried with
+exponential backoff until `CHAT_OUTBOX_MAX_ATTEMPTS` is reached.
+Dispatched events are deleted after `CHAT_OUTBOX_RETENTION_DAYS`.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .encoding import group_event
+from .models import OutboxEvent
+from .workers import BackgroundWorker, delete_in_batches
+
+logger = logging.getLogger(__name__)
+
+
+def publish(group, payload):
+    event = OutboxEvent.objects.create(group=group, payload=payload)
+    if getattr(settings, 'CHAT_OUTBOX_WORKER', 'thread') == 'thread':
+        transaction.on_commit(event_dispatcher.wake)
+    return event
+
+
+async def _send_group(channel_layer, events):
+    """Send one group's events in order; returns ({event id: error}, ids of the events sent)."""
+    for n, event in enumerate(events):
+        try:
+            await channel_layer.group_send(event.group, group_event(event.payload, event.group))
+        except Exception as e:
+            # the rest of the group waits, so the failed event can't be overtaken
+            return {event.id: e}, {sent.id for sent in events[:n]}
+    return {}, {event.id for event in events}
+
+
+async def _send_all(events):
+    channel_layer = get_channel_layer()
+    by_group = {}
+    for event in events:
+        by_group.setdefault(event.group, []).append(event)
+    results = await asyncio.gather(*(_send_group(channel_layer, group) for group in by_group.values()))
+    errors, sent = {}, set()
+    for group_errors, group_sent in results:
+        errors.update(group_errors)
+        sent |= group_sent
+    return errors, sent
+
+
+def retry_delay(attempts):
+    base = getattr(settings, 'CHAT_OUTBOX_RETRY_DELAY', 5)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), 300))
+
+
+def claim_due_events(batch_size):
+    """Reserve up to `batch_size` due events for this dispatcher, oldest first."""
+    now = timezone.now()
+    pending = OutboxEvent.objects.filter(status=OutboxEvent.PENDING)
+    waiting = pending.filter(group=OuterRef('group'), id__lt=OuterRef('id'), next_attempt_at__gt=now)
+    with transaction.atomic():
+        due = pending.filter(next_attempt_at__lte=now).exclude(Exists(waiting))
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        events = list(due.order_by('id')[:batch_size])
+        if events:
+            # a dispatcher that dies mid-send leaves its claim to expire, and the events are retried
+            lease = timedelta(seconds=getattr(settings, 'CHAT_OUTBOX_CLAIM_TIMEOUT', 60))
+            OutboxEvent.objects.filter(id__in=[event.id for event in events]).update(next_attempt_at=now + lease)
+    return events
+
+
+def dispatch_pending_events(batch_size=100):
+    """Send up to `batch_size` due events; returns how many were claimed."""
+    max_attempts = getattr(settings, 'CHAT_OUTBOX_MAX_ATTEMPTS', 5)
+    events = claim_due_events(batch_size)
+    if not events:
+        return 0
+
+    errors, sent = async_to_sync(_send_all)(events)
+    now = timezone.now()
+    for event in events:
+        error = errors.get(event.id)
+        if event.id in sent:
+            event.attempts += 1
+            event.status = OutboxEvent.DISPATCHED
+            event.dispatched_at = now
+        elif error is not None:
+            event.attempts += 1
+            event.last_error = str(error)
+            if event.attempts >= max_attempts:
+                event.status = OutboxEvent.FAILED
+                logger.error('outbox event dispatch failed', extra={'event_id': event.id, 'group': event.group})
+            else:
+                event.next_attempt_at = now + retry_delay(event.attempts)
+        else:
+            # not attempted: queued behind a failure in its group; release the claim
+            event.next_attempt_at = now
+    with transaction.atomic():
+        OutboxEvent.objects.bulk_update(events, ['status', 'attempts', 'next_attempt_at', 'last_error', 'dispatched_at'])
+    return len(events)
+
+
+def prune_dispatched_events(days=None):
+    """Delete events dispatched more than `days` (default `CHAT_OUTBOX_RETENTION_DAYS`) days ago; returns how many."""
+    if days is None:
+        days = getattr(settings, 'CHAT_OUTBOX_RETENTION_DAYS', 7)
+    cutoff = timezone.now() - timedelta(days=days)
+    return delete_in_batches(OutboxEvent.objects.filter(status=OutboxEvent.DISPATCHED, dispatched_at__lt=cutoff))
+
+
+event_dispatcher = BackgroundWorker(
+    'chatapp-outbox',
+    dispatch_pending_events,
+    batch_size=getattr(settings, 'CHAT_OUTBOX_BATCH_SIZE', 100),
+    poll_interval=getattr(settings, 'CHAT_OUTBOX_POLL_INTERVAL', 5),
+    prune=prune_dispatched_events,
+)
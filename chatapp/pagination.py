@@ -0,0 +1,115 @@
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageKeysetPagination(BasePagination):
+    """Keyset (cursor) pagination over a conversation's messages.
+
+    Messages are ordered by ``(timestamp, id)`` which is backed by the
+    ``(conversation, timestamp, id)`` index, so every page is a bounded index
+    range scan no matter how long the conversation is.
+
+    - ``?before=<id>&limit=N`` -> the N messages immediately older than ``id``
+    - ``?after=<id>&limit=N``  -> the N messages immediately newer than ``id``
+    - no cursor               -> the newest N messages
+
+    Pages are always returned oldest-first so clients can prepend/append them as-is.
+    """
+    default_limit = 50
+    max_limit = 200
+    limit_query_param = 'limit'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        before = self.get_cursor(request, self.before_query_param)
+        after = self.get_cursor(request, self.after_query_param)
+        if before is not None and after is not None:
+            raise ValidationError({'error': 'Use either `before` or `after`, not both'})
+
+        if after is not None:
+            queryset = queryset.filter(self.newer_than(queryset, after))
+            page = list(queryset.order_by('timestamp', 'id')[:self.limit + 1])
+            self.has_newer = len(page) > self.limit
+            self.has_older = True
+            page = page[:self.limit]
+        else:
+            if before is not None:
+                queryset = queryset.filter(self.older_than(queryset, before))
+            page = list(queryset.order_by('-timestamp', '-id')[:self.limit + 1])
+            self.has_older = len(page) > self.limit
+            self.has_newer = before is not None
+            page = page[:self.limit]
+            page.reverse()
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'previous': self.get_previous_link(),
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, self.default_limit))
+        except (TypeError, ValueError):
+            return self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    def get_cursor(self, request, param):
+        value = request.query_params.get(param)
+        if value in (None, ''):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({param: 'Must be a message id'})
+
+    def get_anchor(self, queryset, message_id):
+        # the cursor message may have been deleted since the client saw it; fall back to the id alone
+        return queryset.filter(pk=message_id).values_list('timestamp', flat=True).first()
+
+    def older_than(self, queryset, message_id):
+        timestamp = self.get_anchor(queryset, message_id)
+        if timestamp is None:
+            return Q(id__lt=message_id)
+        # the redundant bound gives the index a range to seek into; the OR alone only matches the conversation
+        return Q(timestamp__lte=timestamp) & (Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+
+    def newer_than(self, queryset, message_id):
+        timestamp = self.get_anchor(queryset, message_id)
+        if timestamp is None:
+            return Q(id__gt=message_id)
+        return Q(timestamp__gte=timestamp) & (Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id))
+
+    def get_previous_link(self):
+        if not self.has_older or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.after_query_param)
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.before_query_param, self.page[0].id)
+
+    def get_next_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.after_query_param, self.page[-1].id)
+
+
+class FeedbackCursorPagination(CursorPagination):
+    """Newest-first cursor pagination for the feedback inbox (backed by the `*_created_at` indexes)."""
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    page_size_query_param = 'limit'
+    max_page_size = 200
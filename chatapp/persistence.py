@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import sys
+import time
+import weakref
+
+from django.conf import settings
+from django.db import DatabaseError, connections, router, transaction
+
+from . import metrics
+from .db import DatabaseBusy, write_to_async
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Write-behind persistence for chat messages sent over websockets.
+
+    Messages submitted by consumers are queued and written with a single
+    `bulk_create` once `batch_size` messages are pending or `flush_interval`
+    seconds after the first one was queued, whichever comes first. `submit`
+    resolves with the saved Message (with its real id) once its batch is written,
+    so consumers can still ack the client. One writer exists per event loop.
+
+    At most `max_pending` messages wait to be written. Past that, `submit`
+    waits up to `queue_timeout` seconds for room and then raises DatabaseBusy,
+    the same backpressure the database executor applies to direct writes.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.01, max_pending=1000, queue_timeout=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self._full = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    async def submit(self, message):
+        """Queue an unsaved Message and wait until it has been written."""
+        if self._closed:
+            raise RuntimeError('Message writer is closed')
+        future = asyncio.get_running_loop().create_future()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        try:
+            self.queue.put_nowait((message, future))
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put((message, future)), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise DatabaseBusy(retry_after=max(self.queue_timeout, 1.0)) from None
+        if self.queue.qsize() >= self.batch_size - 1:
+            self._full.set()
+        # a disconnecting client must not cancel the write of a message it already sent
+        return await asyncio.shield(future)
+
+    async def close(self):
+        """Flush everything still queued and stop the writer."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            self._full.set()
+            await self.queue.put(None)
+            await self._task
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if self.queue.qsize() < self.batch_size - 1:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+
+            batch = [item]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        messages = [message for message, _ in batch]
+        try:
+            errors = await write_to_async(self._write, block=True)(messages)
+        except Exception as e:
+            errors = [e] * len(batch)
+        for (message, future), error in zip(batch, errors):
+            if error is None:
+                self.written += 1
+                if not future.done():
+                    future.set_result(message)
+            else:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(error)
+
+        elapsed = (time.perf_counter() - started) * 1000
+        self.batches += 1
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        self.total_flush_ms += elapsed
+
+    def _write(self, messages):
+        """Write a batch; returns one error (or None) per message.
+
+        If the batch insert fails, the messages are written one at a time so a
+        single bad row fails on its own instead of taking the batch with it.
+        """
+        from .models import Message
+        using = router.db_for_write(Message)
+        try:
+            self._write_batch(messages, using)
+            return [None] * len(messages)
+        except DatabaseError:
+            if len(messages) == 1:
+                raise
+            logger.warning('write-behind batch failed, retrying one message at a time',
+                           extra={'batch_size': len(messages)}, exc_info=True)
+
+        from .services import record_new_messages
+        errors = []
+        for message in messages:
+            # the failed batch may have assigned ids before it rolled back
+            message.pk = None
+            message._state.adding = True
+            message._ingest = True
+            try:
+                with transaction.atomic(using=using):
+                    message.save(using=using)
+                    record_new_messages([message], using=using)
+            except DatabaseError as e:
+                logger.error('write-behind message could not be saved',
+                             extra={'conversation_id': message.conversation_id, 'uid': message.uid}, exc_info=True)
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    def _write_batch(self, messages, using):
+        from .models import Message
+        from .services import record_new_messages
+        with transaction.atomic(using=using):
+            if connections[using].features.can_return_rows_from_bulk_insert:
+                Message.objects.using(using).bulk_create(messages)
+            else:
+                # backends that can't return ids from a bulk insert fall back to one insert per message
+                for message in messages:
+                    message._ingest = True
+                    message.save(using=using)
+            record_new_messages(messages, using=using)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_pending': self.max_pending,
+            'batches': self.batches,
+            'messages_written': self.written,
+            'messages_failed': self.failed,
+            'messages_rejected': self.rejected,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'avg_flush_ms': round(self.total_flush_ms / self.batches, 3) if self.batches else 0.0,
+            'max_flush_ms': round(self.max_flush_ms, 3),
+        }
+
+
+_writers = weakref.WeakKeyDictionary()
+_shutdown_hook_installed = False
+
+
+def get_message_writer():
+    """Return the write-behind writer bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter(
+            batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100),
+            flush_interval=getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.01),
+            max_pending=getattr(settings, 'CHAT_WRITE_BEHIND_MAX_PENDING', 1000),
+            queue_timeout=getattr(settings, 'CHAT_DB_QUEUE_TIMEOUT', 1.0),
+        )
+        install_shutdown_flush(loop)
+    return writer
+
+
+async def close_message_writers():
+    for writer in list(_writers.values()):
+        await writer.close()
+
+
+def install_shutdown_flush(loop):
+    """Flush queued messages when the server stops.
+
+    Servers that speak ASGI lifespan call `close_message_writers` from
+    chatapp.lifespan, but daphne never sends lifespan events. It runs on
+    Twisted's asyncio reactor, which waits for the Deferreds returned by
+    "before shutdown" triggers (daphne cancels its application instances the
+    same way), so the writers are drained from one of those while the loop and
+    the database threads are still up. Consumers cancelled at shutdown don't
+    take their queued writes with them: `submit` shields them.
+    """
+    global _shutdown_hook_installed
+    reactor = sys.modules.get('twisted.internet.reactor')
+    if reactor is None or _shutdown_hook_installed:
+        return
+    _shutdown_hook_installed = True
+    reactor.addSystemEventTrigger('before', 'shutdown', flush_before_shutdown, loop)
+
+
+def flush_before_shutdown(loop):
+    from twisted.internet.defer import Deferred
+    writer = _writers.get(loop)
+    if writer is None:
+        return None
+    return Deferred.fromFuture(loop.create_task(writer.close()))
+
+
+def _writer_stats():
+    stats = [writer.stats() for writer in list(_writers.values())]
+    return {
+        'enabled': getattr(settings, 'CHAT_WRITE_BEHIND', False),
+        'queue_depth': sum(s['queue_depth'] for s in stats),
+        'batches': sum(s['batches'] for s in stats),
+        'messages_written': sum(s['messages_written'] for s in stats),
+        'messages_failed': sum(s['messages_failed'] for s in stats),
+        'messages_rejected': sum(s['messages_rejected'] for s in stats),
+        'last_flush_ms': max((s['last_flush_ms'] for s in stats), default=0.0),
+        'max_flush_ms': max((s['max_flush_ms'] for s in stats), default=0.0),
+    }
+
+
+metrics.register('message_writer', _writer_stats)
@@ -0,0 +1,149 @@
+import asyncio
+import time
+import weakref
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .encoding import group_event
+
+
+class PresenceRegistry:
+    """Tracks which users are connected to which chat group.
+
+    A user is online in a group while at least one of their sockets is joined.
+    Sockets that send `heartbeat` frames opt into expiry: if they go silent for
+    longer than `ttl` seconds they are dropped even if `disconnect` never ran.
+
+    Status changes are not broadcast immediately. They are collected per group
+    and flushed every `flush_interval` seconds as at most one `online_status`
+    event per status (`online_users` holding every user that changed), and a user
+    who drops and reconnects within the window produces no event at all.
+    Joining sockets get a full snapshot instead of waiting for others to announce.
+
+    This store lives in the worker process; deployments running several workers
+    need a shared (e.g. Redis) implementation of the same interface.
+    """
+
+    def __init__(self, ttl=60, flush_interval=0.25):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.groups = {}      # group -> {user_id: {'user': user_data, 'channels': {channel_name: last_heartbeat}}}
+        self.published = {}   # group -> user ids last announced as online
+        self.dirty = {}       # group -> {user_id: user_data} changed since the last flush
+        self._task = None
+
+    def join(self, group, user_data, channel_name):
+        """Register a socket and return the snapshot of users online in `group`."""
+        users = self.groups.setdefault(group, {})
+        entry = users.setdefault(user_data['id'], {'user': user_data, 'channels': {}})
+        entry['channels'][channel_name] = None
+        self._mark(group, user_data)
+        return [entry['user'] for entry in users.values()]
+
+    def leave(self, group, user_id, channel_name):
+        users = self.groups.get(group, {})
+        entry = users.get(user_id)
+        if entry is None or channel_name not in entry['channels']:
+            return
+        del entry['channels'][channel_name]
+        if not entry['channels']:
+            del users[user_id]
+            if not users:
+                del self.groups[group]
+        self._mark(group, entry['user'])
+
+    def heartbeat(self, group, user_id, channel_name):
+        entry = self.groups.get(group, {}).get(user_id)
+        if entry is not None and channel_name in entry['channels']:
+            entry['channels'][channel_name] = time.monotonic()
+            self._schedule()
+
+    def expire(self):
+        if not self.ttl:
+            return
+        deadline = time.monotonic() - self.ttl
+        for group, users in list(self.groups.items()):
+            for user_id, entry in list(users.items()):
+                for channel_name, last_heartbeat in list(entry['channels'].items()):
+                    if last_heartbeat is not None and last_heartbeat < deadline:
+                        self.leave(group, user_id, channel_name)
+
+    async def flush(self):
+        dirty, self.dirty = self.dirty, {}
+        channel_layer = get_channel_layer()
+        for group, changed in dirty.items():
+            online_now = self.groups.get(group, {})
+            published = self.published.setdefault(group, set())
+            online, offline = [], []
+            for user_id, user_data in changed.items():
+                if user_id in online_now and user_id not in published:
+                    published.add(user_id)
+                    online.append(user_data)
+                elif user_id not in online_now and user_id in published:
+                    published.discard(user_id)
+                    offline.append(user_data)
+            if not published:
+                del self.published[group]
+
+            for status, users in (('online', online), ('offline', offline)):
+                if users:
+                    await channel_layer.group_send(group, group_event({
+                        'type': 'online_status',
+                        'online_users': users,
+                        'status': status,
+                    }, group))
+
+    def _mark(self, group, user_data):
+        self.dirty.setdefault(group, {})[user_data['id']] = user_data
+        self._schedule()
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def _has_heartbeats(self):
+        return any(
+            last_heartbeat is not None
+            for users in self.groups.values()
+            for entry in users.values()
+            for last_heartbeat in entry['channels'].values()
+        )
+
+    async def _run(self):
+        while self.dirty or (self.ttl and self._has_heartbeats()):
+            await asyncio.sleep(self.flush_interval)
+            self.expire()
+            await self.flush()
+
+    def stats(self):
+        return {
+            'groups': len(self.groups),
+            'users': sum(len(users) for users in self.groups.values()),
+            'connections': sum(len(entry['channels']) for users in self.groups.values() for entry in users.values()),
+            'pending_changes': sum(len(changed) for changed in self.dirty.values()),
+        }
+
+
+_registries = weakref.WeakKeyDictionary()
+
+
+def get_presence_registry():
+    """Return the presence registry bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    registry = _registries.get(loop)
+    if registry is None:
+        registry = _registries[loop] = PresenceRegistry(
+            ttl=getattr(settings, 'CHAT_PRESENCE_TTL', 60),
+            flush_interval=getattr(settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 0.25),
+        )
+    return registry
+
+
+def _presence_stats():
+    stats = [registry.stats() for registry in list(_registries.values())]
+    return {key: sum(s[key] for s in stats) for key in ('groups', 'users', 'connections', 'pending_changes')}
+
+
+metrics.register('presence', _presence_stats)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+import weakref
+
+from django.conf import settings
+
+from . import metrics
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now, cost=1):
+        """Take `cost` tokens; returns 0 if allowed, else the seconds until it would be."""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens >= cost:
+            self.tokens = tokens - cost
+            return 0.0
+        self.tokens = tokens
+        return (cost - tokens) / self.rate
+
+    def refund(self, cost=1):
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+    def idle(self, now):
+        # a bucket that has refilled completely is indistinguishable from a new one
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    """Per-connection and per-user token buckets for chat frames.
+
+    Connection buckets live on the consumer; user buckets are shared by all of a
+    user's sockets in this process, so opening more tabs doesn't buy more
+    throughput. Idle user buckets are pruned as the table grows. `clock`
+    returns the current time in seconds (tests pass a fake one).
+    """
+
+    def __init__(self, connection_rate=5.0, connection_burst=10, user_rate=10.0, user_burst=20, clock=time.monotonic):
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.clock = clock
+        self.users = {}
+        self._prune_at = 1024
+
+    def connection_bucket(self):
+        return TokenBucket(self.connection_rate, self.connection_burst, self.clock())
+
+    def take(self, connection_bucket, user_id):
+        """Charge one frame to the connection and the user; returns 0 or a retry-after in seconds."""
+        now = self.clock()
+        wait = connection_bucket.take(now)
+        if wait:
+            return wait
+        bucket = self.users.get(user_id)
+        if bucket is None:
+            if len(self.users) >= self._prune_at:
+                self._prune(now)
+            bucket = self.users[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+        wait = bucket.take(now)
+        if wait:
+            # the frame is rejected, so it shouldn't count against the connection either
+            connection_bucket.refund()
+        return wait
+
+    def _prune(self, now):
+        self.users = {user_id: bucket for user_id, bucket in self.users.items() if not bucket.idle(now)}
+        self._prune_at = max(1024, len(self.users) * 2)
+
+
+stats = {'throttled_messages': 0, 'throttled_resumes': 0, 'throttled_typing': 0, 'oversized': 0}
+
+_limiters = weakref.WeakKeyDictionary()
+
+
+def get_rate_limiter():
+    """Return the chat rate limiter bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = _limiters[loop] = RateLimiter(
+            connection_rate=getattr(settings, 'CHAT_MESSAGE_RATE', 5.0),
+            connection_burst=getattr(settings, 'CHAT_MESSAGE_BURST', 10),
+            user_rate=getattr(settings, 'CHAT_USER_MESSAGE_RATE', 10.0),
+            user_burst=getattr(settings, 'CHAT_USER_MESSAGE_BURST', 20),
+        )
+    return limiter
+
+
+def _rate_limit_stats():
+    return dict(stats, tracked_users=sum(len(limiter.users) for limiter in list(_limiters.values())))
+
+
+metrics.register('rate_limits', _rate_limit_stats)
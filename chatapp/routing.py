@@ -4,4 +4,5 @@ from .import consumers
 websocket_urlpatterns = [
     path('ws/chat/<int:conversation_id>/', consumers.ChatConsumer.as_asgi()),
     path('ws/notifications/', consumers.NotificationsConsumer.as_asgi()),
+    path('ws/stream/', consumers.StreamConsumer.as_asgi()),
 ]
\ No newline at end of file
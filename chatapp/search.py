@@ -0,0 +1,222 @@
+"""Full-text search over chat messages and feedback.
+
+Documents live in a single `chatapp_search` table keyed by a rowid derived
+from the object (`id * 2` for messages, `id * 2 + 1` for feedback), so updates
+and deletes are primary-key operations. The table is an FTS5 virtual table on
+SQLite and a table with a generated tsvector column plus a GIN index on
+Postgres (see migration 0008); both sit behind the same `SearchBackend`
+interface. Other databases fall back to a scanning `icontains` search.
+
+Feedback, edited messages and deletes are indexed by the save and delete
+signals, in the same transaction as the change. New messages are indexed in
+batches off the write path: they are saved with `search_indexed=False` and
+`index_pending_messages` picks them up after commit, from a worker thread
+(`CHAT_SEARCH_WORKER = 'thread'`) or `manage.py index_search --loop`. A
+message is searchable a moment after it is sent rather than immediately.
+"""
+import abc
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .workers import BackgroundWorker
+
+MESSAGE = 'message'
+FEEDBACK = 'feedback'
+
+_KIND_OFFSET = {MESSAGE: 0, FEEDBACK: 1}
+
+
+def _rowid(kind, object_id):
+    return object_id * 2 + _KIND_OFFSET[kind]
+
+
+def _object_id(rowid):
+    return rowid // 2
+
+
+def _terms(query):
+    return re.findall(r'\w+', query)
+
+
+class SearchBackend(abc.ABC):
+
+    def index(self, kind, object_id, body, conversation_id=None, owner_id=None):
+        self.index_many(kind, [(object_id, body, conversation_id, owner_id)])
+
+    @abc.abstractmethod
+    def index_many(self, kind, documents):
+        """Add or replace documents, given as (object_id, body, conversation_id, owner_id) tuples."""
+
+    @abc.abstractmethod
+    def remove(self, kind, object_id):
+        pass
+
+    @abc.abstractmethod
+    def search(self, kind, query, limit=20, conversation_ids=None, owner_id=None):
+        """Ranked object ids of `kind` matching `query`, best match first.
+
+        `conversation_ids` restricts messages to those conversations and
+        `owner_id` restricts results to documents owned by that user.
+        """
+
+    def _filters(self, kind, conversation_ids, owner_id):
+        clauses, params = ['kind = %s'], [kind]
+        if conversation_ids is not None:
+            conversation_ids = list(conversation_ids) or [-1]
+            clauses.append('conversation_id IN (%s)' % ', '.join(['%s'] * len(conversation_ids)))
+            params.extend(conversation_ids)
+        if owner_id is not None:
+            clauses.append('owner_id = %s')
+            params.append(owner_id)
+        return clauses, params
+
+
+class SQLiteSearchBackend(SearchBackend):
+
+    def index_many(self, kind, documents):
+        rows = [(_rowid(kind, object_id), body, kind, conversation_id, owner_id)
+                for object_id, body, conversation_id, owner_id in documents]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chatapp_search WHERE rowid IN (%s)' % ', '.join(['%s'] * len(rows)),
+                           [row[0] for row in rows])
+            cursor.executemany(
+                'INSERT INTO chatapp_search (rowid, body, kind, conversation_id, owner_id) VALUES (%s, %s, %s, %s, %s)',
+                rows,
+            )
+
+    def remove(self, kind, object_id):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chatapp_search WHERE rowid = %s', [_rowid(kind, object_id)])
+
+    def search(self, kind, query, limit=20, conversation_ids=None, owner_id=None):
+        terms = _terms(query)
+        if not terms:
+            return []
+        # every term must match, each as a prefix ("deliv" finds "delivery")
+        match = ' '.join('"%s"*' % term for term in terms)
+        clauses, params = self._filters(kind, conversation_ids, owner_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT rowid FROM chatapp_search WHERE chatapp_search MATCH %s AND {} ORDER BY rank LIMIT %s'.format(' AND '.join(clauses)),
+                [match, *params, limit],
+            )
+            return [_object_id(rowid) for rowid, in cursor.fetchall()]
+
+
+class PostgresSearchBackend(SearchBackend):
+
+    def index_many(self, kind, documents):
+        rows = [(_rowid(kind, object_id), body, kind, conversation_id, owner_id)
+                for object_id, body, conversation_id, owner_id in documents]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO chatapp_search (rowid, body, kind, conversation_id, owner_id) VALUES (%s, %s, %s, %s, %s) '
+                'ON CONFLICT (rowid) DO UPDATE SET body = EXCLUDED.body, conversation_id = EXCLUDED.conversation_id, '
+                'owner_id = EXCLUDED.owner_id',
+                rows,
+            )
+
+    def remove(self, kind, object_id):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chatapp_search WHERE rowid = %s', [_rowid(kind, object_id)])
+
+    def search(self, kind, query, limit=20, conversation_ids=None, owner_id=None):
+        terms = _terms(query)
+        if not terms:
+            return []
+        tsquery = ' & '.join('%s:*' % term for term in terms)
+        clauses, params = self._filters(kind, conversation_ids, owner_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT rowid FROM chatapp_search WHERE document @@ to_tsquery('simple', %s) AND {} "
+                "ORDER BY ts_rank(document, to_tsquery('simple', %s)) DESC LIMIT %s".format(' AND '.join(clauses)),
+                [tsquery, *params, tsquery, limit],
+            )
+            return [_object_id(rowid) for rowid, in cursor.fetchall()]
+
+
+class ScanSearchBackend(SearchBackend):
+    """Unranked `icontains` fallback for databases without a native full-text index."""
+
+    def index_many(self, kind, documents):
+        pass
+
+    def remove(self, kind, object_id):
+        pass
+
+    def search(self, kind, query, limit=20, conversation_ids=None, owner_id=None):
+        from django.db.models import Q
+        from .models import Feedback, Message
+        terms = _terms(query)
+        if not terms:
+            return []
+        if kind == MESSAGE:
+            queryset = Message.objects.all()
+            for term in terms:
+                queryset = queryset.filter(content__icontains=term)
+            if conversation_ids is not None:
+                queryset = queryset.filter(conversation_id__in=conversation_ids)
+            if owner_id is not None:
+                queryset = queryset.filter(sender_id=owner_id)
+        else:
+            queryset = Feedback.objects.all()
+            for term in terms:
+                queryset = queryset.filter(Q(subject__icontains=term) | Q(message__icontains=term)
+                                           | Q(name__icontains=term) | Q(email__icontains=term))
+            if owner_id is not None:
+                queryset = queryset.filter(user_id=owner_id)
+        return list(queryset.order_by('-id').values_list('id', flat=True)[:limit])
+
+
+def get_backend():
+    if connection.vendor == 'sqlite':
+        return SQLiteSearchBackend()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return ScanSearchBackend()
+
+
+def index_message(message):
+    get_backend().index(MESSAGE, message.id, message.content,
+                        conversation_id=message.conversation_id, owner_id=message.sender_id)
+
+
+def index_pending_messages(batch_size=500):
+    """Index up to `batch_size` messages saved since the last run; returns how many."""
+    from .models import Message
+    with transaction.atomic():
+        pending = Message.objects.filter(search_indexed=False)
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        documents = list(pending.order_by('id').values_list('id', 'content', 'conversation_id', 'sender_id')[:batch_size])
+        if documents:
+            get_backend().index_many(MESSAGE, documents)
+            Message.objects.filter(id__in=[document[0] for document in documents]).update(search_indexed=True)
+    return len(documents)
+
+
+message_indexer = BackgroundWorker(
+    'chatapp-search',
+    index_pending_messages,
+    batch_size=getattr(settings, 'CHAT_SEARCH_BATCH_SIZE', 500),
+    poll_interval=getattr(settings, 'CHAT_SEARCH_POLL_INTERVAL', 5),
+)
+
+
+def index_feedback(feedback):
+    body = ' '.join(filter(None, [feedback.subject, feedback.message, feedback.name, feedback.email]))
+    get_backend().index(FEEDBACK, feedback.id, body, owner_id=feedback.user_id)
+
+
+def search_messages(query, limit=20, conversation_ids=None):
+    return get_backend().search(MESSAGE, query, limit=limit, conversation_ids=conversation_ids)
+
+
+def search_feedback(query, limit=20, owner_id=None):
+    return get_backend().search(FEEDBACK, query, limit=limit, owner_id=owner_id)
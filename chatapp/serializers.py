@@ -29,9 +29,20 @@ class CurrentUserSerializer(serializers.ModelSerializer):
 
 class ConversationSerializer(serializers.ModelSerializer):
     participants = UserListSerializer(many=True, read_only=True)
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
     class Meta:
         model = Conversation
-        fields = ('id', 'participants', 'created_at')
+        fields = ('id', 'participants', 'created_at', 'last_message', 'last_activity_at', 'unread_count')
+
+    def get_last_message(self, obj):
+        if obj.last_message is None:
+            return None
+        return MessageSlimSerializer(obj.last_message).data
+
+    def get_unread_count(self, obj):
+        # annotated by ConversationListCreateView for the requesting user
+        return getattr(obj, 'unread_count', 0)
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
@@ -42,10 +53,23 @@ class MessageSerializer(serializers.ModelSerializer):
     participants = serializers.SerializerMethodField()
     class Meta:
         model = Message
-        fields = ('id', 'conversation', 'sender', 'content', 'timestamp', 'participants')
+        fields = ('id', 'uid', 'conversation', 'sender', 'content', 'timestamp', 'participants')
 
     def get_participants(self, obj):
-        return UserListSerializer(obj.conversation.participants.all(), many=True).data
+        # every message of a conversation shares the same participants, so serialize them
+        # once per request (the context is shared by all items of a list serializer)
+        cache = self.context.setdefault('participants', {})
+        if obj.conversation_id not in cache:
+            cache[obj.conversation_id] = UserListSerializer(obj.conversation.participants.all(), many=True).data
+        return cache[obj.conversation_id]
+
+
+class MessageSlimSerializer(serializers.ModelSerializer):
+    """Message list payload without the per-message participants array (`?slim=true`)."""
+    sender = UserListSerializer()
+    class Meta:
+        model = Message
+        fields = ('id', 'uid', 'conversation', 'sender', 'content', 'timestamp')
 
 
 class CreateMessageSerializer(serializers.ModelSerializer):
@@ -0,0 +1,184 @@
+"""Message ingest: the one path chat messages are written and deleted through.
+
+REST and websocket messages both go through `post_message` and
+`delete_message`. Every change, including messages written by the
+write-behind writer, is appended to the conversation's change log
+(`MessageChange`) under the next per-conversation version in the same
+transaction as the change itself. New messages are recorded in bulk by
+`record_new_messages`: a few statements per conversation however many
+messages were written, with search indexing left to a background indexer
+(see chatapp.search). Clients that know
+the last version they saw sync with `changes?since=<version>` in O(changes),
+and live sockets get the same changes as `chat_message` / `message_deleted`
+events.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Case, F, PositiveBigIntegerField, PositiveIntegerField, Value, When
+
+from . import search
+from .models import Conversation, ConversationReadState, Message, MessageChange
+from .outbox import publish
+
+
+def message_payload(message):
+    """A stored message (with its sender loaded) in the shape of a live `chat_message` frame."""
+    sender = message.sender
+    payload = {
+        'type': 'chat_message',
+        'id': message.id,
+        'uid': message.uid,
+        'message': message.content,
+        'user': {
+            'id': sender.id,
+            'username': sender.username,
+            'is_staff': sender.is_staff,
+            'is_superuser': sender.is_superuser,
+        },
+        'timestamp': message.timestamp.isoformat(),
+    }
+    version = getattr(message, 'change_version', None)
+    if version is not None:
+        payload['version'] = version
+    return payload
+
+
+def _can_return_from_update(connection):
+    # can_return_columns_from_insert is no guide: MariaDB returns rows from INSERT but not from UPDATE
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+
+
+def _bump_version(conversation_id, count, last=None, using=DEFAULT_DB_ALIAS):
+    """Reserve the next `count` versions of the conversation's log; returns the highest.
+
+    `last`, the newest of the messages being recorded, moves the
+    conversation's last message forward in the same statement. It never moves
+    backwards: write-behind batches may commit slightly out of order. The row
+    lock taken by the update orders versions by commit within a conversation.
+    """
+    connection = connections[using]
+    table = connection.ops.quote_name(Conversation._meta.db_table)
+    sql = f'UPDATE {table} SET version = version + %s'
+    params = [count]
+    if last is not None:
+        timestamp = connection.ops.adapt_datetimefield_value(last.timestamp)
+        newer = '(last_message_id IS NULL OR last_activity_at <= %s)'
+        sql += (f', last_message_id = CASE WHEN {newer} THEN %s ELSE last_message_id END'
+                f', last_activity_at = CASE WHEN {newer} THEN %s ELSE last_activity_at END')
+        params += [timestamp, last.id, timestamp, timestamp]
+    sql += ' WHERE id = %s'
+    params.append(conversation_id)
+    with connection.cursor() as cursor:
+        if _can_return_from_update(connection):
+            cursor.execute(sql + ' RETURNING version', params)
+            return cursor.fetchone()[0]
+        cursor.execute(sql, params)
+    return Conversation.objects.using(using).filter(pk=conversation_id).values_list('version', flat=True).get()
+
+
+def record_change(conversation_id, message_id, kind, using=DEFAULT_DB_ALIAS):
+    """Append a change to the conversation's log and return its version."""
+    with transaction.atomic(using=using):
+        version = _bump_version(conversation_id, 1, using=using)
+        MessageChange.objects.using(using).create(conversation_id=conversation_id, version=version,
+                                                  message_id=message_id, kind=kind)
+    return version
+
+
+def _update_read_states(conversation_id, messages, using):
+    # a sender has read everything up to their newest message in the batch, and has the
+    # messages after it unread; everyone else has the whole batch unread
+    unread, last_read = [], []
+    for sender_id in {message.sender_id for message in messages}:
+        position = max(n for n, message in enumerate(messages) if message.sender_id == sender_id)
+        own = messages[position]
+        others = sum(1 for message in messages if message.sender_id != sender_id)
+        unread += [
+            When(user_id=sender_id, last_read_id__lt=own.id, then=Value(len(messages) - position - 1)),
+            When(user_id=sender_id, then=F('unread_count') + others),
+        ]
+        last_read.append(When(user_id=sender_id, last_read_id__lt=own.id, then=Value(own.id)))
+    ConversationReadState.objects.using(using).filter(conversation_id=conversation_id).update(
+        unread_count=Case(*unread, default=F('unread_count') + len(messages), output_field=PositiveIntegerField()),
+        last_read_id=Case(*last_read, default=F('last_read_id'), output_field=PositiveBigIntegerField()),
+    )
+
+
+def record_new_messages(messages, using=DEFAULT_DB_ALIAS):
+    """Record newly written messages: change log, conversation summary and read states.
+
+    Runs in the caller's transaction. Per conversation it takes one UPDATE
+    (versions and last message), one UPDATE of the participants' read states
+    and a share of one change log insert, however many messages are recorded.
+    Each message gets its `change_version`.
+    """
+    by_conversation = {}
+    for message in sorted(messages, key=lambda message: message.id):
+        by_conversation.setdefault(message.conversation_id, []).append(message)
+    changes = []
+    with transaction.atomic(using=using):
+        for conversation_id, batch in by_conversation.items():
+            newest = max(batch, key=lambda message: (message.timestamp, message.id))
+            version = _bump_version(conversation_id, len(batch), newest, using)
+            for message_version, message in enumerate(batch, start=version - len(batch) + 1):
+                message.change_version = message_version
+                changes.append(MessageChange(conversation_id=conversation_id, version=message_version,
+                                             message_id=message.id, kind=MessageChange.CREATED))
+            _update_read_states(conversation_id, batch, using)
+        MessageChange.objects.using(using).bulk_create(changes)
+    if changes and getattr(settings, 'CHAT_SEARCH_WORKER', 'thread') == 'thread':
+        transaction.on_commit(search.message_indexer.wake, using=using)
+
+
+def post_message(conversation, sender, content, uid=None, broadcast=False):
+    """Write a message (and its change log entry).
+
+    Websocket consumers fan the message out themselves; other callers pass
+    `broadcast=True` to have it published to the conversation's sockets once
+    the transaction commits.
+    """
+    extra = {'uid': uid} if uid is not None else {}
+    with transaction.atomic():
+        message = Message(conversation=conversation, sender=sender, content=content, **extra)
+        message._ingest = True
+        message.save(force_insert=True)
+        record_new_messages([message])
+        if broadcast:
+            publish(f'chat_{conversation.id}', message_payload(message))
+    return message
+
+
+def delete_message(message):
+    """Delete a message, leaving a tombstone in the change log and telling connected sockets."""
+    with transaction.atomic():
+        message_id, conversation_id = message.id, message.conversation_id
+        message.delete()
+        publish(f'chat_{conversation_id}', {
+            'type': 'message_deleted',
+            'id': message_id,
+            'conversation_id': conversation_id,
+            'version': message.change_version,
+        })
+
+
+def changes_since(conversation, since, limit):
+    """Up to `limit` changes after version `since`, oldest first, plus whether more remain.
+
+    Created entries carry the message as it is now; if it was deleted since,
+    its tombstone follows later in the log and the entry carries no message.
+    """
+    changes = list(conversation.changes.filter(version__gt=since).order_by('version')[:limit + 1])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    created_ids = [change.message_id for change in changes if change.kind == MessageChange.CREATED]
+    messages = Message.objects.select_related('sender').in_bulk(created_ids) if created_ids else {}
+    entries = []
+    for change in changes:
+        entry = {'version': change.version, 'kind': change.kind, 'id': change.message_id}
+        if change.kind == MessageChange.CREATED:
+            message = messages.get(change.message_id)
+            entry['message'] = message_payload(message) if message is not None else None
+        entries.append(entry)
+    return entries, has_more
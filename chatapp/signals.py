@@ -0,0 +1,74 @@
+from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import search, services
+from .cache import staff_directory, user_cache
+from .models import Conversation, ConversationReadState, Feedback, Message, MessageChange
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance.pk)
+    staff_directory.invalidate_for(instance)
+
+
+@receiver(post_save, sender=Message)
+def record_message(sender, instance, created, using, **kwargs):
+    # services and the write-behind writer record their messages in bulk (services.record_new_messages);
+    # this covers messages saved anywhere else, such as the admin
+    if not created:
+        search.index_message(instance)
+    elif not getattr(instance, '_ingest', False):
+        services.record_new_messages([instance], using=using)
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    search.get_backend().remove(search.MESSAGE, instance.id)
+
+
+@receiver(post_save, sender=Feedback)
+def index_feedback(sender, instance, **kwargs):
+    search.index_feedback(instance)
+
+
+@receiver(post_delete, sender=Feedback)
+def unindex_feedback(sender, instance, **kwargs):
+    search.get_backend().remove(search.FEEDBACK, instance.id)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def create_read_states(sender, instance, action, pk_set, **kwargs):
+    if action == 'post_add' and isinstance(instance, Conversation) and pk_set:
+        ConversationReadState.objects.bulk_create(
+            [ConversationReadState(conversation=instance, user_id=user_id) for user_id in pk_set],
+            ignore_conflicts=True,
+        )
+
+
+@receiver(post_delete, sender=Message)
+def rewind_conversation_summary(sender, instance, **kwargs):
+    (ConversationReadState.objects
+        .filter(conversation_id=instance.conversation_id, last_read_id__lt=instance.id, unread_count__gt=0)
+        .exclude(user_id=instance.sender_id)
+        .update(unread_count=F('unread_count') - 1))
+    # SET_NULL has already cleared last_message if this was it; point it at the newest remaining message
+    if Conversation.objects.filter(pk=instance.conversation_id, last_message__isnull=True).exists():
+        last = (Message.objects.filter(conversation_id=instance.conversation_id)
+                .order_by('-timestamp', '-id').first())
+        if last is not None:
+            Conversation.objects.filter(pk=instance.conversation_id, last_message__isnull=True).update(
+                last_message=last, last_activity_at=last.timestamp)
+
+
+@receiver(post_delete, sender=Message)
+def log_message_deleted(sender, instance, origin=None, **kwargs):
+    # a conversation being deleted takes its whole change log with it
+    if isinstance(origin, Conversation) or getattr(origin, 'model', None) is Conversation:
+        return
+    instance.change_version = services.record_change(instance.conversation_id, instance.id, MessageChange.DELETED)
@@ -1,3 +1,1517 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import logging
+import sys
+import threading
+import time
+import unittest
+from datetime import timedelta
+from logging.handlers import QueueListener
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import metrics, persistence, search, services
+from .admin import FeedbackAdmin
+from .benchmarks import BenchmarkSuite
+from .cache import staff_directory, user_cache
+from .consumers import ChatSocketConsumer
+from .db import DatabaseBusy, DatabaseExecutor, db_to_async
+from .encoding import group_event
+from .layers import LocalChannelLayer
+from .log import JSONFormatter, QueueLogHandler
+from .mail import deliver_due_mail, prune_sent_mail, queue_mail
+from .models import Conversation, ConversationReadState, Feedback, Message, OutboundEmail, OutboxEvent
+from .outbox import dispatch_pending_events, prune_dispatched_events
+from .pagination import MessageKeysetPagination
+from .ratelimit import RateLimiter, TokenBucket
+from .workers import BackgroundWorker, delete_in_batches
+
+
+class MessageListQueryCountTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.admin = User.objects.create_user(username='admin', password='password', is_staff=True)
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.user, self.admin])
+        self.url = f'/chats/conversations/{self.conversation.id}/messages/'
+        self.client.force_authenticate(self.user)
+
+    def create_messages(self, count):
+        senders = [self.user, self.admin]
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=senders[i % 2], content=f'message {i}')
+            for i in range(count)
+        ])
+
+    def count_list_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['results']
+
+    def test_query_count_does_not_grow_with_message_count(self):
+        self.create_messages(5)
+        few_queries, results = self.count_list_queries(self.url)
+        self.assertEqual(len(results), 5)
+
+        self.create_messages(45)
+        many_queries, results = self.count_list_queries(self.url)
+        self.assertEqual(len(results), 50)
+        self.assertEqual(few_queries, many_queries)
+
+    def test_participants_are_serialized_for_every_message(self):
+        self.create_messages(3)
+        _, results = self.count_list_queries(self.url)
+        for message in results:
+            self.assertEqual({p['id'] for p in message['participants']}, {self.user.id, self.admin.id})
+
+    def test_slim_payload_drops_participants(self):
+        self.create_messages(3)
+        queries, results = self.count_list_queries(self.url + '?slim=true')
+        full_queries, _ = self.count_list_queries(self.url)
+        self.assertNotIn('participants', results[0])
+        self.assertEqual(results[0]['sender']['id'], self.user.id)
+        self.assertLessEqual(queries, full_queries)
+
+
+class MessageKeysetPaginationTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.user])
+        self.url = f'/chats/conversations/{self.conversation.id}/messages/'
+        self.client.force_authenticate(self.user)
+        self.ids = [message.id for message in Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=self.user, content=f'message {i}') for i in range(5)
+        ])]
+
+    def page(self, url=None, **params):
+        response = self.client.get(url or self.url, params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        return [message['id'] for message in body['results']], body['previous'], body['next']
+
+    def walk_back(self, limit):
+        ids, previous, _ = self.page(limit=limit)
+        while previous:
+            older, previous, _ = self.page(previous)
+            ids = older + ids
+        return ids
+
+    def test_newest_page_by_default(self):
+        ids, previous, next_ = self.page(limit=2)
+        self.assertEqual(ids, self.ids[3:])
+        self.assertIn(f'before={self.ids[3]}', previous)
+        self.assertIsNone(next_)
+
+    def test_before_and_after(self):
+        ids, previous, next_ = self.page(before=self.ids[3], limit=2)
+        self.assertEqual(ids, self.ids[1:3])
+        self.assertIn(f'after={self.ids[2]}', next_)
+        ids, _, next_ = self.page(after=self.ids[1], limit=2)
+        self.assertEqual(ids, self.ids[2:4])
+        self.assertIsNotNone(next_)
+        ids, _, next_ = self.page(after=self.ids[2], limit=2)
+        self.assertEqual(ids, self.ids[3:])
+        self.assertIsNone(next_)
+        ids, previous, _ = self.page(before=self.ids[1], limit=2)
+        self.assertEqual(ids, self.ids[:1])
+        self.assertIsNone(previous)
+
+    def test_walking_back_returns_every_message_once(self):
+        self.assertEqual(self.walk_back(limit=2), self.ids)
+
+    def test_identical_timestamps_are_ordered_by_id(self):
+        Message.objects.filter(id__in=self.ids).update(timestamp=timezone.now())
+        self.assertEqual(self.walk_back(limit=2), self.ids)
+        ids, _, _ = self.page(after=self.ids[1], limit=2)
+        self.assertEqual(ids, self.ids[2:4])
+
+    def test_deleted_cursor_falls_back_to_the_id(self):
+        Message.objects.filter(id=self.ids[2]).delete()
+        ids, _, _ = self.page(before=self.ids[2], limit=10)
+        self.assertEqual(ids, self.ids[:2])
+        ids, _, _ = self.page(after=self.ids[2], limit=10)
+        self.assertEqual(ids, self.ids[3:])
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'reads the SQLite query plan')
+    def test_cursor_pages_seek_into_the_timestamp_index(self):
+        paginator = MessageKeysetPagination()
+        messages = Message.objects.filter(conversation=self.conversation)
+        older = messages.filter(paginator.older_than(messages, self.ids[3])).order_by('-timestamp', '-id')[:3]
+        newer = messages.filter(paginator.newer_than(messages, self.ids[1])).order_by('timestamp', 'id')[:3]
+        for queryset, bound in ((older, 'timestamp<'), (newer, 'timestamp>')):
+            plan = queryset.explain()
+            self.assertIn('message_conv_ts_id_idx', plan)
+            self.assertIn(f'conversation_id=? AND {bound}', plan)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(self.url, {'before': self.ids[3], 'after': self.ids[1]}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'before': 'abc'}).status_code, 400)
+        # out of range limits are clamped, unparseable ones use the default
+        self.assertEqual(self.page(limit=0)[0], self.ids[4:])
+        self.assertEqual(self.page(limit='abc')[0], self.ids)
+
+
+class ConversationPairTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.admin = User.objects.create(username='admin', is_staff=True)
+
+    def create(self, creator, *participants):
+        self.client.force_authenticate(creator)
+        return self.client.post('/chats/conversations/', {'participants': [user.id for user in participants]},
+                                format='json')
+
+    def test_creating_the_same_pair_twice_returns_the_existing_conversation(self):
+        response = self.create(self.user, self.user, self.admin)
+        self.assertEqual(response.status_code, 201)
+        conversation_id = response.json()['id']
+        # either participant, in either order
+        for creator, participants in [(self.user, (self.user, self.admin)), (self.admin, (self.user, self.admin))]:
+            response = self.create(creator, *participants)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['conversation_id'], conversation_id)
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_admin_check_ignores_a_stale_staff_directory(self):
+        # another process changed the flags: no signal reached this process's cached directory
+        other = User.objects.create(username='other')
+        staff_directory.members()
+        self.addCleanup(staff_directory.invalidate)
+        User.objects.filter(id=self.admin.id).update(is_staff=False)
+        User.objects.filter(id=other.id).update(is_staff=True)
+        self.assertEqual(self.create(self.user, self.user, self.admin).status_code, 403)
+        self.assertEqual(self.create(self.user, self.user, other).status_code, 201)
+
+
+class ConversationInboxTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.client.force_authenticate(self.user)
+
+    def start_conversation(self, username):
+        other = User.objects.create(username=username)
+        conversation = Conversation.objects.create()
+        conversation.participants.set([self.user, other])
+        return conversation, other
+
+    def inbox(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chats/conversations/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_inbox_is_ordered_by_activity_with_unread_counts(self):
+        quiet, _ = self.start_conversation('quiet')
+        first, first_other = self.start_conversation('first')
+        second, second_other = self.start_conversation('second')
+        services.post_message(second, second_other, 'one')
+        services.post_message(first, first_other, 'two')
+        services.post_message(first, first_other, 'three')
+        services.post_message(second, self.user, 'reply')
+
+        _, inbox = self.inbox()
+        self.assertEqual([entry['id'] for entry in inbox], [second.id, first.id, quiet.id])
+        self.assertEqual([entry['unread_count'] for entry in inbox], [0, 2, 0])
+        self.assertEqual(inbox[0]['last_message']['content'], 'reply')
+        self.assertIsNone(inbox[2]['last_message'])
+
+        # unread counts are per user
+        self.client.force_authenticate(first_other)
+        _, inbox = self.inbox()
+        self.assertEqual([(entry['id'], entry['unread_count']) for entry in inbox], [(first.id, 0)])
+
+    def test_ties_on_activity_fall_back_to_the_newest_conversation(self):
+        conversations = [self.start_conversation(f'other {i}')[0] for i in range(3)]
+        Conversation.objects.update(last_activity_at=timezone.now())
+        _, inbox = self.inbox()
+        self.assertEqual([entry['id'] for entry in inbox], [c.id for c in reversed(conversations)])
+
+    def test_query_count_does_not_grow_with_the_inbox(self):
+        for i in range(2):
+            conversation, other = self.start_conversation(f'few {i}')
+            services.post_message(conversation, other, 'hello')
+        few_queries, inbox = self.inbox()
+        self.assertEqual(len(inbox), 2)
+
+        for i in range(10):
+            conversation, other = self.start_conversation(f'many {i}')
+            services.post_message(conversation, other, 'hello')
+            services.post_message(conversation, self.user, 'hi')
+        with self.assertNumQueries(few_queries):
+            _, inbox = self.inbox()
+        self.assertEqual(len(inbox), 12)
+
+
+class CachedJWTAuthenticationTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.addCleanup(user_cache.clear)
+
+    def me(self):
+        return self.client.get('/chats/auth/me/').status_code
+
+    def test_saving_the_user_invalidates_the_cache(self):
+        self.assertEqual(self.me(), 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.me(), 401)
+
+    def test_deleting_the_user_invalidates_the_cache(self):
+        self.assertEqual(self.me(), 200)
+        self.user.delete()
+        self.assertEqual(self.me(), 401)
+
+    @override_settings(CHAT_AUTH_USER_MAX_AGE=10)
+    def test_changes_from_other_processes_apply_after_the_max_age(self):
+        self.assertEqual(self.me(), 200)
+        # an update made elsewhere sends no signal to this process
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        self.assertEqual(self.me(), 200)
+        later = time.monotonic() + 11
+        with mock.patch('chatapp.cache.time.monotonic', return_value=later):
+            self.assertEqual(self.me(), 401)
+
+
+class ParticipantKeyMigrationTests(TransactionTestCase):
+    before = [('chatapp', '0009_conversation_summaries')]
+    after = [('chatapp', '0010_conversation_participant_key')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_oldest_duplicate_keeps_the_key(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        old_apps = executor.loader.project_state(self.before).apps
+        OldUser = old_apps.get_model('auth', 'User')
+        OldConversation = old_apps.get_model('chatapp', 'Conversation')
+        a, b, c = (OldUser.objects.create(username=name) for name in 'abc')
+        oldest, duplicate, group = (OldConversation.objects.create() for _ in range(3))
+        oldest.participants.set([b, a])
+        duplicate.participants.set([a, b])
+        group.participants.set([a, b, c])
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        new_apps = executor.loader.project_state(self.after).apps
+        keys = dict(new_apps.get_model('chatapp', 'Conversation').objects.values_list('id', 'participant_key'))
+        self.assertEqual(keys, {oldest.id: f'{a.id}:{b.id}', duplicate.id: None, group.id: None})
+
+
+class FeedbackMailOutboxTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        for i in range(3):
+            User.objects.create_superuser(username=f'admin{i}', password='password', email=f'admin{i}@example.com')
+        self.client.force_authenticate(self.user)
+
+    def submit_feedback(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/chats/feedback/', {'subject': 'Help', 'message': 'It broke', 'type': 'question'})
+        self.assertEqual(response.status_code, 201)
+        return callbacks
+
+    def test_feedback_queues_mail_instead_of_sending_inline(self):
+        with mock.patch('chatapp.mail.mail_worker.wake') as wake:
+            callbacks = self.submit_feedback()
+            self.assertEqual(len(mail.outbox), 0)
+            self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.PENDING).count(), 3)
+            for callback in callbacks:
+                callback()
+            wake.assert_called_once()
+
+    def test_due_mail_is_sent_over_one_connection(self):
+        with mock.patch('chatapp.mail.mail_worker.wake'):
+            self.submit_feedback()
+        with mock.patch('chatapp.mail.get_connection', wraps=mail.get_connection) as get_connection:
+            self.assertEqual(deliver_due_mail(), 3)
+        get_connection.assert_called_once()
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['admin0@example.com', 'admin1@example.com', 'admin2@example.com'])
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 3)
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        with mock.patch('chatapp.mail.mail_worker.wake'):
+            self.submit_feedback()
+        with mock.patch('chatapp.mail.EmailMessage.send', side_effect=OSError('smtp down')):
+            self.assertEqual(deliver_due_mail(), 3)
+        email = OutboundEmail.objects.first()
+        self.assertEqual((email.status, email.attempts, email.last_error), (OutboundEmail.PENDING, 1, 'smtp down'))
+        # not due again until the backoff has passed
+        self.assertEqual(deliver_due_mail(), 0)
+
+
+@override_settings(CHAT_MAIL_WORKER='command', CHAT_OUTBOX_WORKER='command')
+class FeedbackUpdateOutboxTests(APITransactionTestCase):
+    # real commits and rollbacks, so the outbox row's transaction can be checked
+
+    def setUp(self):
+        self.user = User.objects.create(username='user', email='user@example.com')
+        self.feedback = Feedback.objects.create(user=self.user, subject='Help', message='It broke')
+        self.url = f'/chats/feedback/{self.feedback.id}/'
+        self.client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+
+    def respond(self):
+        return self.client.put(self.url, {'subject': 'Help', 'message': 'It broke', 'status': Feedback.RESOLVED,
+                                          'admin_response': 'Fixed'}, format='json')
+
+    def test_event_is_written_in_the_update_transaction(self):
+        from chatapp import outbox
+        seen = []
+
+        def publish(group, payload):
+            # inside the update's transaction, which has already written the new status
+            seen.append((connection.in_atomic_block, Feedback.objects.get(id=self.feedback.id).status))
+            return outbox.publish(group, payload)
+
+        with mock.patch('chatapp.views.publish', side_effect=publish):
+            self.assertEqual(self.respond().status_code, 200)
+        self.assertEqual(seen, [(True, Feedback.RESOLVED)])
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.group, event.status), (f'user_{self.user.id}', OutboxEvent.PENDING))
+        feedback = event.payload['feedback']
+        self.assertEqual((feedback['id'], feedback['status'], feedback['admin_response']),
+                         (self.feedback.id, Feedback.RESOLVED, 'Fixed'))
+        self.assertEqual(OutboundEmail.objects.get().recipient, 'user@example.com')
+
+    def test_a_rolled_back_update_leaves_no_event(self):
+        from chatapp import outbox
+
+        def publish(group, payload):
+            outbox.publish(group, payload)
+            raise DatabaseError('disk full')
+
+        with mock.patch('chatapp.views.publish', side_effect=publish), self.assertRaises(DatabaseError):
+            self.respond()
+        self.feedback.refresh_from_db()
+        self.assertEqual(self.feedback.status, Feedback.OPEN)
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertFalse(OutboundEmail.objects.exists())
+
+
+class FeedbackInboxTests(APITestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create(username='admin', is_staff=True)
+        self.user = User.objects.create(username='user')
+        rows = [
+            (self.user, Feedback.QUESTION, Feedback.OPEN, '2026-01-01T10:00:00Z'),
+            (self.user, Feedback.COMPLAINT, Feedback.RESOLVED, '2026-01-02T10:00:00Z'),
+            (self.admin, Feedback.FEEDBACK, Feedback.IN_PROGRESS, '2026-01-03T10:00:00Z'),
+            (self.user, Feedback.COMPLAINT, Feedback.OPEN, '2026-01-03T10:00:00Z'),
+            (self.admin, Feedback.QUESTION, Feedback.OPEN, '2026-01-04T10:00:00Z'),
+        ]
+        self.feedback = Feedback.objects.bulk_create([
+            Feedback(user=user, type=type_, status=status, subject=f'subject {i}', message='message')
+            for i, (user, type_, status, _) in enumerate(rows)
+        ])
+        for feedback, (*_, created_at) in zip(self.feedback, rows):
+            Feedback.objects.filter(id=feedback.id).update(created_at=created_at)
+        self.client.force_authenticate(self.admin)
+
+    def inbox(self, url='/chats/feedback/', **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        return [self.feedback.index(Feedback.objects.get(id=item['id'])) for item in body['results']], body['next']
+
+    def test_filters(self):
+        self.assertEqual(self.inbox()[0], [4, 3, 2, 1, 0])
+        self.assertEqual(self.inbox(status=Feedback.OPEN)[0], [4, 3, 0])
+        self.assertEqual(self.inbox(status=[Feedback.RESOLVED, Feedback.IN_PROGRESS])[0], [2, 1])
+        self.assertEqual(self.inbox(type=Feedback.COMPLAINT, status=Feedback.OPEN)[0], [3])
+        self.assertEqual(self.inbox(created_after='2026-01-02', created_before='2026-01-03T12:00:00Z')[0], [3, 2, 1])
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.inbox(status=Feedback.OPEN)[0], [3, 0])
+
+    def test_invalid_dates_are_rejected(self):
+        for params in ({'created_after': 'yesterday'}, {'created_before': '2026-13-01'}):
+            response = self.client.get('/chats/feedback/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(next(iter(params)), response.json())
+
+    def test_next_links_walk_the_inbox_once(self):
+        positions, next_ = self.inbox(limit=2, type=[Feedback.COMPLAINT, Feedback.FEEDBACK, Feedback.QUESTION])
+        self.assertIn('cursor=', next_)
+        self.assertIn('limit=2', next_)
+        while next_:
+            page, next_ = self.inbox(next_)
+            self.assertLessEqual(len(page), 2)
+            positions += page
+        # rows 2 and 3 share a timestamp; the id breaks the tie
+        self.assertEqual(positions, [4, 3, 2, 1, 0])
+
+
+class BenchmarkSuiteSmokeTests(TransactionTestCase):
+    # sockets run their queries on other threads, so the seeded rows must be committed
+
+    def test_suite_reports_every_operation(self):
+        report = BenchmarkSuite(rooms=2, clients=2, messages=2, requests=2, history=3).run()
+        self.assertEqual(report['config']['rooms'], 2)
+        results = report['results']
+        self.assertEqual(set(results), {
+            'ws_connect', 'ws_message', 'rest_message_list', 'rest_conversation_list',
+            'rest_feedback_list', 'rest_feedback_create',
+        })
+        self.assertEqual(results['ws_connect']['count'], 4)
+        self.assertEqual(results['ws_message']['count'], 4)
+        self.assertEqual(results['rest_feedback_create']['count'], 2)
+        for result in results.values():
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['queries_per_op'], 0)
+
+
+class LocalChannelLayerTests(SimpleTestCase):
+
+    def test_group_send_from_another_thread_wakes_the_receiver(self):
+        # what the outbox worker does: async_to_sync on its own thread and loop
+        layer = LocalChannelLayer()
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.group_add('chat_1', channel)
+            receiver = asyncio.ensure_future(layer.receive(channel))
+            await asyncio.sleep(0)
+            # async_to_sync is built on the thread, so it runs on a loop of its own there
+            sender = threading.Thread(
+                target=lambda: async_to_sync(layer.group_send)('chat_1', {'type': 'chat.message', 'text': 'hi'}))
+            started = time.monotonic()
+            sender.start()
+            message = await asyncio.wait_for(receiver, 2)
+            elapsed = time.monotonic() - started
+            await asyncio.get_running_loop().run_in_executor(None, sender.join)
+            return message, elapsed
+
+        message, elapsed = async_to_sync(run)()
+        self.assertEqual(message['text'], 'hi')
+        self.assertLess(elapsed, 1)
+
+
+class DatabaseExecutorTests(SimpleTestCase):
+
+    def test_pending_limit_is_per_event_loop(self):
+        executor = DatabaseExecutor(max_workers=2, max_pending=1, queue_timeout=0)
+        self.addCleanup(executor.pool.shutdown)
+        release = threading.Event()
+
+        async def fill_then_overflow():
+            held = asyncio.ensure_future(executor.run(release.wait))
+            await asyncio.sleep(0.05)
+            with self.assertRaises(DatabaseBusy):
+                await executor.run(lambda: None)
+            # another loop has a budget of its own
+            other = await asyncio.to_thread(asyncio.run, executor.run(lambda: 'other loop'))
+            release.set()
+            await held
+            return other
+
+        self.assertEqual(asyncio.run(fill_then_overflow()), 'other loop')
+        self.assertEqual(executor.rejected, 1)
+
+
+class QueueLogHandlerTests(SimpleTestCase):
+
+    def handler(self, maxsize, **kwargs):
+        # the listener isn't running yet, so nothing drains the queue until the test starts it
+        self.stream = io.StringIO()
+        with mock.patch.object(QueueListener, 'start'):
+            handler = QueueLogHandler(self.stream, maxsize=maxsize, **kwargs)
+        handler.setFormatter(JSONFormatter())
+        self.addCleanup(handler.stop)
+        return handler
+
+    def emit(self, handler, *messages):
+        for message in messages:
+            handler.handle(logging.makeLogRecord({'name': 'chatapp.test', 'msg': message}))
+
+    def lines(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_drops_are_reported_once_the_queue_has_room(self):
+        handler = self.handler(maxsize=2, report_interval=0)
+        self.emit(handler, 'a', 'b', 'c')
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(metrics.snapshot()['logging']['dropped'], 1)
+        handler.listener.start()
+        handler.queue.join()
+        self.emit(handler, 'd')
+        handler.stop()
+        lines = self.lines()
+        self.assertEqual([line['message'] for line in lines[:3]], ['a', 'b', 'd'])
+        self.assertEqual((lines[3]['level'], lines[3]['dropped']), ('WARNING', 1))
+        self.assertEqual(len(lines), 4)
+
+    def test_unreported_drops_are_written_on_stop(self):
+        handler = self.handler(maxsize=1)
+        self.emit(handler, 'a', 'b', 'c')
+        handler.listener.start()
+        handler.stop()
+        lines = self.lines()
+        self.assertEqual(lines[0]['message'], 'a')
+        self.assertEqual((lines[1]['dropped'], lines[1]['dropped_total']), (2, 2))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitTests(SimpleTestCase):
+
+    def test_bucket_allows_a_burst_then_refills_at_the_rate(self):
+        bucket = TokenBucket(rate=2.0, capacity=3, now=0.0)
+        self.assertEqual([bucket.take(0.0) for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertEqual(bucket.take(0.0), 0.5)
+        self.assertEqual(bucket.take(0.25), 0.25)
+        self.assertEqual(bucket.take(0.5), 0.0)
+        # a long pause refills up to the capacity, not beyond it
+        self.assertEqual([bucket.take(100.0) for _ in range(4)], [0.0, 0.0, 0.0, 0.5])
+
+    def test_bucket_refund_and_idle(self):
+        bucket = TokenBucket(rate=1.0, capacity=2, now=0.0)
+        self.assertTrue(bucket.idle(0.0))
+        bucket.take(0.0)
+        self.assertFalse(bucket.idle(0.5))
+        self.assertTrue(bucket.idle(1.0))
+        bucket.refund()
+        bucket.refund()
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_connections_have_their_own_budget_within_the_users(self):
+        clock = FakeClock()
+        limiter = RateLimiter(connection_rate=1.0, connection_burst=2, user_rate=1.0, user_burst=3, clock=clock)
+        first, second, other = limiter.connection_bucket(), limiter.connection_bucket(), limiter.connection_bucket()
+        self.assertEqual([limiter.take(first, 1) for _ in range(3)], [0.0, 0.0, 1.0])
+        # a second tab has its own connection budget but shares the user's
+        self.assertEqual(limiter.take(second, 1), 0.0)
+        self.assertEqual(limiter.take(second, 1), 1.0)
+        # the frame the user bucket refused isn't charged to the connection
+        self.assertEqual(second.tokens, 1)
+        self.assertEqual(limiter.take(other, 2), 0.0)
+
+        clock.now = 1.0
+        self.assertEqual(limiter.take(second, 1), 0.0)
+        self.assertEqual(limiter.take(second, 1), 1.0)
+
+    def test_idle_users_are_pruned(self):
+        clock = FakeClock()
+        limiter = RateLimiter(connection_rate=1.0, connection_burst=5, user_rate=1.0, user_burst=5, clock=clock)
+        limiter._prune_at = 2
+        limiter.take(limiter.connection_bucket(), 1)
+        clock.now = 3.0
+        connection = limiter.connection_bucket()
+        for _ in range(3):
+            limiter.take(connection, 2)
+        # user 1 has refilled completely, user 2 is still two tokens short
+        clock.now = 4.0
+        limiter.take(limiter.connection_bucket(), 3)
+        self.assertEqual(set(limiter.users), {2, 3})
+
+
+class OutboxDispatchTests(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.failing = set()
+        outer = self
+
+        class Layer:
+            async def group_send(self, group, message):
+                if message['id'] in outer.failing:
+                    raise ConnectionError('layer down')
+                outer.sent.append(message['id'])
+
+        patcher = mock.patch('chatapp.outbox.get_channel_layer', return_value=Layer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def publish(self, group, n):
+        return OutboxEvent.objects.create(group=group, payload={'type': 'notice', 'id': n})
+
+    def test_failed_event_backs_off_and_holds_back_its_group(self):
+        a1, a2, b1 = self.publish('a', 1), self.publish('a', 2), self.publish('b', 3)
+        self.failing = {1}
+        self.assertEqual(dispatch_pending_events(), 3)
+        self.assertEqual(self.sent, [3])
+        a1.refresh_from_db()
+        self.assertEqual((a1.status, a1.attempts), (OutboxEvent.PENDING, 1))
+        self.assertGreater(a1.next_attempt_at, timezone.now())
+        a2.refresh_from_db()
+        self.assertEqual((a2.status, a2.attempts), (OutboxEvent.PENDING, 0))
+
+        # no retry before the backoff is up, and a2 may not overtake a1
+        self.assertEqual(dispatch_pending_events(), 0)
+        self.failing = set()
+        OutboxEvent.objects.filter(id=a1.id).update(next_attempt_at=timezone.now())
+        self.assertEqual(dispatch_pending_events(), 2)
+        self.assertEqual(self.sent, [3, 1, 2])
+        self.assertFalse(OutboxEvent.objects.filter(status=OutboxEvent.PENDING).exists())
+
+    @override_settings(CHAT_OUTBOX_MAX_ATTEMPTS=1)
+    def test_event_fails_for_good_after_max_attempts(self):
+        a1, a2 = self.publish('a', 1), self.publish('a', 2)
+        self.failing = {1}
+        dispatch_pending_events()
+        a1.refresh_from_db()
+        self.assertEqual(a1.status, OutboxEvent.FAILED)
+        dispatch_pending_events()
+        self.assertEqual(self.sent, [2])
+
+
+@override_settings(CHAT_SEARCH_WORKER='command')
+class MessageIngestTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+
+    def read_state(self, user):
+        return ConversationReadState.objects.get(conversation=self.conversation, user=user)
+
+    def test_post_message_bookkeeping_is_a_fixed_handful_of_statements(self):
+        with CaptureQueriesContext(connection) as queries:
+            message = services.post_message(self.conversation, self.alice, 'hello')
+        # insert, version/summary update, read states, change log (plus savepoints)
+        self.assertLessEqual(len([q for q in queries if 'SAVEPOINT' not in q['sql']]), 4)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.last_message_id, self.conversation.version), (message.id, 1))
+        self.assertEqual(message.change_version, 1)
+        self.assertEqual(self.read_state(self.bob).unread_count, 1)
+        self.assertEqual(self.read_state(self.alice).last_read_id, message.id)
+
+    def test_a_batch_is_recorded_like_messages_posted_one_by_one(self):
+        messages = Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=sender, content=content)
+            for sender, content in [(self.alice, 'a1'), (self.bob, 'b1'), (self.alice, 'a2'), (self.bob, 'b2')]
+        ])
+        services.record_new_messages(messages)
+        self.assertEqual([message.change_version for message in messages], [1, 2, 3, 4])
+        self.assertEqual(list(self.conversation.changes.order_by('version').values_list('message_id', flat=True)),
+                         [message.id for message in messages])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, messages[-1].id)
+        alice, bob = self.read_state(self.alice), self.read_state(self.bob)
+        self.assertEqual((alice.last_read_id, alice.unread_count), (messages[2].id, 1))
+        self.assertEqual((bob.last_read_id, bob.unread_count), (messages[3].id, 0))
+
+    def test_versions_are_read_back_where_update_cannot_return_them(self):
+        with mock.patch('chatapp.services._can_return_from_update', return_value=False), \
+                CaptureQueriesContext(connection) as queries:
+            first = services.post_message(self.conversation, self.alice, 'one')
+            second = services.post_message(self.conversation, self.bob, 'two')
+        self.assertFalse([q for q in queries if 'RETURNING version' in q['sql']])
+        self.assertEqual((first.change_version, second.change_version), (1, 2))
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.version, self.conversation.last_message_id), (2, second.id))
+
+    def test_new_messages_are_indexed_in_batches(self):
+        message = services.post_message(self.conversation, self.alice, 'parcel delivery')
+        self.assertEqual(search.search_messages('parcel'), [])
+        self.assertEqual(search.index_pending_messages(), 1)
+        self.assertEqual(search.search_messages('parcel'), [message.id])
+        self.assertEqual(search.index_pending_messages(), 0)
+
+
+@override_settings(CHAT_SEARCH_WORKER='command', CHAT_OUTBOX_WORKER='command')
+class MessageChangesTests(APITestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        self.url = f'/chats/conversations/{self.conversation.id}/'
+        self.client.force_authenticate(self.alice)
+
+    def post(self, content):
+        response = self.client.post(self.url + 'messages/', {'conversation': self.conversation.id, 'content': content})
+        self.assertEqual(response.status_code, 201)
+        return Message.objects.get(content=content)
+
+    def changes(self, **params):
+        response = self.client.get(self.url + 'changes/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_changes_since_a_version(self):
+        messages = [self.post(f'message {i}') for i in range(3)]
+        body = self.changes()
+        self.assertEqual((body['version'], body['has_more']), (3, False))
+        self.assertEqual([(change['version'], change['kind'], change['id'], change['message']['message'])
+                          for change in body['changes']],
+                         [(i + 1, 'created', message.id, message.content) for i, message in enumerate(messages)])
+
+        body = self.changes(since=1, limit=1)
+        self.assertEqual((body['version'], body['has_more']), (2, True))
+        self.assertEqual([change['id'] for change in body['changes']], [messages[1].id])
+        body = self.changes(since=3)
+        self.assertEqual((body['version'], body['has_more'], body['changes']), (3, False, []))
+
+    def test_deletes_leave_a_tombstone(self):
+        kept, deleted = self.post('kept'), self.post('deleted')
+        response = self.client.delete(self.url + f'messages/{deleted.id}/')
+        self.assertEqual(response.status_code, 204)
+        body = self.changes(since=1)
+        self.assertEqual(body['version'], 3)
+        self.assertEqual([(change['kind'], change['id'], change.get('message')) for change in body['changes']],
+                         [('created', deleted.id, None), ('deleted', deleted.id, None)])
+        self.assertEqual(self.changes(since=2)['changes'], [{'version': 3, 'kind': 'deleted', 'id': deleted.id}])
+        self.assertEqual(self.changes(limit=1)['changes'][0]['message']['id'], kept.id)
+
+    def test_rest_messages_and_deletes_are_published_to_the_sockets(self):
+        message = self.post('hello')
+        self.client.delete(self.url + f'messages/{message.id}/')
+        events = [(event.group, event.payload) for event in OutboxEvent.objects.order_by('id')]
+        self.assertEqual([(group, payload['type'], payload['id']) for group, payload in events],
+                         [(f'chat_{self.conversation.id}', 'chat_message', message.id),
+                          (f'chat_{self.conversation.id}', 'message_deleted', message.id)])
+        self.assertEqual(events[0][1]['version'], 1)
+        self.assertEqual(events[1][1]['version'], 2)
+
+    def test_only_participants_can_read_the_changes(self):
+        self.post('hello')
+        self.client.force_authenticate(User.objects.create(username='outsider'))
+        self.assertEqual(self.client.get(self.url + 'changes/').status_code, 403)
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get(self.url + 'changes/', {'since': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get('/chats/conversations/999999/changes/').status_code, 404)
+
+
+@override_settings(CHAT_SEARCH_WORKER='command', CHAT_OUTBOX_WORKER='command')
+class SearchTests(APITestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.staff])
+
+    def post(self, content):
+        message = services.post_message(self.conversation, self.alice, content)
+        search.index_pending_messages()
+        return message
+
+    def test_backends_implement_the_whole_interface(self):
+        class Partial(search.SearchBackend):
+            def remove(self, kind, object_id):
+                pass
+
+        with self.assertRaises(TypeError):
+            Partial()
+        self.assertIsInstance(search.get_backend(), search.SQLiteSearchBackend)
+
+    def test_messages_are_indexed_updated_and_removed(self):
+        message = self.post('parcel delivery delayed')
+        self.assertEqual(search.search_messages('deliv'), [message.id])
+        self.assertEqual(search.search_messages('parcel delayed'), [message.id])
+        self.assertEqual(search.search_messages('parcel refund'), [])
+
+        message.content = 'refund issued'
+        message.save()
+        self.assertEqual(search.search_messages('parcel'), [])
+        self.assertEqual(search.search_messages('refund'), [message.id])
+
+        services.delete_message(message)
+        self.assertEqual(search.search_messages('refund'), [])
+
+    def test_messages_are_limited_to_the_given_conversations(self):
+        message = self.post('parcel delivery')
+        other = Conversation.objects.create()
+        self.assertEqual(search.search_messages('parcel', conversation_ids=[self.conversation.id]), [message.id])
+        self.assertEqual(search.search_messages('parcel', conversation_ids=[other.id]), [])
+        self.assertEqual(search.search_messages('parcel', conversation_ids=[]), [])
+
+    def test_feedback_is_filtered_by_owner(self):
+        mine = Feedback.objects.create(user=self.alice, subject='Broken parcel', message='It arrived broken')
+        theirs = Feedback.objects.create(user=self.bob, subject='Late parcel', message='It arrived late')
+        self.assertEqual(search.search_feedback('parcel', owner_id=self.alice.id), [mine.id])
+        self.assertEqual(sorted(search.search_feedback('parcel')), [mine.id, theirs.id])
+
+        self.client.force_authenticate(self.alice)
+        response = self.client.get('/chats/search/', {'q': 'parcel', 'type': 'feedback'})
+        self.assertEqual([item['id'] for item in response.json()['feedback']], [mine.id])
+        self.client.force_authenticate(self.staff)
+        response = self.client.get('/chats/search/', {'q': 'parcel', 'type': 'feedback'})
+        self.assertEqual(sorted(item['id'] for item in response.json()['feedback']), [mine.id, theirs.id])
+
+        mine.delete()
+        self.assertEqual(search.search_feedback('parcel'), [theirs.id])
+
+    def test_admin_says_when_matches_were_cut_short(self):
+        for n in range(3):
+            Feedback.objects.create(user=self.alice, subject=f'Parcel {n}', message='Missing')
+        self.client.force_login(User.objects.create_superuser('root', 'root@example.com', 'password'))
+        with mock.patch.object(FeedbackAdmin, 'search_limit', 2):
+            response = self.client.get('/admin/chatapp/feedback/', {'q': 'parcel'})
+        self.assertContains(response, 'Only the 2 best matches are listed')
+        self.assertEqual(response.context['cl'].result_count, 2)
+
+
+@override_settings(CHAT_SEARCH_WORKER='command', CHAT_OUTBOX_WORKER='command')
+class ConversationReadTests(APITestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        self.url = f'/chats/conversations/{self.conversation.id}/read/'
+        self.client.force_authenticate(self.bob)
+
+    def read_state(self, user):
+        return ConversationReadState.objects.get(conversation=self.conversation, user=user)
+
+    def post(self, *contents, sender=None):
+        return [services.post_message(self.conversation, sender or self.alice, content) for content in contents]
+
+    def test_unread_counts_follow_new_messages(self):
+        first, second = self.post('one', 'two')
+        self.assertEqual(self.read_state(self.bob).unread_count, 2)
+        self.assertEqual(self.read_state(self.alice).unread_count, 0)
+        reply, = self.post('three', sender=self.bob)
+        # replying reads everything up to the reply
+        self.assertEqual((self.read_state(self.bob).last_read_id, self.read_state(self.bob).unread_count), (reply.id, 0))
+        self.assertEqual(self.read_state(self.alice).unread_count, 1)
+
+    def test_read_up_to_a_message(self):
+        first, second, third = self.post('one', 'two', 'three')
+        response = self.client.post(self.url, {'message_id': first.id})
+        self.assertEqual(response.json(), {'last_read_id': first.id, 'unread_count': 2})
+        response = self.client.post(self.url)
+        self.assertEqual(response.json(), {'last_read_id': third.id, 'unread_count': 0})
+
+    def test_message_id_must_belong_to_the_conversation(self):
+        self.post('one')
+        other = Conversation.objects.create()
+        other.participants.set([self.alice, self.bob])
+        foreign = services.post_message(other, self.alice, 'elsewhere')
+        for message_id in (foreign.id, foreign.id + 1000):
+            response = self.client.post(self.url, {'message_id': message_id})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual((self.read_state(self.bob).last_read_id, self.read_state(self.bob).unread_count), (0, 1))
+
+    def test_deleting_messages_rewinds_the_summary(self):
+        first, second, third = self.post('one', 'two', 'three')
+        self.client.post(self.url, {'message_id': first.id})
+        services.delete_message(first)
+        # already read: nothing to take back
+        self.assertEqual(self.read_state(self.bob).unread_count, 2)
+        services.delete_message(third)
+        self.assertEqual(self.read_state(self.bob).unread_count, 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, second.id)
+        services.delete_message(second)
+        self.conversation.refresh_from_db()
+        self.assertIsNone(self.conversation.last_message_id)
+        self.assertEqual(self.read_state(self.bob).unread_count, 0)
+
+
+@override_settings(CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60, CHAT_SEARCH_WORKER='command')
+class MessageWriterTests(TransactionTestCase):
+    # the writer saves on the database thread, so the rows have to be committed
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.user])
+
+    def message(self, content, **kwargs):
+        return Message(conversation=self.conversation, sender=self.user, content=content, **kwargs)
+
+    def test_queued_messages_are_written_when_daphne_shuts_down(self):
+        # daphne sends no lifespan events; the writer hooks the reactor's shutdown instead
+        reactor = mock.Mock()
+
+        async def run():
+            writer = persistence.get_message_writer()
+            pending = [asyncio.ensure_future(writer.submit(self.message(f'm{i}'))) for i in range(3)]
+            await asyncio.sleep(0.05)
+            self.assertEqual(await sync_to_async(Message.objects.count)(), 0)
+
+            phase, event, trigger, loop = reactor.addSystemEventTrigger.call_args.args
+            self.assertEqual((phase, event), ('before', 'shutdown'))
+            await trigger(loop).asFuture(loop)
+            return await asyncio.gather(*pending)
+
+        with mock.patch.dict(sys.modules, {'twisted.internet.reactor': reactor}), \
+                mock.patch.object(persistence, '_shutdown_hook_installed', False):
+            saved = async_to_sync(run)()
+        self.assertTrue(all(message.pk for message in saved))
+        self.assertEqual(sorted(Message.objects.values_list('content', flat=True)), ['m0', 'm1', 'm2'])
+
+    def test_one_bad_row_does_not_lose_the_batch(self):
+        existing = Message.objects.create(conversation=self.conversation, sender=self.user, content='existing')
+
+        async def run():
+            writer = persistence.get_message_writer()
+            pending = [
+                asyncio.ensure_future(writer.submit(self.message('first'))),
+                asyncio.ensure_future(writer.submit(self.message('duplicate', uid=existing.uid))),
+                asyncio.ensure_future(writer.submit(self.message('last'))),
+            ]
+            await asyncio.sleep(0)
+            await writer.close()
+            return await asyncio.gather(*pending, return_exceptions=True)
+
+        with self.assertLogs('chatapp.persistence', 'WARNING'):
+            first, duplicate, last = async_to_sync(run)()
+        self.assertTrue(first.pk and last.pk)
+        self.assertIsInstance(duplicate, Exception)
+        self.assertEqual(sorted(Message.objects.values_list('content', flat=True)), ['existing', 'first', 'last'])
+
+    def test_a_full_queue_turns_messages_away(self):
+        async def run():
+            # the long flush interval keeps the queue from draining until close()
+            writer = persistence.MessageWriter(flush_interval=10, max_pending=2, queue_timeout=0.05)
+            pending = [asyncio.ensure_future(writer.submit(self.message(f'm{i}'))) for i in range(4)]
+            await asyncio.sleep(0.2)
+            await writer.close()
+            return writer, await asyncio.gather(*pending, return_exceptions=True)
+
+        writer, results = async_to_sync(run)()
+        # one message is taken off the queue by the writer, two wait in it, the fourth has no room
+        self.assertTrue(all(message.pk for message in results[:3]))
+        self.assertIsInstance(results[3], DatabaseBusy)
+        self.assertEqual(writer.stats()['messages_rejected'], 1)
+        self.assertEqual(sorted(Message.objects.values_list('content', flat=True)), ['m0', 'm1', 'm2'])
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'chatapp.layers.LocalChannelLayer'}},
+                   CHAT_SEARCH_WORKER='command', CHAT_OUTBOX_WORKER='command', CHAT_CATCH_UP_BATCH_SIZE=2)
+class ResumeTests(TransactionTestCase):
+    # sockets run their queries on other threads, so the rows have to be committed
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        self.history = [services.post_message(self.conversation, self.alice, f'old{i}') for i in range(5)]
+
+    def connect(self, user, query=''):
+        from chatsystemapp.asgi import application
+        return WebsocketCommunicator(application, f'/ws/chat/{self.conversation.id}/?token={AccessToken.for_user(user)}{query}')
+
+    async def drain(self, communicator):
+        frames = []
+        while not await communicator.receive_nothing(0.3):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    def test_replay_comes_first_and_live_messages_are_not_repeated(self):
+        get_messages_after = ChatSocketConsumer.get_messages_after.__wrapped__
+
+        def slow_get_messages_after(consumer, *args):
+            # keep the replay running while the live messages go out
+            time.sleep(0.1)
+            return get_messages_after(consumer, *args)
+
+        async def run():
+            bob = self.connect(self.bob)
+            await bob.connect()
+            alice = self.connect(self.alice, f'&last_id={self.history[0].id}')
+            await alice.connect()
+            for i in range(2):
+                await bob.send_json_to({'type': 'chat_message', 'message': f'live{i}'})
+            frames = await self.drain(alice)
+            await alice.disconnect()
+            await bob.disconnect()
+            return frames
+
+        with mock.patch.object(ChatSocketConsumer, 'get_messages_after', db_to_async(slow_get_messages_after)):
+            frames = async_to_sync(run)()
+        received = []
+        for frame in frames:
+            if frame['type'] == 'catch_up':
+                received += [('replay', message['message']) for message in frame['messages']]
+            elif frame['type'] == 'chat_message':
+                received.append(('live', frame['message']))
+        contents = [content for _, content in received]
+        self.assertEqual(contents, ['old1', 'old2', 'old3', 'old4', 'live0', 'live1'])
+        self.assertEqual(received[:4], [('replay', f'old{i}') for i in range(1, 5)])
+
+    @override_settings(CHAT_MESSAGE_RATE=0.001, CHAT_MESSAGE_BURST=2)
+    def test_resume_frames_are_rate_limited(self):
+        async def run():
+            alice = self.connect(self.alice)
+            await alice.connect()
+            await self.drain(alice)
+            frames = []
+            for _ in range(3):
+                await alice.send_json_to({'type': 'resume', 'last_id': self.history[3].id})
+                frames += await self.drain(alice)
+            await alice.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+        self.assertEqual([frame['type'] for frame in frames], ['catch_up', 'catch_up', 'error'])
+        self.assertEqual((frames[2]['code'], frames[2]['event']), ('throttled', 'resume'))
+        self.assertGreater(frames[2]['retry_after'], 0)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'chatapp.layers.LocalChannelLayer'}},
+                   CHAT_SEARCH_WORKER='command', CHAT_OUTBOX_WORKER='command')
+class StreamConsumerTests(TransactionTestCase):
+    # sockets run their queries on other threads, so the rows have to be committed
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.first, self.second = Conversation.objects.create(), Conversation.objects.create()
+        for conversation in (self.first, self.second):
+            conversation.participants.set([self.alice, self.bob])
+
+    def connect(self, path, user, token=None):
+        from chatsystemapp.asgi import application
+        return WebsocketCommunicator(application, f'{path}?token={token or AccessToken.for_user(user)}')
+
+    async def drain(self, communicator):
+        frames = []
+        while not await communicator.receive_nothing(0.3):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    async def notify(self, user, payload):
+        group = f'user_{user.id}'
+        await get_channel_layer().group_send(group, group_event(payload, group))
+
+    def test_frames_are_routed_per_stream(self):
+        first, second = f'chat.{self.first.id}', f'chat.{self.second.id}'
+
+        async def run():
+            alice = self.connect('/ws/stream/', self.alice)
+            bob = self.connect('/ws/stream/', self.bob)
+            for communicator, user in ((alice, self.alice), (bob, self.bob)):
+                await communicator.connect()
+                await communicator.send_json_to({'type': 'subscribe', 'streams': [first, second, 'notifications']})
+            subscribed = [(frame['stream'], frame['type']) for frame in await self.drain(bob)]
+            await self.drain(alice)
+
+            await alice.send_json_to({'stream': first, 'type': 'chat_message', 'message': 'to first'})
+            await alice.send_json_to({'stream': second, 'type': 'chat_message', 'message': 'to second'})
+            await self.notify(self.bob, {'type': 'feedback_update', 'id': 7})
+            live = await self.drain(bob)
+
+            await bob.send_json_to({'type': 'unsubscribe', 'stream': second})
+            unsubscribed = await self.drain(bob)
+            await alice.send_json_to({'stream': first, 'type': 'chat_message', 'message': 'first again'})
+            await alice.send_json_to({'stream': second, 'type': 'chat_message', 'message': 'second again'})
+            after = await self.drain(bob)
+            await bob.send_json_to({'stream': second, 'type': 'chat_message', 'message': 'not subscribed'})
+            refused = await self.drain(bob)
+            await alice.disconnect()
+            await bob.disconnect()
+            return subscribed, live, unsubscribed, after, refused
+
+        subscribed, live, unsubscribed, after, refused = async_to_sync(run)()
+        self.assertIn((first, 'subscribed'), subscribed)
+        self.assertIn((second, 'subscribed'), subscribed)
+        self.assertIn(('notifications', 'subscribed'), subscribed)
+        messages = [(frame['stream'], frame.get('message')) for frame in live if frame['type'] == 'chat_message']
+        self.assertEqual(messages, [(first, 'to first'), (second, 'to second')])
+        self.assertIn(('notifications', 7), [(frame['stream'], frame.get('id')) for frame in live
+                                             if frame['type'] == 'feedback_update'])
+        self.assertEqual([(frame['stream'], frame['type']) for frame in unsubscribed], [(second, 'unsubscribed')])
+        messages = [(frame['stream'], frame.get('message')) for frame in after if frame['type'] == 'chat_message']
+        self.assertEqual(messages, [(first, 'first again')])
+        self.assertEqual([(frame['stream'], frame['code']) for frame in refused], [(second, 'not_subscribed')])
+
+    def test_notifications_socket_authenticates_like_the_chat_sockets(self):
+        async def run():
+            socket = self.connect('/ws/notifications/', self.bob)
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            await self.notify(self.bob, {'type': 'feedback_update', 'id': 7})
+            await self.notify(self.alice, {'type': 'feedback_update', 'id': 8})
+            frames = await self.drain(socket)
+            await socket.disconnect()
+
+            codes = []
+            for token in ('not-a-token', deleted_users_token):
+                socket = self.connect('/ws/notifications/', None, token=token)
+                codes.append((await socket.connect())[1])
+            return frames, codes
+
+        deleted = User.objects.create(username='deleted')
+        deleted_users_token = AccessToken.for_user(deleted)
+        deleted.delete()
+        frames, codes = async_to_sync(run)()
+        self.assertEqual(frames, [{'type': 'feedback_update', 'id': 7}])
+        self.assertEqual(codes, [4001, 4001])
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'chatapp.layers.LocalChannelLayer'}},
+                   CHAT_SEARCH_WORKER='command', CHAT_OUTBOX_WORKER='command')
+class ChatConsumerTests(TransactionTestCase):
+    # sockets run their queries on other threads, so the rows have to be committed
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        # importing the application runs django.setup(), which resets logging; do it before any assertLogs
+        from chatsystemapp.asgi import application
+        self.application = application
+
+    def connect(self, user):
+        return WebsocketCommunicator(self.application, f'/ws/chat/{self.conversation.id}/?token={AccessToken.for_user(user)}')
+
+    async def drain(self, communicator, timeout=0.3):
+        frames = []
+        while not await communicator.receive_nothing(timeout):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    def test_sockets_revalidate_cached_users(self):
+        async def connect_code(user):
+            socket = self.connect(user)
+            connected, code = await socket.connect()
+            if connected:
+                await socket.disconnect()
+                return 'accepted'
+            return code
+
+        self.addCleanup(user_cache.clear)
+        self.assertEqual(async_to_sync(connect_code)(self.alice), 'accepted')
+        # an update made elsewhere sends no signal to this process
+        User.objects.filter(id=self.alice.id).update(is_active=False)
+        self.assertEqual(async_to_sync(connect_code)(self.alice), 'accepted')
+        with override_settings(CHAT_AUTH_USER_MAX_AGE=0):
+            self.assertEqual(async_to_sync(connect_code)(self.alice), 4001)
+        self.bob.is_active = False
+        self.bob.save()
+        self.assertEqual(async_to_sync(connect_code)(self.bob), 4001)
+
+    def test_membership_is_checked_once_on_connect(self):
+        outsider = User.objects.create(username='outsider')
+        get_conversation = ChatSocketConsumer.get_conversation.__wrapped__
+        lookups = []
+
+        def counted_get_conversation(consumer, conversation_id):
+            lookups.append(conversation_id)
+            return get_conversation(consumer, conversation_id)
+
+        async def run():
+            codes = []
+            for user, conversation_id in ((outsider, self.conversation.id), (self.alice, 999999)):
+                socket = WebsocketCommunicator(self.application, f'/ws/chat/{conversation_id}/?token={AccessToken.for_user(user)}')
+                codes.append((await socket.connect())[1])
+            alice = self.connect(self.alice)
+            await alice.connect()
+            for i in range(3):
+                await alice.send_json_to({'type': 'chat_message', 'message': f'message {i}'})
+            await self.drain(alice)
+            await alice.disconnect()
+            return codes
+
+        with mock.patch.object(ChatSocketConsumer, 'get_conversation', db_to_async(counted_get_conversation)):
+            codes = async_to_sync(run)()
+        self.assertEqual(codes, [4003, 4004])
+        # one lookup per connection; messages reuse the conversation resolved on connect
+        self.assertEqual(len(lookups), 3)
+        self.assertEqual(Message.objects.filter(conversation=self.conversation).count(), 3)
+
+    def test_messages_must_be_non_empty_strings(self):
+        frames = [
+            {'type': 'chat_message', 'message': ['evil', 'list'], 'temp_id': 't1'},
+            {'type': 'chat_message', 'message': {'evil': 'object'}, 'temp_id': 't2'},
+            {'type': 'chat_message', 'message': None, 'temp_id': 't3'},
+            {'type': 'chat_message', 'temp_id': 't4'},
+            {'type': 'chat_message', 'message': '   ', 'temp_id': 't5'},
+        ]
+
+        async def run():
+            alice, bob = self.connect(self.alice), self.connect(self.bob)
+            for communicator in (alice, bob):
+                await communicator.connect()
+                await self.drain(communicator)
+            for frame in frames:
+                await alice.send_json_to(frame)
+            errors = await self.drain(alice)
+            seen_by_bob = await self.drain(bob)
+            await alice.send_json_to({'type': 'chat_message', 'message': '  hello  ', 'temp_id': 't6'})
+            sent = await self.drain(bob)
+            await alice.disconnect()
+            await bob.disconnect()
+            return errors, seen_by_bob, sent
+
+        errors, seen_by_bob, sent = async_to_sync(run)()
+        self.assertEqual([(frame['code'], frame['event'], frame['temp_id']) for frame in errors if frame['type'] == 'error'],
+                         [('invalid', 'chat_message', f't{i}') for i in range(1, 6)])
+        self.assertEqual([frame for frame in seen_by_bob if frame['type'] == 'chat_message'], [])
+        # what was broadcast is what was saved
+        self.assertEqual([frame['message'] for frame in sent if frame['type'] == 'chat_message'], ['hello'])
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['hello'])
+
+    @override_settings(CHAT_PRESENCE_FLUSH_INTERVAL=0.5)
+    def test_presence_snapshot_then_batched_deltas(self):
+        carol = User.objects.create(username='carol')
+        self.conversation.participants.add(carol)
+
+        def names(frame):
+            return sorted(user['username'] for user in frame['online_users'])
+
+        async def run():
+            alice = self.connect(self.alice)
+            await alice.connect()
+            joined = await self.drain(alice, timeout=0.8)
+            bob, carol_socket = self.connect(self.bob), self.connect(carol)
+            await bob.connect()
+            await carol_socket.connect()
+            bob_snapshot = await bob.receive_json_from()
+            arrivals = await self.drain(alice, timeout=0.8)
+            # dropping and reconnecting within the window is not news
+            await bob.disconnect()
+            bob = self.connect(self.bob)
+            await bob.connect()
+            blips = await self.drain(alice, timeout=0.8)
+            await bob.disconnect()
+            await carol_socket.disconnect()
+            departures = await self.drain(alice, timeout=0.8)
+            await alice.disconnect()
+            return joined, bob_snapshot, arrivals, blips, departures
+
+        joined, bob_snapshot, arrivals, blips, departures = async_to_sync(run)()
+        self.assertEqual((joined[0]['snapshot'], names(joined[0])), (True, ['alice']))
+        self.assertEqual((bob_snapshot['snapshot'], names(bob_snapshot)), (True, ['alice', 'bob']))
+        self.assertEqual([(frame['status'], names(frame)) for frame in arrivals], [('online', ['bob', 'carol'])])
+        self.assertEqual(blips, [])
+        self.assertEqual([(frame['status'], names(frame)) for frame in departures], [('offline', ['bob', 'carol'])])
+
+    @override_settings(CHAT_TYPING_WINDOW=10, CHAT_TYPING_TIMEOUT=0.3)
+    def test_typing_is_coalesced_into_one_start_and_one_stop(self):
+        typing = {'type': 'typing', 'receiver': self.bob.id}
+
+        async def run():
+            alice, bob = self.connect(self.alice), self.connect(self.bob)
+            for communicator in (alice, bob):
+                await communicator.connect()
+                await self.drain(communicator)
+            for _ in range(5):
+                await alice.send_json_to(typing)
+            # the longer wait lets the stop timer fire
+            timed_out = await self.drain(bob, timeout=0.6)
+            await alice.send_json_to(typing)
+            await alice.send_json_to({**typing, 'is_typing': False})
+            stopped = await self.drain(bob, timeout=0.6)
+            await alice.disconnect()
+            await bob.disconnect()
+            return timed_out, stopped
+
+        timed_out, stopped = async_to_sync(run)()
+        for frames in (timed_out, stopped):
+            self.assertEqual([(frame['type'], frame['user']['id'], frame['is_typing']) for frame in frames
+                              if frame['type'] != 'online_status'],
+                             [('typing', self.alice.id, True), ('typing', self.alice.id, False)])
+
+    def test_group_events_are_encoded_once_for_every_recipient(self):
+        from chatapp import encoding
+        carol = User.objects.create(username='carol')
+        self.conversation.participants.add(carol)
+
+        async def run():
+            sockets = [self.connect(user) for user in (self.alice, self.bob, carol)]
+            for socket in sockets:
+                await socket.connect()
+            for socket in sockets:
+                await self.drain(socket)
+            with mock.patch('chatapp.encoding.dumps', wraps=encoding.dumps) as dumps:
+                await sockets[0].send_json_to({'type': 'chat_message', 'message': 'hello everyone'})
+                texts = []
+                for socket in sockets:
+                    frames = [await socket.receive_from()]
+                    while not await socket.receive_nothing(0.3):
+                        frames.append(await socket.receive_from())
+                    texts += [text for text in frames if '"chat_message"' in text]
+            for socket in sockets:
+                await socket.disconnect()
+            return texts, [call.args[0] for call in dumps.call_args_list]
+
+        texts, encoded = async_to_sync(run)()
+        self.assertEqual(len(texts), 3)
+        self.assertEqual(len(set(texts)), 1)
+        self.assertEqual(json.loads(texts[0])['message'], 'hello everyone')
+        self.assertEqual([payload['type'] for payload in encoded if payload['type'] == 'chat_message'], ['chat_message'])
+
+
+    async def exchange(self, *frames):
+        """Send `frames` from alice and return what alice and bob saw."""
+        alice, bob = self.connect(self.alice), self.connect(self.bob)
+        for communicator in (alice, bob):
+            await communicator.connect()
+            await self.drain(communicator)
+        for frame in frames:
+            await alice.send_json_to(frame)
+        seen = [[frame for frame in await self.drain(communicator) if frame['type'] != 'online_status']
+                for communicator in (alice, bob)]
+        await alice.disconnect()
+        await bob.disconnect()
+        return seen
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_a_full_write_behind_queue_asks_the_client_to_retry(self):
+        with mock.patch.object(persistence.MessageWriter, 'submit', side_effect=DatabaseBusy(retry_after=1.0)), \
+                self.assertLogs('chatapp.consumers', 'WARNING'):
+            seen_by_alice, seen_by_bob = async_to_sync(self.exchange)({'type': 'chat_message', 'message': 'hi', 'temp_id': 't1'})
+        self.assertEqual([(frame['type'], frame['code'], frame['temp_id'], frame['retry_after']) for frame in seen_by_alice],
+                         [('error', 'busy', 't1', 1.0)])
+        self.assertEqual(seen_by_bob, [])
+
+    @override_settings(CHAT_BROADCAST_BEFORE_PERSIST=True)
+    def test_broadcast_before_persist_acks_with_the_database_id(self):
+        seen_by_alice, seen_by_bob = async_to_sync(self.exchange)(
+            {'type': 'chat_message', 'message': ' hi ', 'temp_id': 't1'},
+            {'type': 'chat_message', 'message': {'evil': 'object'}, 'temp_id': 't2'},
+        )
+        message = Message.objects.get()
+        self.assertEqual(message.content, 'hi')
+        self.assertEqual([frame['type'] for frame in seen_by_bob], ['chat_message', 'message_persisted'])
+        pending, persisted = seen_by_bob
+        self.assertEqual((pending['uid'], pending['message'], pending['pending'], pending['temp_id']),
+                         (message.uid, 'hi', True, 't1'))
+        self.assertNotIn('id', pending)
+        self.assertEqual((persisted['uid'], persisted['id'], persisted['temp_id']), (message.uid, message.id, 't1'))
+        # the sender gets the same pair, and the invalid frame only comes back to it as an error
+        self.assertEqual(sorted(frame['type'] for frame in seen_by_alice), ['chat_message', 'error', 'message_persisted'])
+
+    @override_settings(CHAT_BROADCAST_BEFORE_PERSIST=True)
+    def test_broadcast_before_persist_reports_failed_writes(self):
+        with mock.patch.object(ChatSocketConsumer, 'create_message', side_effect=RuntimeError('disk full')), \
+                self.assertLogs('chatapp.consumers', 'ERROR'):
+            _, seen_by_bob = async_to_sync(self.exchange)({'type': 'chat_message', 'message': 'hi', 'temp_id': 't1'})
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual([frame['type'] for frame in seen_by_bob], ['chat_message', 'message_failed'])
+        pending, failed = seen_by_bob
+        self.assertEqual((failed['uid'], failed['temp_id']), (pending['uid'], 't1'))
+
+@override_settings(CHAT_MAIL_WORKER='command', CHAT_OUTBOX_WORKER='command', CHAT_SEARCH_WORKER='command',
+                   CHAT_MAIL_RETENTION_DAYS=7, CHAT_OUTBOX_RETENTION_DAYS=7)
+class WorkerRetentionTests(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.old = self.now - timedelta(days=8)
+        self.recent = self.now - timedelta(days=1)
+
+    def email(self, status, sent_at=None):
+        return OutboundEmail.objects.create(recipient='a@example.com', subject='Subject', body='Body',
+                                            status=status, sent_at=sent_at)
+
+    def event(self, status, dispatched_at=None):
+        return OutboxEvent.objects.create(group='g', payload={'type': 'notice'}, status=status,
+                                          dispatched_at=dispatched_at)
+
+    def test_only_old_sent_mail_and_dispatched_events_are_pruned(self):
+        kept_emails = [self.email(OutboundEmail.SENT, self.recent), self.email(OutboundEmail.FAILED),
+                       self.email(OutboundEmail.PENDING)]
+        self.email(OutboundEmail.SENT, self.old)
+        kept_events = [self.event(OutboxEvent.DISPATCHED, self.recent), self.event(OutboxEvent.FAILED),
+                       self.event(OutboxEvent.PENDING)]
+        self.event(OutboxEvent.DISPATCHED, self.old)
+
+        self.assertEqual(prune_sent_mail(), 1)
+        self.assertEqual(prune_dispatched_events(), 1)
+        self.assertEqual(set(OutboundEmail.objects.all()), set(kept_emails))
+        self.assertEqual(set(OutboxEvent.objects.all()), set(kept_events))
+        self.assertEqual(prune_sent_mail(days=0), 1)
+
+    def test_rows_are_deleted_in_batches(self):
+        for _ in range(5):
+            self.event(OutboxEvent.DISPATCHED, self.old)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(delete_in_batches(OutboxEvent.objects.all(), batch_size=2), 5)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('DELETE')]), 3)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_workers_prune_on_their_first_poll_then_every_interval(self):
+        prune = mock.Mock(return_value=0)
+        worker = BackgroundWorker('test', lambda batch_size: 0, batch_size=10, prune=prune, prune_interval=3600)
+        worker.prune_if_due()
+        worker.prune_if_due()
+        self.assertEqual(prune.call_count, 1)
+        with mock.patch('chatapp.workers.time.monotonic', return_value=time.monotonic() + 3601):
+            worker.prune_if_due()
+        self.assertEqual(prune.call_count, 2)
+
+    def test_commands_drain_the_backlog_and_prune(self):
+        self.email(OutboundEmail.SENT, self.old)
+        queue_mail('Subject', 'Body', ['b@example.com'])
+        self.event(OutboxEvent.DISPATCHED, self.recent)
+        conversation = Conversation.objects.create()
+        user = User.objects.create(username='user')
+        conversation.participants.set([user])
+        services.post_message(conversation, user, 'parcel')
+
+        outputs = {}
+        with mock.patch('chatapp.outbox.get_channel_layer'):
+            for command, options in (('send_queued_mail', {}), ('dispatch_outbox', {'prune_days': 0}),
+                                     ('index_search', {'batch_size': 1})):
+                out = io.StringIO()
+                call_command(command, stdout=out, **options)
+                outputs[command] = out.getvalue().splitlines()
+        self.assertEqual(outputs['send_queued_mail'], ['1 sent email(s) pruned', '1 email(s) processed'])
+        self.assertEqual(outputs['dispatch_outbox'], ['1 dispatched event(s) pruned', '0 event(s) processed'])
+        self.assertEqual(outputs['index_search'], ['1 message(s) indexed'])
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class MailWorkerTests(TransactionTestCase):
+
+    def test_mail_is_sent_outside_a_transaction_with_the_rows_claimed(self):
+        seen = []
+
+        def send(message):
+            email = OutboundEmail.objects.get()
+            seen.append((connection.in_atomic_block, email.next_attempt_at > timezone.now()))
+            return 1
+
+        with mock.patch('chatapp.mail.mail_worker.wake'), \
+                mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=send):
+            queue_mail('Subject', 'Body', ['a@example.com'])
+            self.assertEqual(deliver_due_mail(), 1)
+        # no transaction (or row lock) held during SMTP, and another worker would skip the row
+        self.assertEqual(seen, [(False, True)])
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.SENT)
+
+    def test_servers_poll_the_outboxes_at_startup(self):
+        for start_workers in (False, True):
+            with override_settings(CHAT_START_WORKERS=start_workers), \
+                    mock.patch('chatapp.mail.mail_worker.wake') as mail_wake, \
+                    mock.patch('chatapp.outbox.event_dispatcher.wake') as outbox_wake, \
+                    mock.patch('chatapp.search.message_indexer.wake') as search_wake:
+                apps.get_app_config('chatapp').ready()
+            # only processes told they are servers start polling; commands and test runners don't
+            for wake in (mail_wake, outbox_wake, search_wake):
+                self.assertEqual(wake.call_count, int(start_workers))
@@ -9,9 +9,13 @@ urlpatterns = [
     path('auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('auth/me/', CurrentUserView.as_view(), name='current_user'),
     path('conversations/', ConversationListCreateView.as_view(), name='conversation_list'),
+    path('conversations/<int:conversation_id>/read/', ConversationReadView.as_view(), name='conversation_read'),
     path('conversations/<int:conversation_id>/messages/', MessageListCreateView.as_view(), name='message_list_create'),
+    path('conversations/<int:conversation_id>/changes/', MessageChangesView.as_view(), name='message_changes'),
     path('conversations/<int:conversation_id>/messages/<int:pk>/', MessageRetrieveDestroyView.as_view(), name='message_detail_destroy'),
     path('feedback/', FeedbackListCreateView.as_view(), name='feedback_list_create'),
     path('feedback/<int:pk>/', FeedbackRetrieveUpdateView.as_view(), name='feedback_detail_update'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     
 ]
\ No newline at end of file
@@ -1,16 +1,29 @@
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from .models import *
 from .serializers import *
-from rest_framework.exceptions import PermissionDenied
-from django.core.mail import send_mail
+from .pagination import FeedbackCursorPagination, MessageKeysetPagination
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from .cache import staff_directory
+from .mail import queue_mail
+from .outbox import publish
+from .services import changes_since, delete_message, post_message
+from . import search
 from django.conf import settings
 from rest_framework.views import APIView
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, time as dt_time
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 
 class CurrentUserView(APIView):
@@ -21,6 +34,15 @@ class CurrentUserView(APIView):
         return Response(serializer.data)
 
 
+class MetricsView(APIView):
+    """Per-process counters of the realtime subsystems (staff only)."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        from . import metrics
+        return Response(metrics.snapshot())
+
+
 class CreateUserView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -45,80 +67,141 @@ class ConversationListCreateView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
+        # the inbox: summaries are denormalized on the conversation, so this is one query
+        # (plus the participants prefetch) however many messages each conversation holds
+        unread = (ConversationReadState.objects
+                  .filter(conversation=OuterRef('pk'), user=self.request.user)
+                  .values('unread_count')[:1])
         return (Conversation.objects
                 .filter(participants=self.request.user)
-                .prefetch_related('participants'))
+                .select_related('last_message__sender')
+                .annotate(unread_count=Coalesce(Subquery(unread), 0))
+                .order_by('-last_activity_at', '-id'))
 
     def create(self, request, *args, **kwargs):
         participants_data = request.data.get('participants', [])
 
-        if len(participants_data) != 2:
+        try:
+            participant_ids = {int(user_id) for user_id in participants_data}
+        except (TypeError, ValueError):
+            participant_ids = set()
+        if len(participants_data) != 2 or len(participant_ids) != 2:
             return Response(
                 {'error': 'A conversation needs exactly two participants'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        if str(request.user.id) not in map(str, participants_data):
+        if request.user.id not in participant_ids:
             return Response(
                 {'error': 'You are not a participant of this conversation'},
                 status=status.HTTP_403_FORBIDDEN
             )
-        users = User.objects.filter(id__in=participants_data)
-        if users.count() != 2:
+        other_id, = participant_ids - {request.user.id}
+        # read from the row, not the staff directory cache: this is an authorization decision
+        other = User.objects.filter(id=other_id).values('is_staff', 'is_superuser').first()
+        if other is None:
             return Response(
                 {'error': 'A conversation needs exactly two participants'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        existing_conversation = Conversation.objects.filter(
-            participants__id=participants_data[0]
-        ).filter(
-            participants__id=participants_data[1]
-        ).distinct()
-
-        if existing_conversation.exists():
-            return Response(
-                {'error': 'A conversation already exists between these participants'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
         # Enforce that regular users can only start conversations with admins
-        other_user = users.exclude(id=request.user.id).first()
-        if other_user is None:
-            return Response({'error': 'Invalid participants'}, status=status.HTTP_400_BAD_REQUEST)
-
         if not (request.user.is_staff or request.user.is_superuser):
             # current user is a normal user; the other participant must be staff
-            if not other_user.is_staff and not other_user.is_superuser:
+            if not (other['is_staff'] or other['is_superuser']):
                 return Response({'error': 'You can only start conversations with an admin'}, status=status.HTTP_403_FORBIDDEN)
 
-        conversation = Conversation.objects.create()
-        conversation.participants.set(users)
+        # the unique participant_key turns check-then-insert into one race-free get-or-create
+        with transaction.atomic():
+            conversation, created = Conversation.objects.get_or_create(
+                participant_key=Conversation.pair_key(request.user.id, other_id))
+            if created:
+                conversation.participants.add(*participant_ids)
+        if not created:
+            # the client can open the existing conversation instead
+            return Response(
+                {'error': 'A conversation already exists between these participants', 'conversation_id': conversation.id},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         #serialize the conversation
         serializer = self.get_serializer(conversation)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+class ConversationReadView(APIView):
+    """Read receipt: marks the conversation read up to `message_id` (default: the latest message)."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, conversation_id, *args, **kwargs):
+        conversation = get_object_or_404(Conversation, id=conversation_id)
+        if request.user not in conversation.participants.all():
+            raise PermissionDenied('You are not a participant of this conversation')
+        message_id = request.data.get('message_id')
+        if message_id:
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                raise ValidationError({'message_id': 'Must be a message id'})
+            # ids are global, so one from another conversation (or from the future) would hide unread messages
+            if not conversation.messages.filter(id=message_id).exists():
+                raise ValidationError({'message_id': 'Not a message in this conversation'})
+        else:
+            message_id = conversation.last_message_id or 0
+
+        with transaction.atomic():
+            state, _ = ConversationReadState.objects.select_for_update().get_or_create(
+                conversation=conversation, user=request.user)
+            if message_id > state.last_read_id:
+                state.last_read_id = message_id
+            state.unread_count = (conversation.messages
+                                  .filter(id__gt=state.last_read_id)
+                                  .exclude(sender=request.user)
+                                  .count())
+            state.save(update_fields=['last_read_id', 'unread_count', 'updated_at'])
+            publish(f'chat_{conversation.id}', {
+                'type': 'read_receipt',
+                'conversation_id': conversation.id,
+                'user_id': request.user.id,
+                'last_read_id': state.last_read_id,
+            })
+        return Response({'last_read_id': state.last_read_id, 'unread_count': state.unread_count})
+
+
 class MessageListCreateView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageKeysetPagination
 
     def get_queryset(self):
         conversation_id = self.kwargs['conversation_id']
         conversation = self.get_conversation(conversation_id)
 
-        return conversation.messages.order_by('timestamp')
+        # messages fetched through the related manager reuse `conversation` (and its prefetched
+        # participants) instead of loading it again per row
+        return conversation.messages.select_related('sender').order_by('timestamp', 'id')
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
             return CreateMessageSerializer
+        if self.request.query_params.get('slim') in ('1', 'true'):
+            return MessageSlimSerializer
         return MessageSerializer
 
     def perform_create(self, serializer):
         #fetch conversation and validate user participation
-        print("Incoming conversation", self.request.data)
+        started = time.perf_counter()
         conversation_id = self.kwargs['conversation_id']
         conversation = self.get_conversation(conversation_id)
 
-        serializer.save(sender=self.request.user, conversation=conversation)
+        # same ingest path as websocket messages; connected sockets get it once this commits
+        message = post_message(conversation, self.request.user, serializer.validated_data['content'], broadcast=True)
+        serializer.instance = message
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('message created', extra={
+                'conversation_id': conversation.id,
+                'user_id': self.request.user.id,
+                'message_id': message.id,
+                'latency_ms': round((time.perf_counter() - started) * 1000, 3),
+            })
 
     def get_conversation(self, conversation_id):
         #check if user is a participant of the conversation, it helps to fetch the conversation and 
@@ -134,22 +217,131 @@ class MessageRetrieveDestroyView(generics.RetrieveDestroyAPIView):
 
     def get_queryset(self):
         conversation_id = self.kwargs['conversation_id']
-        return Message.objects.filter(conversation__id=conversation_id)
+        return Message.objects.filter(conversation__id=conversation_id).select_related('sender')
 
     def perform_destroy(self, instance):
         if instance.sender != self.request.user:
             raise PermissionDenied('You are not the sender of this message')
-        instance.delete()
+        delete_message(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class MessageChangesView(APIView):
+    """Incremental sync: `?since=<version>&limit=N` returns the conversation's changes after `since`.
+
+    Clients keep the returned `version` and pass it as `since` next time; a
+    `deleted` entry is a tombstone for a message they may still be showing.
+    """
+    permission_classes = [IsAuthenticated]
+    default_limit = 200
+    max_limit = 1000
+
+    def get(self, request, conversation_id, *args, **kwargs):
+        conversation = get_object_or_404(Conversation, id=conversation_id)
+        if request.user not in conversation.participants.all():
+            raise PermissionDenied('You are not a participant of this conversation')
+        try:
+            since = max(0, int(request.query_params.get('since', 0)))
+            limit = max(1, min(int(request.query_params.get('limit', self.default_limit)), self.max_limit))
+        except ValueError:
+            raise ValidationError({'error': '`since` and `limit` must be integers'})
+
+        changes, has_more = changes_since(conversation, since, limit)
+        return Response({
+            'version': changes[-1]['version'] if changes else conversation.version,
+            'has_more': has_more,
+            'changes': changes,
+        })
+
+
+class SearchView(APIView):
+    """Ranked full-text search: `?q=<terms>&type=messages|feedback&limit=N`.
+
+    Messages are limited to the caller's conversations; feedback to their own
+    submissions unless they are staff.
+    """
+    permission_classes = [IsAuthenticated]
+    max_limit = 100
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'This parameter is required'})
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), self.max_limit))
+        except ValueError:
+            raise ValidationError({'limit': 'Must be an integer'})
+        kinds = request.query_params.getlist('type') or ['messages', 'feedback']
+        user = request.user
+        results = {}
+
+        if 'messages' in kinds:
+            conversation_ids = list(user.conversations.values_list('id', flat=True))
+            ids = search.search_messages(query, limit=limit, conversation_ids=conversation_ids)
+            messages = Message.objects.filter(id__in=ids, conversation_id__in=conversation_ids).select_related('sender').in_bulk()
+            results['messages'] = MessageSlimSerializer([messages[i] for i in ids if i in messages], many=True).data
+
+        if 'feedback' in kinds:
+            is_admin = user.is_staff or user.is_superuser
+            ids = search.search_feedback(query, limit=limit, owner_id=None if is_admin else user.id)
+            feedback = Feedback.objects.filter(id__in=ids).select_related('user')
+            if not is_admin:
+                feedback = feedback.filter(user=user)
+            feedback = feedback.in_bulk()
+            results['feedback'] = FeedbackSerializer([feedback[i] for i in ids if i in feedback], many=True).data
+
+        return Response(results)
+
+
 class FeedbackListCreateView(generics.ListCreateAPIView):
+    """Feedback inbox, newest first and cursor paginated.
+
+    Filters: `status` and `type` (repeatable), `created_after` / `created_before`
+    (ISO date or datetime).
+    """
     permission_classes = [IsAuthenticated]
+    pagination_class = FeedbackCursorPagination
 
     def get_queryset(self):
         if self.request.user.is_staff or self.request.user.is_superuser:
-            return Feedback.objects.all().order_by('-created_at')
-        return Feedback.objects.filter(user=self.request.user).order_by('-created_at')
+            queryset = Feedback.objects.all()
+        else:
+            queryset = Feedback.objects.filter(user=self.request.user)
+        return self.filter_inbox(queryset.select_related('user')).order_by('-created_at', '-id')
+
+    def filter_inbox(self, queryset):
+        params = self.request.query_params
+        statuses = params.getlist('status')
+        if statuses:
+            queryset = queryset.filter(status__in=statuses)
+        types = params.getlist('type')
+        if types:
+            queryset = queryset.filter(type__in=types)
+        created_after = self.parse_date_param('created_after')
+        if created_after is not None:
+            queryset = queryset.filter(created_at__gte=created_after)
+        created_before = self.parse_date_param('created_before')
+        if created_before is not None:
+            queryset = queryset.filter(created_at__lt=created_before)
+        return queryset
+
+    def parse_date_param(self, name):
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        try:
+            parsed = parse_datetime(value)
+            day = parse_date(value) if parsed is None else None
+        except ValueError:
+            # well formed but out of range, e.g. month 13
+            parsed = day = None
+        if parsed is None:
+            if day is None:
+                raise ValidationError({name: 'Expected an ISO date or datetime'})
+            parsed = datetime.combine(day, dt_time.min)
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -159,16 +351,12 @@ class FeedbackListCreateView(generics.ListCreateAPIView):
     def perform_create(self, serializer):
         feedback = serializer.save(user=self.request.user)
 
-        # notify admins by email (development: console backend will print)
-        admin_emails = list(User.objects.filter(is_superuser=True, email__isnull=False).values_list('email', flat=True))
+        # notify admins by email; queued here and delivered by the mail worker after commit
+        admin_emails = staff_directory.superuser_emails()
         if admin_emails:
             subject = f"New {feedback.get_type_display()} submitted: {feedback.subject}"
             message = f"A new {feedback.get_type_display()} has been submitted by {self.request.user.username or feedback.name}\n\nSubject: {feedback.subject}\n\nMessage:\n{feedback.message}\n\nView in admin to respond and change status."
-            from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None) or None
-            try:
-                send_mail(subject, message, from_email, admin_emails, fail_silently=True)
-            except Exception:
-                pass
+            queue_mail(subject, message, admin_emails)
 
 
 class FeedbackRetrieveUpdateView(generics.RetrieveUpdateAPIView):
@@ -185,34 +373,27 @@ class FeedbackRetrieveUpdateView(generics.RetrieveUpdateAPIView):
 
         # if a staff updates, allow changing status and admin_response
         if self.request.user.is_staff or self.request.user.is_superuser:
-            updated = serializer.save()
-            # if admin_response provided, notify the user by email
-            if updated.admin_response and updated.user and updated.user.email:
-                subject = f"Response to your feedback: {updated.subject}"
-                message = f"An admin has responded to your feedback:\n\n{updated.admin_response}\n\nStatus: {updated.get_status_display()}"
-                from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', None) or None
-                try:
-                    send_mail(subject, message, from_email, [updated.user.email], fail_silently=True)
-                except Exception:
-                    pass
-            # send realtime notification to the user's notification group (if channels running)
-            try:
-                channel_layer = get_channel_layer()
-                payload = {
-                    'type': 'feedback_update',
-                    'feedback': {
-                        'id': updated.id,
-                        'admin_response': updated.admin_response,
-                        'status': updated.status,
-                        'subject': updated.subject,
-                        'message': updated.message,
-                        'updated_at': updated.updated_at.isoformat() if updated.updated_at else None,
-                    }
-                }
-                async_to_sync(channel_layer.group_send)(f'user_{updated.user.id}', payload)
-            except Exception:
-                # ignore if channel layer not configured or send fails
-                pass
+            # the update, its email and its realtime notification commit (or roll back) together
+            with transaction.atomic():
+                updated = serializer.save()
+                # if admin_response provided, notify the user by email
+                if updated.admin_response and updated.user and updated.user.email:
+                    subject = f"Response to your feedback: {updated.subject}"
+                    message = f"An admin has responded to your feedback:\n\n{updated.admin_response}\n\nStatus: {updated.get_status_display()}"
+                    queue_mail(subject, message, [updated.user.email])
+                # realtime notification to the user's notification group, dispatched after commit
+                if updated.user_id:
+                    publish(f'user_{updated.user_id}', {
+                        'type': 'feedback_update',
+                        'feedback': {
+                            'id': updated.id,
+                            'admin_response': updated.admin_response,
+                            'status': updated.status,
+                            'subject': updated.subject,
+                            'message': updated.message,
+                            'updated_at': updated.updated_at.isoformat() if updated.updated_at else None,
+                        }
+                    })
             return
 
         # if normal user updates, prevent changing status/admin_response
@@ -222,19 +403,18 @@ class FeedbackRetrieveUpdateView(generics.RetrieveUpdateAPIView):
         serializer.save()
 
     def update(self, request, *args, **kwargs):
-        """Override update to log validation errors and request payload for easier debugging.
-        Returns serializer errors with 400 if validation fails, and prints details to server logs.
+        """Override update to log validation errors for easier debugging.
+        Returns serializer errors with 400 if validation fails.
         """
         partial = kwargs.pop('partial', False)
         instance = self.get_object()
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         if not serializer.is_valid():
-            # Log details for debugging
-            try:
-                print("Feedback update validation failed. data=", request.data)
-                print("Validation errors:", serializer.errors)
-            except Exception:
-                pass
+            logger.warning('feedback update validation failed', extra={
+                'feedback_id': instance.id,
+                'user_id': request.user.id,
+                'errors': serializer.errors,
+            })
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
         return super().update(request, *args, **kwargs)
\ No newline at end of file
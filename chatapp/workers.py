@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+def delete_in_batches(queryset, batch_size=1000):
+    """Delete the rows of `queryset` a batch at a time, so no one statement holds the write lock for long."""
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += queryset.model.objects.filter(id__in=ids).delete()[0]
+
+
+class BackgroundWorker:
+    """Daemon thread that runs `process` when woken and every `poll_interval` seconds.
+
+    `process` returns how many items it handled; it is called again straight
+    away while it keeps returning `batch_size` items so a backlog drains without
+    waiting for the next poll. The thread starts on the first `wake()`; servers
+    wake their workers at startup (see ChatappConfig.ready) so rows a previous
+    process left pending or scheduled for retry are picked up straight away.
+
+    `prune`, if given, deletes rows the worker is done with; it runs on the
+    first poll and then every `prune_interval` seconds. The management
+    commands (chatapp.management.base.WorkerCommand) run the same `drain` and
+    `prune` from a dedicated process.
+    """
+
+    def __init__(self, name, process, batch_size, poll_interval=5.0, prune=None, prune_interval=3600.0):
+        self.name = name
+        self.process = process
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.prune = prune
+        self.prune_interval = prune_interval
+        self._next_prune = 0.0
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self._event.set()
+
+    def drain(self, batch_size=None):
+        """Run `process` until it handles less than a full batch; returns how many items it handled."""
+        batch_size = batch_size or self.batch_size
+        total = 0
+        while True:
+            handled = self.process(batch_size)
+            total += handled
+            if handled < batch_size:
+                return total
+
+    def prune_if_due(self):
+        """Run `prune` if `prune_interval` has passed since the last run; returns how many rows it deleted."""
+        if self.prune is None or time.monotonic() < self._next_prune:
+            return 0
+        self._next_prune = time.monotonic() + self.prune_interval
+        return self.prune()
+
+    def _run(self):
+        while True:
+            self._event.wait(self.poll_interval)
+            self._event.clear()
+            try:
+                self.drain()
+                self.prune_if_due()
+            except Exception:
+                logger.exception('background worker failed', extra={'worker': self.name})
+            finally:
+                close_old_connections()
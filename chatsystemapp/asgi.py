@@ -16,6 +16,7 @@ django_asgi_app = get_asgi_application()
 
 # Import routing AFTER Django has loaded the app registry
 from chatapp.routing import websocket_urlpatterns
+from chatapp.lifespan import lifespan
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
@@ -24,4 +25,5 @@ application = ProtocolTypeRouter({
             websocket_urlpatterns
         )
     ),
+    "lifespan": lifespan,
 })
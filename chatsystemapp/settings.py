@@ -81,18 +81,33 @@ WSGI_APPLICATION = 'chatsystemapp.wsgi.application'
 
 ASGI_APPLICATION = 'chatsystemapp.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            'hosts': [os.environ.get("REDIS_SERVER")],
+# 'redis' for multi-process deployments; 'local' (chatapp.layers.LocalChannelLayer) keeps
+# everything in this process and is the default when REDIS_SERVER isn't set
+CHAT_CHANNEL_LAYER = os.environ.get('CHAT_CHANNEL_LAYER', 'redis' if os.environ.get('REDIS_SERVER') else 'local')
+
+if CHAT_CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.environ.get("REDIS_SERVER")],
+            },
         },
-    },
-}
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chatapp.layers.LocalChannelLayer',
+            'CONFIG': {
+                'capacity': int(os.environ.get('CHAT_CHANNEL_CAPACITY', 100)),
+                'expiry': 60,
+            },
+        },
+    }
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chatapp.authentication.CachedJWTAuthentication',
     ),
 }
 
@@ -101,6 +116,78 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=30),
 }
 
+# Users resolved from JWTs (REST and websockets) are cached per process
+CHAT_USER_CACHE_SIZE = int(os.environ.get('CHAT_USER_CACHE_SIZE', 1024))
+CHAT_USER_CACHE_TTL = int(os.environ.get('CHAT_USER_CACHE_TTL', 300))
+# REST and websocket authentication reload cached users older than this, so changes made by other processes apply quickly
+CHAT_AUTH_USER_MAX_AGE = int(os.environ.get('CHAT_AUTH_USER_MAX_AGE', 10))
+CHAT_STAFF_DIRECTORY_TTL = int(os.environ.get('CHAT_STAFF_DIRECTORY_TTL', 300))
+
+# Write-behind persistence for websocket chat messages: batched bulk inserts
+# flushed every CHAT_WRITE_BEHIND_BATCH_SIZE messages or CHAT_WRITE_BEHIND_FLUSH_INTERVAL seconds
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', 100))
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.01))
+# at most this many messages wait to be written per event loop; past that (after CHAT_DB_QUEUE_TIMEOUT)
+# the client gets a `busy` error frame
+CHAT_WRITE_BEHIND_MAX_PENDING = int(os.environ.get('CHAT_WRITE_BEHIND_MAX_PENDING', 1000))
+
+# Broadcast chat messages under a server-assigned uid before they are written, then
+# follow up with message_persisted / message_failed once the write finishes
+CHAT_BROADCAST_BEFORE_PERSIST = os.environ.get('CHAT_BROADCAST_BEFORE_PERSIST', '').lower() in ('1', 'true', 'yes')
+
+# Encoder for websocket frames: 'auto' uses orjson when it is installed, else the stdlib json
+CHAT_JSON_ENCODER = os.environ.get('CHAT_JSON_ENCODER', 'auto')
+
+# Presence: status changes are batched every CHAT_PRESENCE_FLUSH_INTERVAL seconds; sockets that
+# send heartbeat frames are dropped after CHAT_PRESENCE_TTL seconds without one (0 disables expiry)
+CHAT_PRESENCE_FLUSH_INTERVAL = float(os.environ.get('CHAT_PRESENCE_FLUSH_INTERVAL', 0.25))
+CHAT_PRESENCE_TTL = int(os.environ.get('CHAT_PRESENCE_TTL', 60))
+
+# Typing indicators: at most one broadcast per user and conversation every CHAT_TYPING_WINDOW
+# seconds, and an automatic "stopped typing" after CHAT_TYPING_TIMEOUT seconds without keystrokes
+CHAT_TYPING_WINDOW = float(os.environ.get('CHAT_TYPING_WINDOW', 3.0))
+CHAT_TYPING_TIMEOUT = float(os.environ.get('CHAT_TYPING_TIMEOUT', 5.0))
+
+# Rate limits for websocket frames (token buckets: rate per second, burst size). Chat messages are
+# limited per connection and per user across all of that user's sockets; typing per connection.
+# Rejected frames get a `throttled` error frame with a retry_after.
+CHAT_MESSAGE_RATE = float(os.environ.get('CHAT_MESSAGE_RATE', 5.0))
+CHAT_MESSAGE_BURST = int(os.environ.get('CHAT_MESSAGE_BURST', 10))
+CHAT_USER_MESSAGE_RATE = float(os.environ.get('CHAT_USER_MESSAGE_RATE', 10.0))
+CHAT_USER_MESSAGE_BURST = int(os.environ.get('CHAT_USER_MESSAGE_BURST', 20))
+CHAT_TYPING_RATE = float(os.environ.get('CHAT_TYPING_RATE', 5.0))
+CHAT_TYPING_BURST = int(os.environ.get('CHAT_TYPING_BURST', 10))
+CHAT_MAX_MESSAGE_LENGTH = int(os.environ.get('CHAT_MAX_MESSAGE_LENGTH', 4000))
+CHAT_MAX_FRAME_SIZE = int(os.environ.get('CHAT_MAX_FRAME_SIZE', 16384))
+
+# Conversations one multiplexed ws/stream/ socket may subscribe to at once
+CHAT_STREAM_MAX_SUBSCRIPTIONS = int(os.environ.get('CHAT_STREAM_MAX_SUBSCRIPTIONS', 100))
+
+# Reconnect catch-up (`?last_id=` or a `resume` frame): missed messages are replayed in batches of
+# CHAT_CATCH_UP_BATCH_SIZE, at most CHAT_CATCH_UP_LIMIT of them before the client is told to reload
+CHAT_CATCH_UP_BATCH_SIZE = int(os.environ.get('CHAT_CATCH_UP_BATCH_SIZE', 100))
+CHAT_CATCH_UP_LIMIT = int(os.environ.get('CHAT_CATCH_UP_LIMIT', 1000))
+
+# Server processes (daphne, gunicorn, runserver) set CHAT_START_WORKERS=true so the 'thread' workers
+# below poll once at startup and pick up rows left pending by a previous process. Elsewhere
+# (management commands, test runners) a worker thread only starts once the process queues work.
+CHAT_START_WORKERS = os.environ.get('CHAT_START_WORKERS', '').lower() in ('1', 'true', 'yes')
+
+# Realtime notifications (feedback updates) go through a transactional outbox (chatapp.OutboxEvent),
+# dispatched after commit by a worker thread ('thread') or `manage.py dispatch_outbox --loop` ('command')
+CHAT_OUTBOX_WORKER = os.environ.get('CHAT_OUTBOX_WORKER', 'thread')
+CHAT_OUTBOX_BATCH_SIZE = 100
+CHAT_OUTBOX_MAX_ATTEMPTS = 5
+CHAT_OUTBOX_RETRY_DELAY = 5  # seconds, doubled after every failed attempt (at most 5 minutes)
+CHAT_OUTBOX_CLAIM_TIMEOUT = 60  # seconds before a batch claimed by a dispatcher that died is retried
+CHAT_OUTBOX_RETENTION_DAYS = 7  # dispatched events are deleted after this (hourly, by the dispatcher)
+
+# New messages are added to the search index in batches after commit, by a worker thread ('thread')
+# or `manage.py index_search --loop` ('command')
+CHAT_SEARCH_WORKER = os.environ.get('CHAT_SEARCH_WORKER', 'thread')
+CHAT_SEARCH_BATCH_SIZE = 500
+
 # Cors Headers
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -109,12 +196,70 @@ CORS_ALLOW_ALL_ORIGINS = True
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# CHAT_DB_ENGINE selects the profile: 'sqlite' (default, single node) or 'postgres'.
+
+CHAT_DB_ENGINE = os.environ.get('CHAT_DB_ENGINE', 'sqlite')
+
+if CHAT_DB_ENGINE == 'postgres':
+    # pooling (psycopg_pool) and persistent connections are mutually exclusive in Django
+    CHAT_DB_POOL = os.environ.get('CHAT_DB_POOL', '').lower() in ('1', 'true', 'yes')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'chat'),
+            'USER': os.environ.get('POSTGRES_USER', 'chat'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': 0 if CHAT_DB_POOL else int(os.environ.get('CHAT_DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('CHAT_DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.environ.get('CHAT_DB_POOL_MAX_SIZE', 20)),
+                    'timeout': int(os.environ.get('CHAT_DB_POOL_TIMEOUT', 10)),
+                },
+            } if CHAT_DB_POOL else {},
+        }
     }
-}
+    CHAT_DB_SINGLE_WRITER = False
+else:
+    # WAL lets readers run alongside the writer; synchronous=NORMAL is durable across
+    # application crashes in WAL mode. BEGIN IMMEDIATE takes the write lock up front so
+    # concurrent transactions wait on the busy timeout instead of failing on lock upgrade.
+    # The journal mode is written into the database file (and WAL adds -wal/-shm files next
+    # to it), so it is opt-in: deployments set CHAT_SQLITE_JOURNAL_MODE=WAL, while the
+    # checked-in development database is left in whatever mode it is in.
+    CHAT_SQLITE_JOURNAL_MODE = os.environ.get('CHAT_SQLITE_JOURNAL_MODE', '')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': int(os.environ.get('CHAT_DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'timeout': int(os.environ.get('CHAT_SQLITE_BUSY_TIMEOUT', 20)),
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': ';'.join([
+                    *([f'PRAGMA journal_mode={CHAT_SQLITE_JOURNAL_MODE}'] if CHAT_SQLITE_JOURNAL_MODE else []),
+                    f"PRAGMA synchronous={os.environ.get('CHAT_SQLITE_SYNCHRONOUS', 'NORMAL')}",
+                    f"PRAGMA mmap_size={int(os.environ.get('CHAT_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+                    'PRAGMA temp_store=MEMORY',
+                ]),
+            },
+        }
+    }
+    # websocket message writes go through one dedicated thread (chatapp.db.write_to_async)
+    CHAT_DB_SINGLE_WRITER = os.environ.get('CHAT_DB_SINGLE_WRITER', 'true').lower() in ('1', 'true', 'yes')
+
+# Websocket consumers run their queries on a bounded pool of CHAT_DB_WORKERS threads. At most
+# CHAT_DB_MAX_PENDING calls may be queued per event loop (one loop per process under daphne or
+# uvicorn); beyond that a call waits up to
+# CHAT_DB_QUEUE_TIMEOUT seconds for room and is then rejected with a `busy` error frame
+# (0 rejects straight away).
+CHAT_DB_WORKERS = int(os.environ.get('CHAT_DB_WORKERS', 8))
+CHAT_DB_MAX_PENDING = int(os.environ.get('CHAT_DB_MAX_PENDING', 256))
+CHAT_DB_QUEUE_TIMEOUT = float(os.environ.get('CHAT_DB_QUEUE_TIMEOUT', 1.0))
 
 
 # Password validation
@@ -160,6 +305,35 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Logging: chatapp logs structured JSON through a queue so request/websocket handlers never
+# block on stream I/O. Per-message events are logged at DEBUG and skipped entirely at INFO.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'chatapp.log.JSONFormatter'},
+    },
+    'handlers': {
+        'chatapp': {'()': 'chatapp.log.QueueLogHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'chatapp': {
+            'handlers': ['chatapp'],
+            'level': os.environ.get('CHAT_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # Email settings for development: prints emails to console
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 DEFAULT_FROM_EMAIL = 'webmaster@localhost'
+
+# Notification emails go through an outbox (chatapp.OutboundEmail). 'thread' delivers them from a
+# worker thread in each process; 'command' leaves delivery to `manage.py send_queued_mail --loop`.
+CHAT_MAIL_WORKER = os.environ.get('CHAT_MAIL_WORKER', 'thread')
+CHAT_MAIL_BATCH_SIZE = 50
+CHAT_MAIL_MAX_ATTEMPTS = 5
+CHAT_MAIL_RETRY_DELAY = 30  # seconds, doubled after every failed attempt
+CHAT_MAIL_CLAIM_TIMEOUT = 300  # seconds before a batch claimed by a worker that died is retried
+CHAT_MAIL_RETENTION_DAYS = 7  # sent emails are deleted after this (hourly, by the mail worker); failed ones are kept